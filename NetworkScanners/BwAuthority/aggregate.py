@@ -11,6 +11,10 @@ sys.path.append("../../")
 from TorCtl.TorUtil import plog
 from TorCtl import TorCtl,TorUtil
 from TorCtl.PathSupport import VersionRangeRestriction, NodeRestrictionList, NotNodeRestriction
+from sliceindex import SliceIndex
+import bwrecords
+from consensuscache import ConsensusSnapshot
+from phasestats import PhaseStats
 
 bw_files = []
 nodes = {}
@@ -56,6 +60,22 @@ MAX_AGE = 2*GUARD_SAMPLE_RATE
 # If the resultant scan file is older than 1.5 days, something is wrong
 MAX_SCAN_AGE = 60*60*24*1.5
 
+# Parsed slice files are cached here (relative to the first data dir) so
+# that each run only parses slices that finished since the last one.
+# Set to None to always reparse everything.
+SLICE_INDEX_FILE = "slice-index.sqlite"
+
+# The parsed consensus and the descriptors we looked up are kept here
+# (relative to the first data dir) until the consensus' fresh-until time,
+# so reruns in the same consensus period skip the control port entirely.
+# Set to None to always ask Tor.
+CONSENSUS_SNAPSHOT_FILE = "consensus-snapshot.pickle"
+
+# Write per-phase timing, memory use and file/line/node counts as JSON to
+# <vote file>+STATS_SUFFIX. They are always logged at NOTICE as well.
+# Set to None to not write the file.
+STATS_SUFFIX = ".stats.json"
+
 # path to git repos (.git)
 PATH_TO_TORFLOW_REPO = '../../.git/'
 PATH_TO_TORCTL_REPO = '../../.git/modules/TorCtl/'
@@ -173,50 +193,91 @@ class Node:
       self.circ_fail_rate = line.circ_fail_rate
       self.strm_fail_rate = line.strm_fail_rate
 
-class Line:
+def parse_kv_line(line):
+  # Split a "key=value key=value ..." line into a dict in one pass,
+  # instead of running a separate regex per field.
+  fields = {}
+  for tok in line.split():
+    key, sep, val = tok.partition("=")
+    if sep:
+      fields[key] = val
+  return fields
+
+class Line(object):
   def __init__(self, line, slice_file, timestamp):
-    self.idhex = re.search("[\s]*node_id=([\S]+)[\s]*", line).group(1)
-    self.nick = re.search("[\s]*nick=([\S]+)[\s]*", line).group(1)
-    self.strm_bw = int(re.search("[\s]*strm_bw=([\S]+)[\s]*", line).group(1))
-    self.filt_bw = int(re.search("[\s]*filt_bw=([\S]+)[\s]*", line).group(1))
-    self.ns_bw = int(re.search("[\s]*ns_bw=([\S]+)[\s]*", line).group(1))
-    self.desc_bw = int(re.search("[\s]*desc_bw=([\S]+)[\s]*", line).group(1))
+    f = parse_kv_line(line)
+    self.idhex = f["node_id"]
+    self.nick = f["nick"]
+    self.strm_bw = int(f["strm_bw"])
+    self.filt_bw = int(f["filt_bw"])
+    self.ns_bw = int(f["ns_bw"])
+    self.desc_bw = int(f["desc_bw"])
     self.slice_file = slice_file
     self.measured_at = timestamp
     try:
-      self.circ_fail_rate = float(re.search("[\s]*circ_fail_rate=([\S]+)[\s]*", line).group(1))
-    except:
+      self.circ_fail_rate = float(f["circ_fail_rate"])
+    except (KeyError, ValueError):
       self.circ_fail_rate = 0
     try:
-      self.strm_fail_rate = float(re.search("[\s]*strm_fail_rate=([\S]+)[\s]*", line).group(1))
-    except:
+      self.strm_fail_rate = float(f["strm_fail_rate"])
+    except (KeyError, ValueError):
       self.strm_fail_rate = 0
 
+  # Rebuild a Line from a SliceIndex row without reparsing the slice file
+  @classmethod
+  def from_row(cls, row, slice_file, timestamp):
+    self = cls.__new__(cls)
+    # Same order as sliceindex.LINE_FIELDS
+    (self.idhex, self.nick, self.strm_bw, self.filt_bw, self.ns_bw,
+     self.desc_bw, self.circ_fail_rate, self.strm_fail_rate) = row
+    self.slice_file = slice_file
+    self.measured_at = timestamp
+    return self
+
+  def to_row(self):
+    return (self.idhex, self.nick, self.strm_bw, self.filt_bw, self.ns_bw,
+            self.desc_bw, self.circ_fail_rate, self.strm_fail_rate)
+
 
 class Vote:
   def __init__(self, line):
     # node_id=$DB8C6D8E0D51A42BDDA81A9B8A735B41B2CF95D1 bw=231000 diff=209281 nick=rainbowwarrior measured_at=1319822504
-    self.idhex = re.search("[\s]*node_id=([\S]+)[\s]*", line).group(1)
-    self.nick = re.search("[\s]*nick=([\S]+)[\s]*", line).group(1)
-    self.bw = int(re.search("[\s]+bw=([\S]+)[\s]*", line).group(1))
-    self.measured_at = int(re.search("[\s]*measured_at=([\S]+)[\s]*", line).group(1))
+    f = parse_kv_line(line)
+    self.idhex = f["node_id"]
+    self.nick = f["nick"]
+    self.bw = int(f["bw"])
+    self.measured_at = int(f["measured_at"])
     try:
-      self.pid_error = float(re.search("[\s]*pid_error=([\S]+)[\s]*", line).group(1))
-      self.pid_error_sum = float(re.search("[\s]*pid_error_sum=([\S]+)[\s]*", line).group(1))
-      self.pid_delta = float(re.search("[\s]*pid_delta=([\S]+)[\s]*", line).group(1))
-      self.pid_bw = float(re.search("[\s]*pid_bw=([\S]+)[\s]*", line).group(1))
-    except:
+      self.pid_error = float(f["pid_error"])
+      self.pid_error_sum = float(f["pid_error_sum"])
+      self.pid_delta = float(f["pid_delta"])
+      self.pid_bw = float(f["pid_bw"])
+    except (KeyError, ValueError):
       plog("NOTICE", "No previous PID data.")
       self.pid_bw = self.bw
       self.pid_error = 0
       self.pid_delta = 0
       self.pid_error_sum = 0
     try:
-      self.updated_at = int(re.search("[\s]*updated_at=([\S]+)[\s]*", line).group(1))
-    except:
+      self.updated_at = int(f["updated_at"])
+    except (KeyError, ValueError):
       plog("INFO", "No updated_at field for "+self.nick+"="+self.idhex)
       self.updated_at = self.measured_at
 
+def read_slice_lines(fp, slice_file, timestamp):
+  # Stream Lines out of an open slice file whose slicenum and timestamp
+  # header lines have already been consumed. Bad lines are logged and
+  # skipped, so the whole file is never held in memory.
+  for l in fp:
+    try:
+      yield Line(l, slice_file, timestamp)
+    except ValueError, e:
+      plog("NOTICE", "Conversion error "+str(e)+" at "+l)
+    except KeyError, e:
+      plog("NOTICE", "Slice file format error: missing "+str(e)+" at "+l)
+    except Exception, e:
+      plog("WARN", "Unknown slice parse error "+str(e)+" at "+l)
+      traceback.print_exc()
 
 class VoteSet:
   def __init__(self, filename):
@@ -224,16 +285,20 @@ class VoteSet:
     try:
       f = file(filename, "r")
       f.readline()
-      for line in f.readlines():
+      for line in f:
         vote = Vote(line)
         self.vote_map[vote.idhex] = vote
+      f.close()
     except IOError:
       plog("NOTICE", "No previous vote data.")
 
 # Misc items we need to get out of the consensus
 class ConsensusJunk:
-  def __init__(self, c):
-    cs_bytes = c.sendAndRecv("GETINFO dir/status-vote/current/consensus\r\n")[0][2]
+  def __init__(self, c, cs_bytes=None):
+    # cs_bytes lets callers supply the consensus text (or just its
+    # params and bandwidth-weights lines) instead of asking Tor for it
+    if cs_bytes is None:
+      cs_bytes = c.sendAndRecv("GETINFO dir/status-vote/current/consensus\r\n")[0][2]
     self.bwauth_pid_control = True
     self.group_by_class = False
     self.use_pid_tgt = False
@@ -360,56 +425,14 @@ def write_file_list(datadir):
   # atomic on POSIX
   os.rename(datadir+"/bwfiles.new", datadir+"/bwfiles")
 
-def main(argv):
-  TorUtil.read_config(argv[1]+"/scanner.1/bwauthority.cfg")
-  TorUtil.logfile = "data/aggregate-debug.log"
-
-  (branch, head) = TorUtil.get_git_version(PATH_TO_TORFLOW_REPO)
-  plog('NOTICE', 'TorFlow Version: %s' % branch+' '+head)
-  (branch, head) = TorUtil.get_git_version(PATH_TO_TORCTL_REPO)
-  plog('NOTICE', 'TorCtl Version: %s' % branch+' '+head)
-
-  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  s.connect((TorUtil.control_host,TorUtil.control_port))
-  c = TorCtl.Connection(s)
-  c.debug(file(argv[1]+"/aggregate-control.log", "w", buffering=0))
-  c.authenticate_cookie(file(argv[1]+"/tor.1/control_auth_cookie",
-                         "r"))
-
-  ns_list = c.get_network_status()
-  for n in ns_list:
-    if n.bandwidth == None: n.bandwidth = -1
-  ns_list.sort(lambda x, y: int(y.bandwidth/10000.0 - x.bandwidth/10000.0))
-  for n in ns_list:
-    if n.bandwidth == -1: n.bandwidth = None
-  got_ns_bw = False
-  max_rank = len(ns_list)
-
-  cs_junk = ConsensusJunk(c)
-
-  # TODO: This is poor form.. We should subclass the Networkstatus class
-  # instead of just adding members
-  for i in xrange(max_rank):
-    n = ns_list[i]
-    n.list_rank = i
-    if n.bandwidth == None:
-      plog("NOTICE", "Your Tor is not providing NS w bandwidths for "+n.idhex)
-    else:
-      got_ns_bw = True
-    n.measured = False
-    prev_consensus["$"+n.idhex] = n
-
-  if not got_ns_bw:
-    # Sometimes the consensus lacks a descriptor. In that case,
-    # it will skip outputting 
-    plog("ERROR", "Your Tor is not providing NS w bandwidths!")
-    sys.exit(0)
-
+def find_slice_files(datadirs, bw_files, slice_index=None, max_age=MAX_AGE):
   # Take the most recent timestamp from each scanner 
   # and use the oldest for the timestamp of the result.
   # That way we can ensure all the scanners continue running.
+  # Files older than max_age are deleted. max_age=None keeps (and
+  # returns) everything, e.g. when reading an archive.
   scanner_timestamps = {}
-  for da in argv[1:-1]:
+  for da in datadirs:
     # First, create a list of the most recent files in the
     # scan dirs that are recent enough
     for root, dirs, f in os.walk(da):
@@ -417,61 +440,92 @@ def main(argv):
         if re.match("^scanner.[\d+]$", ds):
           newest_timestamp = 0
           for sr, sd, files in os.walk(da+"/"+ds+"/scan-data"):
+            names = set(files)
+            # Slices with a readable compact bwr- copy are read from that
+            records = {}
+            for f in files:
+              if re.search("^bwr-[\S]+-done-", f):
+                try:
+                  records[f[len("bwr-"):]] = bwrecords.read_header(sr+"/"+f)
+                except ValueError, e:
+                  plog("WARN", str(e))
             for f in files:
-              if re.search("^bws-[\S]+-done-", f):
-                fp = file(sr+"/"+f, "r")
-                slicenum = sr+"/"+fp.readline()
-                timestamp = float(fp.readline())
-                fp.close()
-                # old measurements are probably
-                # better than no measurements. We may not
-                # measure hibernating routers for days.
-                # This filter is just to remove REALLY old files
-                if time.time() - timestamp > MAX_AGE:
-                  sqlf = f.replace("bws-", "sql-")
-                  plog("INFO", "Removing old file "+f+" and "+sqlf)
-                  os.remove(sr+"/"+f)
-                  try:
-                    os.remove(sr+"/"+sqlf)
-                  except:
-                    pass # In some cases the sql file may not exist
+              if f.startswith("bwr-") and f[len("bwr-"):] in records:
+                (slicenum, timestamp) = records[f[len("bwr-"):]]
+                slicenum = sr+"/slicenum="+str(slicenum)+"\n"
+              elif re.search("^bws-[\S]+-done-", f):
+                if f[len("bws-"):] in records:
                   continue
-                if timestamp > newest_timestamp:
-                  newest_timestamp = timestamp
-                bw_files.append((slicenum, timestamp, sr+"/"+f))
+                header = None
+                if slice_index:
+                  header = slice_index.lookup(sr+"/"+f, os.stat(sr+"/"+f))
+                if header:
+                  (slicenum, timestamp) = header
+                else:
+                  fp = file(sr+"/"+f, "r")
+                  slicenum = sr+"/"+fp.readline()
+                  timestamp = float(fp.readline())
+                  fp.close()
+              else:
+                continue
+              # old measurements are probably
+              # better than no measurements. We may not
+              # measure hibernating routers for days.
+              # This filter is just to remove REALLY old files
+              if max_age is not None and time.time() - timestamp > max_age:
+                base = f[len("bws-"):]
+                plog("INFO", "Removing old files for "+base)
+                for prefix in ("bws-", "bwr-", "sql-"):
+                  if prefix+base in names:
+                    os.remove(sr+"/"+prefix+base)
+                if slice_index:
+                  slice_index.forget(sr+"/bws-"+base)
+                continue
+              if timestamp > newest_timestamp:
+                newest_timestamp = timestamp
+              bw_files.append((slicenum, timestamp, sr+"/"+f))
           scanner_timestamps[ds] = newest_timestamp
+  return scanner_timestamps
+
+def add_lines(nodes, lines):
+  count = 0
+  for line in lines:
+    if line.idhex not in nodes:
+      n = Node()
+      nodes[line.idhex] = n
+    else:
+      n = nodes[line.idhex]
+    n.add_line(line)
+    count += 1
+  return count
 
+def load_slice_files(bw_files, nodes, slice_index=None):
   # Need to only use most recent slice-file for each node..
+  # Returns the number of measurement lines read.
+  line_count = 0
   for (s,t,f) in bw_files:
+    if os.path.basename(f).startswith("bwr-"):
+      line_count += add_lines(nodes, (Line.from_row(r, s, t)
+                                        for r in bwrecords.read_rows(f)))
+      continue
+    if slice_index:
+      rows = slice_index.get_lines(f)
+      if rows is not None:
+        line_count += add_lines(nodes, (Line.from_row(r, s, t) for r in rows))
+        continue
     fp = file(f, "r")
     fp.readline() # slicenum
     fp.readline() # timestamp
-    for l in fp.readlines():
-      try:
-        line = Line(l,s,t)
-        if line.idhex not in nodes:
-          n = Node()
-          nodes[line.idhex] = n
-        else:
-          n = nodes[line.idhex]
-        n.add_line(line)
-      except ValueError,e:
-        plog("NOTICE", "Conversion error "+str(e)+" at "+l)
-      except AttributeError, e:
-        plog("NOTICE", "Slice file format error "+str(e)+" at "+l)
-      except Exception, e:
-        plog("WARN", "Unknown slice parse error "+str(e)+" at "+l)
-        traceback.print_exc()
+    lines = read_slice_lines(fp, s, t)
+    if slice_index:
+      lines = list(lines)
+      slice_index.store(f, os.fstat(fp.fileno()), s, t,
+                        [l.to_row() for l in lines])
+    line_count += add_lines(nodes, lines)
     fp.close()
+  return line_count
 
-  if len(nodes) == 0:
-    plog("NOTICE", "No scan results yet.")
-    sys.exit(1)
-
-  for idhex in nodes.iterkeys():
-    if idhex in prev_consensus:
-      nodes[idhex].flags = prev_consensus[idhex].flags
-
+def class_averages(nodes, cs_junk):
   true_filt_avg = {}
   pid_tgt_avg = {}
   true_strm_avg = {}
@@ -489,6 +543,9 @@ def main(argv):
 
     for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
       c_nodes = filter(lambda n: n.node_class() == cl, nodes.itervalues())
+      if not c_nodes:
+        plog("NOTICE", "No measured nodes of class "+cl)
+        continue
       true_filt_avg[cl] = sum(map(lambda n: n.filt_bw, c_nodes))/float(len(c_nodes))
       true_strm_avg[cl] = sum(map(lambda n: n.strm_bw, c_nodes))/float(len(c_nodes))
       true_circ_avg[cl] = sum(map(lambda n: (1.0-n.circ_fail_rate),
@@ -541,38 +598,10 @@ def main(argv):
       true_filt_avg[cl] = filt_avg
       true_strm_avg[cl] = strm_avg
 
+  return (true_filt_avg, true_strm_avg, true_circ_avg, pid_tgt_avg)
 
-  prev_votes = None
-  if cs_junk.bwauth_pid_control:
-    prev_votes = VoteSet(argv[-1])
-
-    guard_cnt = 0
-    node_cnt = 0
-    guard_measure_time = 0
-    node_measure_time = 0
-    for n in nodes.itervalues():
-      if n.idhex in prev_votes.vote_map and n.idhex in prev_consensus:
-        if "Guard" in prev_consensus[n.idhex].flags and \
-           "Exit" not in prev_consensus[n.idhex].flags:
-          if n.measured_at != prev_votes.vote_map[n.idhex].measured_at:
-            guard_cnt += 1
-            guard_measure_time += (n.measured_at - \
-                                    prev_votes.vote_map[n.idhex].measured_at)
-        else:
-          if n.updated_at != prev_votes.vote_map[n.idhex].updated_at:
-            node_cnt += 1
-            node_measure_time += (n.updated_at - \
-                                  prev_votes.vote_map[n.idhex].updated_at)
-
-    # TODO: We may want to try to use this info to autocompute T_d and
-    # maybe T_i?
-    if node_cnt > 0:
-      plog("INFO", "Avg of "+str(node_cnt)+" node update intervals: "+str((node_measure_time/node_cnt)/3600.0))
-
-    if guard_cnt > 0:
-      plog("INFO", "Avg of "+str(guard_cnt)+" guard measurement interval: "+str((guard_measure_time/guard_cnt)/3600.0))
-
-  tot_net_bw = 0
+def pid_feedback(nodes, cs_junk, prev_votes, prev_consensus, true_filt_avg,
+                 true_strm_avg, true_circ_avg, pid_tgt_avg):
   for n in nodes.itervalues():
     n.fbw_ratio = n.filt_bw/true_filt_avg[n.node_class()]
     n.sbw_ratio = n.strm_bw/true_strm_avg[n.node_class()]
@@ -743,10 +772,10 @@ def main(argv):
 
     n.change = n.new_bw - n.desc_bw
 
+def mark_ignored(nodes, prev_consensus):
+  # Authorities, and guards while IGNORE_GUARDS is set, get no vote
+  for n in nodes.itervalues():
     if n.idhex in prev_consensus:
-      if prev_consensus[n.idhex].bandwidth != None:
-        prev_consensus[n.idhex].measured = True
-        tot_net_bw += n.new_bw
       if IGNORE_GUARDS \
            and ("Guard" in prev_consensus[n.idhex].flags and not "Exit" in \
                   prev_consensus[n.idhex].flags):
@@ -756,6 +785,7 @@ def main(argv):
         plog("DEBUG", "Skipping voting for authority "+n.nick)
         n.ignore = True
 
+def clip_votes(nodes, cs_junk, prev_consensus, tot_net_bw):
   # Go through the list and cap them to NODE_CAP
   for n in nodes.itervalues():
     if n.new_bw >= 0x7fffffff:
@@ -781,6 +811,190 @@ def main(argv):
         plog("INFO", "New node "+n.idhex+"="+n.nick+" has bandwidth < 0: "+str(n.new_bw))
       n.new_bw = 1
 
+def vote_line(n):
+  # Turns out str() is more accurate than %lf
+  return "node_id="+n.idhex+" bw="+str(base10_round(n.new_bw))+" nick="+n.nick+ " measured_at="+str(int(n.measured_at))+" updated_at="+str(int(n.updated_at))+" pid_error="+str(n.pid_error)+" pid_error_sum="+str(n.pid_error_sum)+" pid_bw="+str(int(n.pid_bw))+" pid_delta="+str(n.pid_delta)+" circ_fail="+str(n.circ_fail_rate)+"\n"
+
+def connect_control(datadir):
+  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  s.connect((TorUtil.control_host,TorUtil.control_port))
+  c = TorCtl.Connection(s)
+  c.debug(file(datadir+"/aggregate-control.log", "w", buffering=0))
+  c.authenticate_cookie(file(datadir+"/tor.1/control_auth_cookie",
+                         "r"))
+  return c
+
+def read_consensus(snapshot, prev_consensus):
+  """Rank the routers of a ConsensusSnapshot by consensus bandwidth and
+  add them to prev_consensus by "$"+idhex. Returns (number of routers,
+  ConsensusJunk, whether any router had a consensus bandwidth)."""
+  ns_list = snapshot.network_status()
+  for n in ns_list:
+    if n.bandwidth == None: n.bandwidth = -1
+  ns_list.sort(lambda x, y: int(y.bandwidth/10000.0 - x.bandwidth/10000.0))
+  for n in ns_list:
+    if n.bandwidth == -1: n.bandwidth = None
+  got_ns_bw = False
+  max_rank = len(ns_list)
+
+  cs_junk = ConsensusJunk(None, snapshot.consensus_junk_text())
+
+  # TODO: This is poor form.. We should subclass the Networkstatus class
+  # instead of just adding members
+  for i in xrange(max_rank):
+    n = ns_list[i]
+    n.list_rank = i
+    if n.bandwidth == None:
+      plog("NOTICE", "Your Tor is not providing NS w bandwidths for "+n.idhex)
+    else:
+      got_ns_bw = True
+    n.measured = False
+    prev_consensus["$"+n.idhex] = n
+  return (max_rank, cs_junk, got_ns_bw)
+
+def read_measurements(datadirs, bw_files, nodes, prev_consensus,
+                      slice_index, stats):
+  """The discovery and parsing phases: find the slice files under
+  datadirs and load them into nodes, then close slice_index. Returns the
+  newest slice timestamp of each scanner."""
+  stats.start("discovery")
+  scanner_timestamps = find_slice_files(datadirs, bw_files, slice_index)
+  stats.count("files", len(bw_files))
+
+  stats.start("parsing")
+  stats.count("lines", load_slice_files(bw_files, nodes, slice_index))
+  stats.count("nodes", len(nodes))
+
+  if slice_index:
+    slice_index.expire()
+    plog("INFO", "Slice index: "+str(slice_index.hits)+" cached, "
+                 +str(slice_index.misses)+" parsed")
+    slice_index.close()
+
+  for idhex in nodes.iterkeys():
+    if idhex in prev_consensus:
+      nodes[idhex].flags = prev_consensus[idhex].flags
+  return scanner_timestamps
+
+def compute_feedback(nodes, cs_junk, vote_file, prev_consensus, stats):
+  """The averaging and pid phases: class averages, PID feedback against
+  the previous votes in vote_file, and clipping. Sets new_bw and ignore
+  on the nodes and measured on prev_consensus."""
+  stats.start("averaging")
+  (true_filt_avg, true_strm_avg, true_circ_avg, pid_tgt_avg) = \
+     class_averages(nodes, cs_junk)
+
+  stats.start("pid")
+  prev_votes = None
+  if cs_junk.bwauth_pid_control:
+    prev_votes = VoteSet(vote_file)
+
+    guard_cnt = 0
+    node_cnt = 0
+    guard_measure_time = 0
+    node_measure_time = 0
+    for n in nodes.itervalues():
+      if n.idhex in prev_votes.vote_map and n.idhex in prev_consensus:
+        if "Guard" in prev_consensus[n.idhex].flags and \
+           "Exit" not in prev_consensus[n.idhex].flags:
+          if n.measured_at != prev_votes.vote_map[n.idhex].measured_at:
+            guard_cnt += 1
+            guard_measure_time += (n.measured_at - \
+                                    prev_votes.vote_map[n.idhex].measured_at)
+        else:
+          if n.updated_at != prev_votes.vote_map[n.idhex].updated_at:
+            node_cnt += 1
+            node_measure_time += (n.updated_at - \
+                                  prev_votes.vote_map[n.idhex].updated_at)
+
+    # TODO: We may want to try to use this info to autocompute T_d and
+    # maybe T_i?
+    if node_cnt > 0:
+      plog("INFO", "Avg of "+str(node_cnt)+" node update intervals: "+str((node_measure_time/node_cnt)/3600.0))
+
+    if guard_cnt > 0:
+      plog("INFO", "Avg of "+str(guard_cnt)+" guard measurement interval: "+str((guard_measure_time/guard_cnt)/3600.0))
+
+  tot_net_bw = 0
+  pid_feedback(nodes, cs_junk, prev_votes, prev_consensus, true_filt_avg,
+               true_strm_avg, true_circ_avg, pid_tgt_avg)
+
+  for n in nodes.itervalues():
+    if n.idhex in prev_consensus and \
+       prev_consensus[n.idhex].bandwidth != None:
+      prev_consensus[n.idhex].measured = True
+      tot_net_bw += n.new_bw
+  mark_ignored(nodes, prev_consensus)
+
+  clip_votes(nodes, cs_junk, prev_consensus, tot_net_bw)
+
+def write_votes(vote_file, nodes, timestamp):
+  """Write a vote line for each node that is not ignored, highest
+  pid_error first. Returns the number of votes written."""
+  n_print = nodes.values()
+  n_print.sort(lambda x,y: int(y.pid_error*1000) - int(x.pid_error*1000))
+
+  out = file(vote_file, "w")
+  out.write(str(timestamp)+"\n")
+
+  # FIXME: Split out debugging data
+  votes = 0
+  for n in n_print:
+    if not n.ignore:
+      out.write(vote_line(n))
+      votes += 1
+  out.close()
+  return votes
+
+def main(argv):
+  stats = PhaseStats()
+  stats.start("consensus")
+  TorUtil.read_config(argv[1]+"/scanner.1/bwauthority.cfg")
+  TorUtil.logfile = "data/aggregate-debug.log"
+
+  (branch, head) = TorUtil.get_git_version(PATH_TO_TORFLOW_REPO)
+  plog('NOTICE', 'TorFlow Version: %s' % branch+' '+head)
+  (branch, head) = TorUtil.get_git_version(PATH_TO_TORCTL_REPO)
+  plog('NOTICE', 'TorCtl Version: %s' % branch+' '+head)
+
+  # Only talk to Tor if the consensus snapshot is stale or missing a
+  # descriptor we need
+  conn = []
+  def get_conn():
+    if not conn:
+      conn.append(connect_control(argv[1]))
+    return conn[0]
+
+  snapshot = None
+  if CONSENSUS_SNAPSHOT_FILE:
+    snapshot = ConsensusSnapshot.load(argv[1]+"/"+CONSENSUS_SNAPSHOT_FILE)
+  if snapshot:
+    plog("INFO", "Using cached consensus from "+
+                 time.asctime(time.gmtime(snapshot.valid_after)))
+  else:
+    snapshot = ConsensusSnapshot(get_conn().sendAndRecv(
+                 "GETINFO dir/status-vote/current/consensus\r\n")[0][2])
+
+  (max_rank, cs_junk, got_ns_bw) = read_consensus(snapshot, prev_consensus)
+
+  if not got_ns_bw:
+    # Sometimes the consensus lacks a descriptor. In that case,
+    # it will skip outputting 
+    plog("ERROR", "Your Tor is not providing NS w bandwidths!")
+    sys.exit(0)
+
+  slice_index = None
+  if SLICE_INDEX_FILE:
+    slice_index = SliceIndex(argv[1]+"/"+SLICE_INDEX_FILE)
+
+  scanner_timestamps = read_measurements(argv[1:-1], bw_files, nodes,
+                                         prev_consensus, slice_index, stats)
+  if len(nodes) == 0:
+    plog("NOTICE", "No scan results yet.")
+    sys.exit(1)
+
+  compute_feedback(nodes, cs_junk, argv[-1], prev_consensus, stats)
+
   oldest_measured = min(map(lambda n: n.measured_at,
              filter(lambda n: n.idhex in prev_consensus,
                        nodes.itervalues())))
@@ -791,6 +1005,11 @@ def main(argv):
                        nodes.itervalues())))
   plog("INFO", "Oldest updated node: "+time.ctime(oldest_updated))
 
+  stats.start("descriptors")
+  snapshot.fetch_routers(filter(lambda n: not n.measured and
+                                 "Fast" in n.flags and "Running" in n.flags,
+                               prev_consensus.itervalues()), get_conn)
+
   missed_nodes = 0.0
   missed_bw = 0
   tot_bw = 0
@@ -799,10 +1018,7 @@ def main(argv):
       tot_bw += n.bandwidth
     if not n.measured:
       if "Fast" in n.flags and "Running" in n.flags:
-        try:
-          r = c.get_router(n)
-        except TorCtl.ErrorReply:
-          r = None
+        r = snapshot.get_router(n, get_conn)
         if r and not r.down and r.bw > 0:
           #if time.mktime(r.published.utctimetuple()) - r.uptime \
           #       < oldest_timestamp:
@@ -815,6 +1031,9 @@ def main(argv):
           # checks.. Possibly going in and out of hibernation?
           plog("DEBUG", "Didn't measure "+n.idhex+"="+n.nickname+" at "+str(round((100.0*n.list_rank)/max_rank,1))+" "+str(n.bandwidth))
 
+  if CONSENSUS_SNAPSHOT_FILE:
+    snapshot.save(argv[1]+"/"+CONSENSUS_SNAPSHOT_FILE)
+
   measured_pct = round(100.0*len(nodes)/(len(nodes)+missed_nodes),1)
   measured_bw_pct = 100.0 - round((100.0*missed_bw)/tot_bw,1)
   if measured_pct < MIN_REPORT:
@@ -833,6 +1052,8 @@ def main(argv):
 
   for cl in ["Guard+Exit", "Guard", "Exit", "Middle"]:
     c_nodes = filter(lambda n: n.node_class() == cl, nodes.itervalues())
+    if not c_nodes:
+      continue
     nc_nodes = filter(lambda n: n.pid_error < 0, c_nodes)
     pc_nodes = filter(lambda n: n.pid_error > 0, c_nodes)
     plog("INFO", "Avg "+cl+"  pid_error="+str(sum(map(lambda n: n.pid_error, c_nodes))/len(c_nodes)))
@@ -852,26 +1073,22 @@ def main(argv):
        "Measured "+str(measured_pct) +"% of all tor nodes ("
        +str(measured_bw_pct)+"% of previous consensus bw).")
 
-  n_print = nodes.values()
-  n_print.sort(lambda x,y: int(y.pid_error*1000) - int(x.pid_error*1000))
-
   for scanner in scanner_timestamps.iterkeys():
     scan_age = int(round(scanner_timestamps[scanner],0))
     if scan_age < time.time() - MAX_SCAN_AGE:
       plog("WARN", "Bandwidth scanner "+scanner+" stale. Possible dead bwauthority.py. Timestamp: "+time.ctime(scan_age))
 
-  out = file(argv[-1], "w")
-  out.write(str(scan_age)+"\n")
-
-  # FIXME: Split out debugging data
-  for n in n_print:
-    if not n.ignore:
-      # Turns out str() is more accurate than %lf
-      out.write("node_id="+n.idhex+" bw="+str(base10_round(n.new_bw))+" nick="+n.nick+ " measured_at="+str(int(n.measured_at))+" updated_at="+str(int(n.updated_at))+" pid_error="+str(n.pid_error)+" pid_error_sum="+str(n.pid_error_sum)+" pid_bw="+str(int(n.pid_bw))+" pid_delta="+str(n.pid_delta)+" circ_fail="+str(n.circ_fail_rate)+"\n")
-  out.close()
+  stats.start("vote_writing")
+  stats.count("votes", write_votes(argv[-1], nodes, scan_age))
 
   write_file_list(argv[1])
 
+  stats.stop()
+  stats.count("missed_nodes", int(missed_nodes))
+  plog("NOTICE", "Aggregate stats: "+stats.summary_line())
+  if STATS_SUFFIX:
+    stats.write(argv[-1]+STATS_SUFFIX)
+
 if __name__ == "__main__":
   try:
     main(sys.argv)
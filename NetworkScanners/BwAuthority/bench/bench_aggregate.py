@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# Scaling benchmark for the aggregate.py pipeline. Run from this directory.
+
+"""
+Aggregate benchmark
+
+Generates synthetic scanner.N/scan-data trees, a matching consensus and a
+previous vote file (synthdata.py), then runs them through the same
+aggregate.py helpers that main() calls and times each phase separately:
+
+  consensus     read_consensus()
+  discovery     find_slice_files(), from read_measurements()
+  parsing       load_slice_files(), from read_measurements()
+  averaging     class averages, from compute_feedback()
+  pid           reading the previous votes, PID feedback and clipping,
+                from compute_feedback()
+  vote_writing  write_votes()
+
+Only talking to Tor and the descriptor lookups are left out. The previous
+votes are read from a separate file rather than the vote file, so every
+repeat sees the same input.
+
+Usage:
+  ./bench_aggregate.py [--relays=N,...] [--scanners=N,...] [--rounds=N,...]
+                       [--index=off,on] [--repeat=N] [--out=report.json]
+                       [--baseline=old-report.json] [--tolerance=0.25]
+
+With --index=on the slice index is kept where main() keeps it and filled
+by an untimed run first, so the times are those of a rerun with no new
+slices; the default follows aggregate.SLICE_INDEX_FILE. Every combination
+of the comma separated lists is run, each --repeat times, keeping the
+fastest time per phase. The report is JSON. With
+--baseline, any phase that got more than --tolerance slower than in the
+baseline report (and by at least 10ms) is listed, and the exit status is
+1, so this can gate a deployment.
+"""
+
+import getopt
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+from TorCtl import TorUtil
+import aggregate
+from consensuscache import ConsensusSnapshot
+from phasestats import PhaseStats
+from sliceindex import SliceIndex
+import synthdata
+
+PHASES = ["consensus", "discovery", "parsing", "averaging", "pid",
+          "vote_writing"]
+
+# Slower than this is never flagged as a regression; timer noise
+MIN_REGRESSION = 0.01
+
+class Scenario:
+  def __init__(self, workdir, relays, scanners, rounds):
+    self.relays = relays
+    self.scanners = scanners
+    self.rounds = rounds
+    self.datadir = workdir+"/data-%d-%d-%d" % (relays, scanners, rounds)
+    os.makedirs(self.datadir)
+    rlist = synthdata.make_relays(relays)
+    synthdata.write_scan_tree(self.datadir, rlist, scanners, rounds)
+    now = time.time()
+    descs = dict((r.idhex, synthdata.descriptor(r, now-3600)) for r in rlist)
+    self.consensus = synthdata.consensus(rlist, descs)
+    self.prev_votes = self.datadir+"/bwscan.prev"
+    synthdata.write_votes(self.prev_votes, rlist, now-3600)
+    self.vote_file = self.datadir+"/bwscan"
+
+  def run(self, index):
+    stats = PhaseStats()
+    stats.start("consensus")
+    prev_consensus = {}
+    (max_rank, cs_junk, got_ns_bw) = aggregate.read_consensus(
+                   ConsensusSnapshot(self.consensus), prev_consensus)
+
+    slice_index = None
+    if index == "on":
+      slice_index = SliceIndex(self.datadir+"/"+self.index_file())
+    bw_files = []
+    nodes = {}
+    aggregate.read_measurements([self.datadir], bw_files, nodes,
+                                prev_consensus, slice_index, stats)
+    aggregate.compute_feedback(nodes, cs_junk, self.prev_votes,
+                               prev_consensus, stats)
+
+    stats.start("vote_writing")
+    aggregate.write_votes(self.vote_file, nodes, int(time.time()))
+    stats.stop()
+    times = dict((p["name"], p["wall"]) for p in stats.phases)
+    return (times, len(bw_files), len(nodes))
+
+  def index_file(self):
+    return aggregate.SLICE_INDEX_FILE or "slice-index.sqlite"
+
+  def reset_index(self):
+    path = self.datadir+"/"+self.index_file()
+    if os.path.exists(path):
+      os.remove(path)
+
+def run_key(run):
+  return (run["relays"], run["scanners"], run["rounds"],
+          run.get("index", "off"))
+
+def compare(report, baseline, tolerance):
+  """Return a list of (run key, phase, old secs, new secs) for every
+  phase that got slower than the baseline allows."""
+  # Older reports also have runs of the numpy engine and of parsing
+  # pools, which are gone
+  old_runs = dict((run_key(r), r) for r in baseline["runs"]
+                    if r.get("engine", "python") == "python"
+                       and r.get("processes", 1) == 1)
+  regressions = []
+  for run in report["runs"]:
+    old = old_runs.get(run_key(run))
+    if not old:
+      continue
+    for phase in PHASES:
+      (was, now) = (old["phases"].get(phase), run["phases"][phase])
+      if was is not None and now > was*(1+tolerance) and \
+         now - was >= MIN_REGRESSION:
+        regressions.append((run_key(run), phase, was, now))
+  return regressions
+
+def int_list(val):
+  return map(int, val.split(","))
+
+def usage(argv):
+  print "Usage: "+argv[0]+" [--relays=N,...] [--scanners=N,...] [--rounds=N,...]"
+  print "         [--index=off,on] [--repeat=N] [--out=FILE]"
+  print "         [--baseline=FILE] [--tolerance=FRACTION]"
+
+def main(argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "",
+                    ["relays=", "scanners=", "rounds=",
+                     "index=", "repeat=", "out=", "baseline=",
+                     "tolerance="])
+  except getopt.GetoptError, e:
+    print str(e)
+    usage(argv)
+    sys.exit(1)
+
+  relay_counts = [2000, 7000]
+  scanner_counts = [9]
+  round_counts = [1, 20]
+  indexes = ["off"]
+  if aggregate.SLICE_INDEX_FILE:
+    indexes = ["on"]
+  repeat = 3
+  outfile = None
+  baseline = None
+  tolerance = 0.25
+  for (flag, val) in opts:
+    if flag == "--relays":
+      relay_counts = int_list(val)
+    elif flag == "--scanners":
+      scanner_counts = int_list(val)
+    elif flag == "--rounds":
+      round_counts = int_list(val)
+    elif flag == "--index":
+      indexes = val.split(",")
+    elif flag == "--repeat":
+      repeat = int(val)
+    elif flag == "--out":
+      outfile = val
+    elif flag == "--baseline":
+      baseline = json.load(file(val, "r"))
+    elif flag == "--tolerance":
+      tolerance = float(val)
+
+  TorUtil.loglevel = "WARN"
+  report = {"time": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "runs": []}
+  workdir = tempfile.mkdtemp(prefix="bench-aggregate-")
+  try:
+    for relays in relay_counts:
+      for scanners in scanner_counts:
+        for rounds in round_counts:
+          scenario = Scenario(workdir, relays, scanners, rounds)
+          for index in indexes:
+            scenario.reset_index()
+            if index == "on":
+              scenario.run(index)
+            best = {}
+            for i in xrange(repeat):
+              (times, files, nodes) = scenario.run(index)
+              for phase in PHASES:
+                best[phase] = min(best.get(phase, times[phase]),
+                                  times[phase])
+            report["runs"].append({"relays": relays, "scanners": scanners,
+                                   "rounds": rounds, "index": index,
+                                   "files": files, "nodes": nodes,
+                                   "phases": best,
+                                   "total": sum(best.itervalues())})
+            print "relays=%d scanners=%d rounds=%d index=%-3s" \
+                  " total %.3fs: %s" % \
+                  (relays, scanners, rounds, index, sum(best.itervalues()),
+                   " ".join("%s=%.3f" % (p, best[p]) for p in PHASES))
+          shutil.rmtree(scenario.datadir)
+  finally:
+    shutil.rmtree(workdir)
+
+  if outfile:
+    f = file(outfile, "w")
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.write("\n")
+    f.close()
+
+  if baseline:
+    regressions = compare(report, baseline, tolerance)
+    for (key, phase, was, now) in regressions:
+      print "REGRESSION relays=%d scanners=%d rounds=%d index=%s" \
+            " %s: %.3fs -> %.3fs" % (key+(phase, was, now))
+    if regressions:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Compare disk footprint and aggregate.py load time of text bws- slice
+# files against their compact bwr- copies. Run from this directory:
+#
+#   ./bench_bwrecords.py [relays] [scanners] [rounds]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+import aggregate
+import bwrecords
+import synthdata
+
+def convert(bws_file):
+  # Same as bwauthority_child.write_bw_records()
+  fp = file(bws_file, "r")
+  slicenum = int(fp.readline().split("=")[-1])
+  timestamp = float(fp.readline())
+  rows = [l.to_row() for l in aggregate.read_slice_lines(fp, slicenum,
+                                                         timestamp)]
+  fp.close()
+  bwrecords.write_records(bwrecords.records_name(bws_file), slicenum,
+                          timestamp, rows)
+
+def load(datadir):
+  bw_files = []
+  nodes = {}
+  t0 = time.time()
+  aggregate.find_slice_files([datadir], bw_files)
+  aggregate.load_slice_files(bw_files, nodes)
+  return (time.time()-t0, len(bw_files), nodes)
+
+def disk_usage(files):
+  return sum(os.path.getsize(f) for f in files)
+
+def main(argv):
+  relays = int(argv[1]) if len(argv) > 1 else 7000
+  scanners = int(argv[2]) if len(argv) > 2 else 9
+  rounds = int(argv[3]) if len(argv) > 3 else 20
+
+  datadir = tempfile.mkdtemp(prefix="bench-bwrecords-")
+  try:
+    rlist = synthdata.make_relays(relays)
+    text_files = synthdata.write_scan_tree(datadir, rlist, scanners, rounds)
+    (text_time, count, text_nodes) = load(datadir)
+    print "%-8s %8.3fs  files=%d nodes=%d size=%dKB" % \
+          ("text", text_time, count, len(text_nodes),
+           disk_usage(text_files)/1024)
+
+    for f in text_files:
+      convert(f)
+    rec_files = map(bwrecords.records_name, text_files)
+    (rec_time, count, rec_nodes) = load(datadir)
+    print "%-8s %8.3fs  files=%d nodes=%d size=%dKB" % \
+          ("records", rec_time, count, len(rec_nodes),
+           disk_usage(rec_files)/1024)
+
+    for (idhex, n) in text_nodes.iteritems():
+      r = rec_nodes[idhex]
+      if (n.nick, n.strm_bw, n.filt_bw, n.ns_bw, n.desc_bw, n.measured_at,
+          n.circ_fail_rate) != (r.nick, r.strm_bw, r.filt_bw, r.ns_bw,
+          r.desc_bw, r.measured_at, r.circ_fail_rate):
+        print "MISMATCH for "+idhex
+        sys.exit(1)
+  finally:
+    shutil.rmtree(datadir)
+
+if __name__ == "__main__":
+  main(sys.argv)
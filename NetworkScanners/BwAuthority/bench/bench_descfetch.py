@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Benchmark fetching the descriptors of unmeasured relays one GETINFO at
+# a time (TorCtl get_router()) against consensuscache.fetch_descriptors().
+# Run from this directory:
+#
+#   ./bench_descfetch.py [relays] [latency ms] [missing %] [batch size]
+
+import random
+import sys
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+from TorCtl import TorCtl
+import consensuscache
+from consensuscache import ConsensusSnapshot
+from fakecontrol import FakeControlPort
+import synthdata
+
+def connect(fake):
+  c = TorCtl.Connection(fake.connect())
+  c.authenticate("")
+  return c
+
+def one_by_one(c, ns_list):
+  routers = {}
+  for ns in ns_list:
+    try:
+      routers[ns.idhex] = c.get_router(ns)
+    except TorCtl.ErrorReply:
+      routers[ns.idhex] = None
+  return routers
+
+def summarize(routers):
+  return dict((idhex, r and (r.down, r.bw))
+                for (idhex, r) in routers.iteritems())
+
+def report(name, elapsed, commands, routers):
+  found = len(filter(None, routers.itervalues()))
+  print "%-20s %8.3fs  commands=%d found=%d/%d" % (name, elapsed, commands,
+                                                   found, len(routers))
+
+def main(argv):
+  relays = int(argv[1]) if len(argv) > 1 else 2000
+  latency = float(argv[2])/1000 if len(argv) > 2 else 0.002
+  missing = float(argv[3])/100 if len(argv) > 3 else 0.02
+  batch_size = int(argv[4]) if len(argv) > 4 else \
+                 consensuscache.DESC_BATCH_SIZE
+
+  rlist = synthdata.make_relays(relays)
+  published = time.time()-3600
+  descs = dict((r.idhex, synthdata.descriptor(r, published)) for r in rlist)
+  ns_list = ConsensusSnapshot(synthdata.consensus(rlist, descs)).ns_list
+
+  # Tor does not have every descriptor the consensus lists
+  rand = random.Random(0)
+  info = dict(("desc/id/"+idhex, d) for (idhex, d) in descs.iteritems()
+                if rand.random() >= missing)
+  fake = FakeControlPort(info, latency)
+  try:
+    c = connect(fake)
+    start = fake.commands
+    t0 = time.time()
+    single = one_by_one(c, ns_list)
+    report("get_router", time.time()-t0, fake.commands-start, single)
+
+    start = fake.commands
+    t0 = time.time()
+    batched = consensuscache.fetch_descriptors(c, ns_list, batch_size)
+    report("fetch_descriptors", time.time()-t0, fake.commands-start, batched)
+    c.close()
+
+    if summarize(single) != summarize(batched):
+      print "MISMATCH between single and batched results"
+      sys.exit(1)
+  finally:
+    fake.close()
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+# Kill a scanner child partway through a slice and check what its
+# restart loses and how long it takes, against a fake Tor and a local
+# bwfile server (fakenet.py). Run from this directory.
+
+"""
+Slice resume test
+
+Measures one slice with checkpoint_every set three times, each time in a
+bwauthority_child.py process of its own:
+
+  full     the whole slice, uninterrupted
+  killed   the same slice from scratch, SIGKILLed once FakeTor's recorded
+           event stream shows --kill-after streams closed with DONE
+  resumed  a restart of the killed run, which picks up its checkpoint
+           from the slice journal
+
+The report has the successful streams the killed run lost (closed
+before the kill, but not in its last checkpoint), and the time and
+fetches the restart took next to the full run. The test fails, with
+exit code 1, if:
+
+  the killed run wrote no checkpoint before the kill (raise --kill-after)
+  it lost --checkpoint-every + --fetch-slots streams or more
+  the restart took more fetches, or more time, than the rest of the
+    full slice after the checkpointed fetches, by more than --tolerance
+    of the full slice
+  the restart, with the kept checkpoint, measured fewer relays than the
+    full run, by more than --tolerance
+
+Usage:
+  ./bench_resume.py [--relays=N] [--nodes-per-slice=N] [--circs-per-node=N]
+                    [--checkpoint-every=N] [--kill-after=N]
+                    [--fetch-slots=N] [--fetch-loop] [--file-size=64k]
+                    [--rate-range=MIN:MAX] [--tolerance=0.25]
+                    [--out=report.json]
+"""
+
+import getopt
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+import bwauthority_child
+from bench_speedrace import CONFIG, fake_network, relay_rates, \
+                            announce_until, read_strm_bws
+from fakenet import BwFileServer, FakeTor
+from slicejournal import SliceJournal
+import synthdata
+
+def child(cfg, url, bwfiles):
+  # A scanner child measuring slice 0 from the fake network's bwfile host
+  bwauthority_child.urls = [url]
+  bwauthority_child.bw_file_list = bwauthority_child.BwFileList(bwfiles)
+  bwauthority_child.main(["bwauthority_child.py", cfg, "0"])
+
+def closed_streams(events):
+  return len([1 for (offset, event, body) in events
+                if event == "STREAM" and " CLOSED " in body and
+                   "REASON=DONE" in body])
+
+class Run:
+  """A scanner child with its own out_dir and slice journal"""
+  def __init__(self, opts, workdir, name, tor, server):
+    self.dir = workdir+"/"+name
+    self.out_dir = self.dir+"/scan-data"
+    tor_dir = self.dir+"/tor"
+    os.makedirs(tor_dir)
+    os.makedirs(self.out_dir)
+    f = file(tor_dir+"/control_auth_cookie", "w")
+    f.write(os.urandom(32))
+    f.close()
+    self.bwfiles = self.dir+"/bwfiles"
+    f = file(self.bwfiles, "w")
+    f.write("1000 %s\n.\n" % opts["file_size"])
+    f.close()
+    self.cfg = self.dir+"/bench.cfg"
+    f = file(self.cfg, "w")
+    f.write(CONFIG % {"loglevel": opts["loglevel"],
+                      "socks_port": tor.socks_port, "control_port": tor.port,
+                      "out_dir": os.path.relpath(self.out_dir),
+                      "tor_dir": tor_dir,
+                      "nodes_per_slice": opts["nodes_per_slice"],
+                      "circs_per_node": opts["circs_per_node"],
+                      "max_fetch_time": opts["max_fetch_time"],
+                      "fetch_slots": opts["fetch_slots"],
+                      "fetch_loop": opts["fetch_loop"]})
+    f.write("pid_file = %s/bwauthority.pid\n" % self.dir)
+    f.write("checkpoint_every = %d\n" % opts["checkpoint_every"])
+    f.close()
+    self.tor = tor
+    self.url = server.base_url()
+
+  def start(self):
+    self.mark = len(self.tor.recorded)
+    self.started = time.time()
+    self.proc = subprocess.Popen(["python", "bench_resume.py", "--child",
+                                  self.cfg, self.url, self.bwfiles])
+
+  def events(self):
+    return self.tor.recorded[self.mark:]
+
+  def wait(self):
+    self.proc.wait()
+    self.time = time.time()-self.started
+    self.fetches = closed_streams(self.events())
+    return self.proc.returncode
+
+  def kill_after(self, streams):
+    """SIGKILL the child once 'streams' streams closed with DONE. Returns
+    how many had when it was killed."""
+    while self.proc.poll() is None:
+      closed = closed_streams(self.events())
+      if closed >= streams:
+        os.kill(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+        self.time = time.time()-self.started
+        return closed
+      time.sleep(0.05)
+    raise Exception("The child exited with "+str(self.proc.returncode)+
+                    " before it was killed")
+
+def run(opts, workdir):
+  rlist = synthdata.make_relays(opts["relays"])
+  rates = relay_rates(rlist, *opts["rate_range"])
+  (relays, info) = fake_network(rlist, rates)
+  tor = FakeTor(relays, info, record=True)
+  server = BwFileServer()
+  done = threading.Event()
+  t = threading.Thread(target=announce_until, args=(tor, done))
+  t.setDaemon(True)
+  t.start()
+
+  full = Run(opts, workdir, "full", tor, server)
+  full.start()
+  full_ret = full.wait()
+
+  killed = Run(opts, workdir, "resume", tor, server)
+  killed.start()
+  closed_at_kill = killed.kill_after(opts["kill_after"])
+  killed_time = killed.time
+  (routers, checkpointed, attempt) = \
+      SliceJournal(killed.out_dir).interrupted_progress(0)
+
+  resumed = killed
+  resumed.start()
+  resumed_ret = resumed.wait()
+
+  done.set()
+  server.shutdown()
+  tor.close()
+
+  full_relays = set(read_strm_bws(full.out_dir))
+  resumed_relays = set(read_strm_bws(resumed.out_dir))
+  rest = max(0, full.fetches-checkpointed)
+  return {"options": opts,
+          "full": {"exit_code": full_ret, "time": full.time,
+                   "fetches": full.fetches, "relays": len(full_relays)},
+          "killed": {"time": killed_time, "closed_at_kill": closed_at_kill,
+                     "checkpointed_fetches": checkpointed,
+                     "checkpointed_relays": len(routers),
+                     "lost_fetches": closed_at_kill-checkpointed},
+          "resumed": {"exit_code": resumed_ret, "time": resumed.time,
+                      "fetches": resumed.fetches,
+                      "relays": len(resumed_relays),
+                      "expected_fetches": rest,
+                      "expected_time": full.time*rest/max(1, full.fetches)}}
+
+def check(report):
+  opts = report["options"]
+  (full, killed, resumed) = (report["full"], report["killed"],
+                             report["resumed"])
+  slack = opts["tolerance"]
+  failures = []
+  if full["exit_code"] != 0 or resumed["exit_code"] != 0:
+    failures.append("exit codes %d and %d, not 0" % (full["exit_code"],
+                                                     resumed["exit_code"]))
+  if not killed["checkpointed_fetches"]:
+    failures.append("no checkpoint before the kill")
+  if killed["lost_fetches"] >= opts["checkpoint_every"]+opts["fetch_slots"]:
+    failures.append("lost %d fetches" % killed["lost_fetches"])
+  if resumed["fetches"] > resumed["expected_fetches"]+slack*full["fetches"]:
+    failures.append("restart took %d fetches, expected %d" %
+                    (resumed["fetches"], resumed["expected_fetches"]))
+  if resumed["time"] > resumed["expected_time"]+slack*full["time"]:
+    failures.append("restart took %.1fs, expected %.1fs" %
+                    (resumed["time"], resumed["expected_time"]))
+  if resumed["relays"] < (1-slack)*full["relays"]:
+    failures.append("measured %d relays, the full run %d" %
+                    (resumed["relays"], full["relays"]))
+  return failures
+
+def usage():
+  print __doc__
+  sys.exit(1)
+
+def main(argv):
+  if len(argv) == 5 and argv[1] == "--child":
+    child(*argv[2:])
+    return
+  try:
+    (optlist, args) = getopt.getopt(argv[1:], "",
+                        ["relays=", "nodes-per-slice=", "circs-per-node=",
+                         "checkpoint-every=", "kill-after=", "fetch-slots=",
+                         "fetch-loop", "file-size=", "rate-range=",
+                         "max-fetch-time=", "tolerance=", "out=",
+                         "loglevel=", "help"])
+  except getopt.GetoptError, e:
+    print str(e)
+    usage()
+  opts = {"relays": 60, "nodes_per_slice": 30, "circs_per_node": 2,
+          "checkpoint_every": 5, "kill_after": 17, "fetch_slots": 1,
+          "fetch_loop": 0, "file_size": "64k",
+          "rate_range": (200.0, 2000.0), "max_fetch_time": 60,
+          "tolerance": 0.25, "loglevel": "NOTICE"}
+  out = None
+  for (o, a) in optlist:
+    if o == "--help":
+      usage()
+    elif o == "--fetch-loop":
+      opts["fetch_loop"] = 1
+    elif o == "--file-size":
+      opts["file_size"] = a
+    elif o == "--rate-range":
+      opts["rate_range"] = tuple(map(float, a.split(":")))
+    elif o == "--tolerance":
+      opts["tolerance"] = float(a)
+    elif o == "--loglevel":
+      opts["loglevel"] = a
+    elif o == "--out":
+      out = a
+    else:
+      opts[o[2:].replace("-", "_")] = int(a)
+
+  workdir = tempfile.mkdtemp(prefix="bench_resume")
+  try:
+    report = run(opts, workdir)
+  finally:
+    shutil.rmtree(workdir)
+
+  (full, killed, resumed) = (report["full"], report["killed"],
+                             report["resumed"])
+  print "full:    %.1fs, %d fetches, %d relays" % \
+        (full["time"], full["fetches"], full["relays"])
+  print "killed:  after %.1fs and %d fetches; checkpoint had %d fetches " \
+        "and %d relays, %d fetches lost" % \
+        (killed["time"], killed["closed_at_kill"],
+         killed["checkpointed_fetches"], killed["checkpointed_relays"],
+         killed["lost_fetches"])
+  print "resumed: %.1fs (expected %.1fs), %d fetches (expected %d), " \
+        "%d relays" % (resumed["time"], resumed["expected_time"],
+                       resumed["fetches"], resumed["expected_fetches"],
+                       resumed["relays"])
+  failures = check(report)
+  report["failures"] = failures
+  if out:
+    f = file(out, "w")
+    json.dump(report, f, indent=2)
+    f.close()
+  for f in failures:
+    print "FAIL: "+f
+  if failures:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Benchmark aggregate.py slice discovery+parsing with and without the
+# persistent SliceIndex. Run from this directory:
+#
+#   ./bench_sliceindex.py [relays] [scanners] [rounds]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+import aggregate
+from sliceindex import SliceIndex
+import synthdata
+
+def load(datadir, index_file):
+  bw_files = []
+  nodes = {}
+  t0 = time.time()
+  slice_index = None
+  if index_file:
+    slice_index = SliceIndex(index_file)
+  aggregate.find_slice_files([datadir], bw_files, slice_index)
+  aggregate.load_slice_files(bw_files, nodes, slice_index)
+  if slice_index:
+    slice_index.expire()
+    slice_index.close()
+  return (time.time()-t0, len(bw_files), len(nodes))
+
+def report(name, result):
+  print "%-28s %8.3fs  files=%d nodes=%d" % ((name,)+result)
+
+def main(argv):
+  relays = int(argv[1]) if len(argv) > 1 else 7000
+  scanners = int(argv[2]) if len(argv) > 2 else 9
+  rounds = int(argv[3]) if len(argv) > 3 else 20
+
+  datadir = tempfile.mkdtemp(prefix="bench-sliceindex-")
+  try:
+    rlist = synthdata.make_relays(relays)
+    synthdata.write_scan_tree(datadir, rlist, scanners, rounds)
+    index_file = datadir+"/slice-index.sqlite"
+
+    report("no index", load(datadir, None))
+    report("cold index", load(datadir, index_file))
+    report("warm index", load(datadir, index_file))
+
+    # One more hour of scanning: a handful of new slices per scanner
+    synthdata.write_scan_tree(datadir, rlist[:scanners*50], scanners, 1,
+                              seed=1, start=time.time()-3600)
+    report("warm index + new slices", load(datadir, index_file))
+  finally:
+    shutil.rmtree(datadir)
+
+if __name__ == "__main__":
+  main(sys.argv)
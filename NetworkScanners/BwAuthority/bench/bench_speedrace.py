@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+#
+# Offline benchmark of bwauthority_child.py's slice measurement against a
+# fake Tor and a local bwfile server (fakenet.py). Run from this directory.
+
+"""
+Speedrace benchmark
+
+Starts a FakeTor whose relays each forward at a rate between the
+--rate-range bounds (KB/s, log-scaled by descriptor bandwidth), and a
+local BwFileServer. bwauthority_child.py is pointed at both and measures
+--slices slices with run_slice(), the same way a scanner does.
+
+The report has:
+
+  the slice times and successful fetches per second
+  the time spent in is_count_met(), write_sql_stats() and
+    write_strm_bws(), by call
+  how well the strm_bw of each measured relay follows its configured
+    rate: the median of strm_bw/rate and the Spearman rank correlation
+
+Every stream goes over two relays, so a relay's strm_bw is also held
+down by the slower relays it was paired with. The correlation is the
+figure to watch.
+
+With --standalone, TorCtl is not needed. The bench itself plays the
+scanner's part towards FakeTor over the control port: one two-hop
+circuit per fetch over the least used relays of the slice, until each
+was used --circs-per-node times; each stream attached by its source
+address, and a relay's strm_bw taken as the mean rate, first to last
+byte, of the fetches through it. The fetches run in a fetchloop.FetchLoop, --fetch-slots at
+a time. This measures the fetch engine and the fake network, not
+bwauthority_child.py's speedrace(), so no call times are reported.
+
+Usage:
+  ./bench_speedrace.py [--relays=N] [--nodes-per-slice=N] [--slices=N]
+                       [--circs-per-node=N] [--fetch-slots=N] [--fetch-loop]
+                       [--file-size=512k] [--rate-range=MIN:MAX]
+                       [--max-fetch-time=SECS] [--https=CERT:KEY]
+                       [--standalone] [--record=events.json]
+                       [--out=report.json]
+
+--record saves every control port event FakeTor sent, with its time.
+"""
+
+import getopt
+import json
+import math
+import os
+import Queue
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+try:
+  from TorCtl import TorUtil
+  import bwauthority_child
+except ImportError:
+  # Only --standalone runs without TorCtl
+  bwauthority_child = None
+import fetchloop
+from fakenet import BwFileServer, FakeRelay, FakeTor
+import synthdata
+
+CONFIG = """[TorCtl]
+loglevel = %(loglevel)s
+tor_host = 127.0.0.1
+tor_port = %(socks_port)d
+control_host = 127.0.0.1
+control_port = %(control_port)d
+control_pass =
+
+[BwAuthority]
+out_dir = %(out_dir)s
+pid_file =
+db_url =
+tor_dir = %(tor_dir)s
+start_pct = 0
+stop_pct = 100
+save_every = 0
+nodes_per_slice = %(nodes_per_slice)d
+circs_per_node = %(circs_per_node)d
+min_streams = 1
+max_fetch_time = %(max_fetch_time)d
+sleep_start = 01:30
+sleep_stop = 01:30
+only_unmeasured = 0
+min_unmeasured = 0
+fetch_slots = %(fetch_slots)d
+fetch_loop = %(fetch_loop)d
+"""
+
+def relay_rates(rlist, lo, hi):
+  # desc_bw is roughly log-normal, so spread the rates on a log scale
+  logs = [math.log(r.desc_bw) for r in rlist]
+  (lmin, lmax) = (min(logs), max(logs))
+  span = (lmax - lmin) or 1.0
+  return [int(1024*lo*math.pow(hi/lo, (l-lmin)/span)) for l in logs]
+
+def fake_network(rlist, rates):
+  now = time.time()
+  descs = {}
+  for r in rlist:
+    policy = "reject *:*"
+    if "Exit" in r.flags:
+      policy = "accept *:*"
+    descs[r.idhex] = synthdata.descriptor(r, now-3600, policy)
+  cons = synthdata.consensus(rlist, descs)
+  # GETINFO ns/all has only the router entries
+  ns = "\n".join(l for l in cons.split("\n") if l[:2] in ("r ", "s ", "w "))
+  info = {"ns/all": ns, "dir/status-vote/current/consensus": cons}
+  for (idhex, d) in descs.iteritems():
+    info["desc/id/"+idhex] = d
+  relays = [FakeRelay(r.idhex, r.nickname, rate)
+              for (r, rate) in zip(rlist, rates)]
+  return (relays, info)
+
+class CallTimer:
+  """Wraps a function and adds up the time spent in it"""
+  def __init__(self, func):
+    self.func = func
+    self.calls = 0
+    self.total = 0.0
+
+  def __call__(self, *args, **kwargs):
+    t0 = time.time()
+    try:
+      return self.func(*args, **kwargs)
+    finally:
+      self.calls += 1
+      self.total += time.time()-t0
+
+  def report(self):
+    return {"calls": self.calls, "total": self.total,
+            "per_call": self.calls and self.total/self.calls or 0.0}
+
+def read_strm_bws(out_dir):
+  strm_bws = {}
+  for name in os.listdir(out_dir):
+    if not name.startswith("bws-") or "-done-" not in name:
+      continue
+    for line in file(out_dir+"/"+name):
+      fields = dict(f.split("=", 1) for f in line.split() if "=" in f)
+      if "node_id" in fields:
+        strm_bws[fields["node_id"].lstrip("$")] = int(fields["strm_bw"])
+  return strm_bws
+
+def ranks(values):
+  order = sorted(xrange(len(values)), key=lambda i: values[i])
+  r = [0.0]*len(values)
+  for (rank, i) in enumerate(order):
+    r[i] = float(rank)
+  return r
+
+def spearman(xs, ys):
+  if len(xs) < 2:
+    return None
+  (rx, ry) = (ranks(xs), ranks(ys))
+  n = len(xs)
+  d2 = sum((a-b)**2 for (a, b) in zip(rx, ry))
+  return 1 - 6*d2/(n*(n*n-1))
+
+def median(values):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[len(values)/2]
+
+def accuracy(strm_bws, relays):
+  measured = [(strm_bws[r.idhex], r.rate) for r in relays
+                if r.idhex in strm_bws]
+  return {"measured_relays": len(measured),
+          "median_strm_bw_over_rate":
+              median([float(bw)/rate for (bw, rate) in measured]),
+          "spearman": spearman([bw for (bw, rate) in measured],
+                               [rate for (bw, rate) in measured])}
+
+def announce_until(tor, done):
+  # The scanner only starts once it has seen a NEWCONSENSUS
+  while not done.isSet():
+    tor.announce_consensus()
+    done.wait(5)
+
+class ControlClient:
+  """A control connection to FakeTor for --standalone. Events are handed
+  to on_event(event, body) from the reading thread."""
+  def __init__(self, tor, on_event):
+    self.sock = socket.create_connection((tor.host, tor.port))
+    self.on_event = on_event
+    self.replies = Queue.Queue()
+    self.thread = threading.Thread(target=self.read)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def command(self, line):
+    self.sock.sendall(line+"\r\n")
+    return self.replies.get()
+
+  def close(self):
+    # No more events once this returns
+    self.sock.shutdown(socket.SHUT_RDWR)
+    self.sock.close()
+    self.thread.join()
+
+  def read(self):
+    f = self.sock.makefile("rb")
+    try:
+      while True:
+        line = f.readline()
+        if not line:
+          break
+        line = line.rstrip("\r\n")
+        if line.startswith("650 "):
+          (event, _, body) = line[4:].partition(" ")
+          self.on_event(event, body)
+        elif line[3:4] == " ":
+          self.replies.put(line)
+    except socket.error:
+      pass
+
+class StandaloneSlice:
+  """Measures 'relays' the way --standalone describes, from 'loop'"""
+  def __init__(self, loop, ctl, proxy, relays, opts, url):
+    self.loop = loop
+    self.ctl = ctl
+    self.proxy = proxy
+    self.opts = opts
+    self.url = url
+    self.used = dict((r.idhex, 0) for r in relays)
+    self.running = 0
+    self.successful = 0
+    self.attempts = 0
+    self.circs = {}    # circ id -> path
+    self.by_addr = {}  # "ip:port" of a fetch's SOCKS connection -> circ id
+    self.strm_bws = {} # idhex -> rates of the fetches through it
+    self.rand = random.Random(0)
+
+  def next_path(self):
+    # Like ExactUniformGenerator: the least used relays first
+    if min(self.used.itervalues()) >= self.opts["circs_per_node"]:
+      return None
+    order = sorted(self.used.iterkeys(),
+                   key=lambda idhex: (self.used[idhex], self.rand.random()))
+    path = order[:2]
+    for idhex in path:
+      self.used[idhex] += 1
+    return path
+
+  def launch(self, path):
+    reply = self.ctl.command("EXTENDCIRCUIT 0 "+
+                             ",".join("$"+idhex for idhex in path))
+    if not reply.startswith("250 EXTENDED "):
+      return False
+    self.circs[int(reply.split()[2])] = path
+    self.running += 1
+    self.attempts += 1
+    return True
+
+  def event(self, event, body):
+    # From the loop, posted by the control connection's thread
+    words = body.split()
+    if event == "CIRC" and words[1] == "BUILT":
+      self.start_fetch(int(words[0]))
+    elif event == "STREAM" and words[1] == "NEW":
+      fields = dict(w.split("=", 1) for w in words[4:] if "=" in w)
+      circ_id = self.by_addr.pop(fields.get("SOURCE_ADDR"), None)
+      if circ_id is not None:
+        self.ctl.command("ATTACHSTREAM %s %d" % (words[0], circ_id))
+
+  def start_fetch(self, circ_id):
+    if circ_id not in self.circs:
+      return
+    try:
+      fetch = fetchloop.Fetch(self.loop, self.url, self.proxy,
+                              socket.socket, "bench_speedrace",
+                              self.fetch_done, redirected=self.redirected)
+    except socket.error:
+      self.circ_done(circ_id)
+      return
+    fetch.circ_id = circ_id
+    self.redirected(fetch)
+    fetch.timer = self.loop.call_later(self.opts["max_fetch_time"],
+                                       lambda: fetch.abort("Timed out"))
+
+  def redirected(self, fetch):
+    self.by_addr["%s:%d" % fetch.raw.getsockname()] = fetch.circ_id
+
+  def fetch_done(self, fetch):
+    self.loop.cancel(fetch.timer)
+    if fetch.ok:
+      self.successful += 1
+      # Timed at our end: events from FakeTor, in this same process, are
+      # read too late to time streams by
+      if fetch.last_byte_at > fetch.first_byte_at:
+        rate = fetch.read_len/(fetch.last_byte_at-fetch.first_byte_at)
+        for idhex in self.circs[fetch.circ_id]:
+          self.strm_bws.setdefault(idhex, []).append(rate)
+    self.circ_done(fetch.circ_id)
+
+  def circ_done(self, circ_id):
+    self.running -= 1
+    del self.circs[circ_id]
+    self.ctl.command("CLOSECIRCUIT %d" % circ_id)
+
+  def run(self):
+    while True:
+      while self.running < self.opts["fetch_slots"]:
+        path = self.next_path()
+        if not path or not self.launch(path):
+          break
+      if not self.running:
+        break
+      self.loop.run_once(1.0)
+
+def run_standalone(opts, relays, tor, server):
+  proxy = (tor.host, tor.socks_port)
+  url = server.base_url()+opts["file_size"]
+  loop = fetchloop.FetchLoop()
+  current = [None]
+  def on_event(event, body):
+    loop.call_from_thread(lambda: current[0].event(event, body))
+  ctl = ControlClient(tor, on_event)
+  ctl.command("AUTHENTICATE")
+  ctl.command("SETEVENTS STREAM CIRC")
+
+  slices = []
+  strm_bws = {}
+  fetches = {"successful": 0, "attempts": 0}
+  per_slice = opts["nodes_per_slice"]
+  for slice_num in xrange(opts["slices"]):
+    slice_relays = relays[slice_num*per_slice:(slice_num+1)*per_slice]
+    if len(slice_relays) < 2:
+      break
+    current[0] = StandaloneSlice(loop, ctl, proxy, slice_relays, opts, url)
+    t0 = time.time()
+    current[0].run()
+    elapsed = time.time()-t0
+    successful = current[0].successful
+    fetches["successful"] += successful
+    fetches["attempts"] += current[0].attempts
+    for (idhex, bws) in current[0].strm_bws.iteritems():
+      strm_bws[idhex] = int(sum(bws)/len(bws))
+    slices.append({"slice": slice_num, "exit_code": 0, "time": elapsed,
+                   "successful": successful,
+                   "fetches_per_sec": successful/elapsed})
+  ctl.close()
+  loop.close()
+  return {"options": opts, "setup_time": 0.0, "slices": slices,
+          "fetches": fetches, "files_served": server.served,
+          "control_commands": tor.commands, "calls": {},
+          "accuracy": accuracy(strm_bws, relays)}
+
+def run_scanner(opts, workdir, relays, tor, server):
+  tor_dir = workdir+"/tor"
+  out_dir = workdir+"/scan-data"
+  os.makedirs(tor_dir)
+  os.makedirs(out_dir)
+  f = file(tor_dir+"/control_auth_cookie", "w")
+  f.write(os.urandom(32))
+  f.close()
+  f = file(workdir+"/bwfiles", "w")
+  f.write("1000 %s\n.\n" % opts["file_size"])
+  f.close()
+  cfg = workdir+"/bench.cfg"
+  f = file(cfg, "w")
+  f.write(CONFIG % {"loglevel": opts["loglevel"],
+                    "socks_port": tor.socks_port, "control_port": tor.port,
+                    # speedrace() puts out_dir under the current directory
+                    "out_dir": os.path.relpath(out_dir), "tor_dir": tor_dir,
+                    "nodes_per_slice": opts["nodes_per_slice"],
+                    "circs_per_node": opts["circs_per_node"],
+                    "max_fetch_time": opts["max_fetch_time"],
+                    "fetch_slots": opts["fetch_slots"],
+                    "fetch_loop": opts["fetch_loop"]})
+  f.close()
+
+  TorUtil.read_config(cfg)
+  conf = bwauthority_child.read_config(cfg)
+  bwauthority_child.urls = [server.base_url()]
+  bwauthority_child.bw_file_list = \
+      bwauthority_child.BwFileList(workdir+"/bwfiles")
+
+  fetches = {"successful": 0, "attempts": 0}
+  account_fetch = bwauthority_child.account_fetch
+  def counted(*args, **kwargs):
+    ret = account_fetch(*args, **kwargs)
+    fetches["attempts"] += 1
+    fetches["successful"] += ret
+    return ret
+  bwauthority_child.account_fetch = counted
+
+  t0 = time.time()
+  (c, hdlr, sql_file) = bwauthority_child.setup_scanner(conf)
+  done = threading.Event()
+  t = threading.Thread(target=announce_until, args=(tor, done))
+  t.setDaemon(True)
+  t.start()
+  bwauthority_child.wait_for_consensus(c, hdlr)
+  done.set()
+  setup_time = time.time()-t0
+
+  timers = {}
+  for name in ("is_count_met", "write_sql_stats", "write_strm_bws"):
+    timers[name] = CallTimer(getattr(hdlr, name))
+    setattr(hdlr, name, timers[name])
+
+  slices = []
+  for slice_num in xrange(opts["slices"]):
+    before = fetches["successful"]
+    t0 = time.time()
+    ret = bwauthority_child.run_slice(hdlr, conf, slice_num, sql_file)
+    elapsed = time.time()-t0
+    if ret == bwauthority_child.STOP_PCT_REACHED:
+      break
+    if ret == 0:
+      hdlr.reset_stats()
+    successful = fetches["successful"]-before
+    slices.append({"slice": slice_num, "exit_code": ret, "time": elapsed,
+                   "successful": successful,
+                   "fetches_per_sec": successful/elapsed})
+  c.close()
+
+  return {"options": opts, "setup_time": setup_time, "slices": slices,
+          "fetches": fetches, "files_served": server.served,
+          "control_commands": tor.commands,
+          "calls": dict((n, t.report()) for (n, t) in timers.iteritems()),
+          "accuracy": accuracy(read_strm_bws(out_dir), relays)}
+
+def run(opts, workdir):
+  rlist = synthdata.make_relays(opts["relays"])
+  rates = relay_rates(rlist, *opts["rate_range"])
+  (relays, info) = fake_network(rlist, rates)
+  tor = FakeTor(relays, info, record=bool(opts["record"]))
+  if opts["https"]:
+    server = BwFileServer(*opts["https"])
+  else:
+    server = BwFileServer()
+  if opts["standalone"]:
+    report = run_standalone(opts, relays, tor, server)
+  else:
+    report = run_scanner(opts, workdir, relays, tor, server)
+  server.shutdown()
+  tor.close()
+  if opts["record"]:
+    f = file(opts["record"], "w")
+    json.dump(tor.recorded, f)
+    f.close()
+  return report
+
+def usage():
+  print __doc__
+  sys.exit(1)
+
+def main(argv):
+  try:
+    (optlist, args) = getopt.getopt(argv[1:], "",
+                        ["relays=", "nodes-per-slice=", "slices=",
+                         "circs-per-node=", "fetch-slots=", "fetch-loop",
+                         "file-size=", "rate-range=", "max-fetch-time=",
+                         "https=", "standalone", "record=", "out=",
+                         "loglevel=", "help"])
+  except getopt.GetoptError, e:
+    print str(e)
+    usage()
+  opts = {"relays": 100, "nodes_per_slice": 20, "slices": 1,
+          "circs_per_node": 2, "fetch_slots": 1, "fetch_loop": 0,
+          "file_size": "256k", "rate_range": (50.0, 2000.0),
+          "max_fetch_time": 60, "https": None, "standalone": False,
+          "record": None, "loglevel": "NOTICE"}
+  out = None
+  for (o, a) in optlist:
+    if o == "--help":
+      usage()
+    elif o == "--fetch-loop":
+      opts["fetch_loop"] = 1
+    elif o == "--standalone":
+      opts["standalone"] = True
+    elif o == "--file-size":
+      opts["file_size"] = a
+    elif o == "--rate-range":
+      opts["rate_range"] = tuple(map(float, a.split(":")))
+    elif o == "--https":
+      opts["https"] = tuple(a.split(":"))
+    elif o == "--record":
+      opts["record"] = a
+    elif o == "--loglevel":
+      opts["loglevel"] = a
+    elif o == "--out":
+      out = a
+    else:
+      opts[o[2:].replace("-", "_")] = int(a)
+
+  workdir = tempfile.mkdtemp(prefix="bench_speedrace")
+  try:
+    report = run(opts, workdir)
+  finally:
+    shutil.rmtree(workdir)
+
+  for s in report["slices"]:
+    print "slice %d: %.1fs, %d successful fetches, %.2f fetches/s" % \
+          (s["slice"], s["time"], s["successful"], s["fetches_per_sec"])
+  for (name, t) in sorted(report["calls"].iteritems()):
+    print "%-16s %4d calls %8.3fs total %8.4fs/call" % \
+          (name, t["calls"], t["total"], t["per_call"])
+  acc = report["accuracy"]
+  print "measured %d relays: median strm_bw/rate %s, spearman %s" % \
+        (acc["measured_relays"], acc["median_strm_bw_over_rate"],
+         acc["spearman"])
+  if out:
+    f = file(out, "w")
+    json.dump(report, f, indent=2)
+    f.close()
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Benchmark SQLSupport stream inserts and bws export, row by row against
+# sqlbulk.py, and check that both exports write the same bws lines for
+# the filters bwauthority_child.py uses. Exits with 1 if they differ.
+# Run from this directory:
+#
+#   ./bench_sqlexport.py [routers] [streams] [batch size] [db file]
+
+import difflib
+import os
+import random
+import StringIO
+import sqlalchemy
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+from TorCtl import SQLSupport
+import sqlbulk
+import synthdata
+
+class InsertListener:
+  # Does to the session what SQLSupport.StreamListener does for a closed
+  # stream: add a row, commit, and drop the session
+  def __init__(self, rand):
+    self.rand = rand
+
+  def listen(self, strm_id):
+    start = time.time() - self.rand.uniform(1, 60)
+    read = self.rand.randint(64*1024, 4*1024*1024)
+    s = SQLSupport.ClosedStream(strm_id=strm_id, tgt_host="127.0.0.1",
+                                tgt_port=443, start_time=start,
+                                end_time=time.time(), tot_read_bytes=read,
+                                tot_write_bytes=200,
+                                read_bandwidth=read/(time.time()-start),
+                                write_bandwidth=0.0, init_status="NEW",
+                                close_reason="DONE")
+    SQLSupport.tc_session.add(s)
+    SQLSupport.tc_session.commit()
+    SQLSupport.tc_session.remove()
+
+def fill_routers(rlist, rand):
+  for r in rlist:
+    router = SQLSupport.Router(idhex=r.idhex, nickname=r.nickname,
+                               bw=r.desc_bw)
+    sbw = r.desc_bw*rand.uniform(0.2, 2.0)
+    SQLSupport.tc_session.add(router)
+    SQLSupport.tc_session.add(SQLSupport.RouterStats(router=router,
+                                sbw=sbw, filt_sbw=sbw*rand.uniform(1, 1.3),
+                                circ_to_rate=rand.uniform(0, 0.1),
+                                avg_desc_bw=float(r.desc_bw),
+                                avg_bw=float(r.ns_bw*1000),
+                                strm_closed=rand.randint(0, 10)))
+  SQLSupport.tc_session.commit()
+  SQLSupport.tc_session.remove()
+
+def timed(name, func):
+  t0 = time.time()
+  ret = func()
+  print "%-18s %8.3fs" % (name, time.time()-t0)
+  return ret
+
+def export_orm(stats_filter):
+  f = StringIO.StringIO()
+  SQLSupport.RouterStats.write_bws(f, 0, 100,
+                                   order_by=SQLSupport.RouterStats.sbw,
+                                   recompute=False, disp_clause=stats_filter)
+  return f.getvalue()
+
+def export_bulk(stats_filter):
+  f = StringIO.StringIO()
+  sqlbulk.write_bws(f, stats_filter)
+  return f.getvalue()
+
+def export_diff(stats_filter):
+  """The lines export_bulk() writes differently than export_orm(), as a
+  unified diff"""
+  # The first line is the time of writing
+  orm = export_orm(stats_filter).split("\n")[1:]
+  bulk = export_bulk(stats_filter).split("\n")[1:]
+  return list(difflib.unified_diff(orm, bulk, "export_orm", "export_bulk",
+                                   lineterm=""))
+
+def main(argv):
+  routers = int(argv[1]) if len(argv) > 1 else 2000
+  streams = int(argv[2]) if len(argv) > 2 else 5000
+  batch = int(argv[3]) if len(argv) > 3 else sqlbulk.BATCH_EVENTS
+  if len(argv) > 4:
+    db_file = argv[4]
+  else:
+    (fd, db_file) = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+
+  rand = random.Random(0)
+  SQLSupport.setup_db("sqlite:///"+db_file, echo=False, drop=True)
+  fill_routers(synthdata.make_relays(routers), rand)
+  print "%d routers, %d streams, %d events per batch" % (routers, streams,
+                                                          batch)
+
+  listener = InsertListener(rand)
+  timed("inserts_per_event",
+        lambda: [listener.listen(i) for i in xrange(streams)])
+  batched = sqlbulk.BatchedListener(listener, batch)
+  def insert_batched():
+    for i in xrange(streams):
+      batched.listen(streams+i)
+    batched.flush()
+  timed("inserts_batched", insert_batched)
+
+  stats_filter = SQLSupport.RouterStats.strm_closed >= 1
+  timed("export_orm", lambda: export_orm(stats_filter))
+  timed("export_bulk", lambda: export_bulk(stats_filter))
+
+  # The filters of speedrace()'s checkpoints and of its final bws file
+  filters = [("strm_closed >= 1", stats_filter),
+             ("final, min_streams 3",
+              sqlalchemy.and_(SQLSupport.RouterStats.strm_closed >= 3,
+                              SQLSupport.RouterStats.filt_sbw >= 0,
+                              SQLSupport.RouterStats.sbw >= 0))]
+  differ = False
+  for (name, f) in filters:
+    diff = export_diff(f)
+    if diff:
+      differ = True
+      print "export_bulk differs from export_orm for %s:" % name
+      print "\n".join(diff[:40])
+    else:
+      print "%-18s same lines" % name
+
+  # What write_sql_stats() does when a slice finishes
+  timed("finalization",
+        lambda: SQLSupport.RouterStats.write_stats(StringIO.StringIO(), 0, 100,
+                               order_by=SQLSupport.RouterStats.sbw,
+                               recompute=True))
+  if len(argv) <= 4:
+    os.remove(db_file)
+  if differ:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv)
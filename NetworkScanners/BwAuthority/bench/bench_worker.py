@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Per-slice turnaround of bwauthority.py's two child modes, against a
+# fake Tor (fakenet.py). Run from this directory.
+
+"""
+Slice worker benchmark
+
+Runs --slices slices in each of bwauthority.py's child modes:
+
+  spawn   one "bwauthority_child.py <cfg> <slice>" process per slice, as
+          bwauthority.py does by default
+  worker  one bwauthority.SliceWorker ("--worker") for all slices, as with
+          persistent_worker = 1
+
+The slices are empty: start_pct is above stop_pct, so run_slice() returns
+STOP_PCT_REACHED right after the slice setup. A slice's turnaround, from
+asking for it to having its exit code, is then only what each mode pays
+per slice: interpreter start, imports, the control connection, the SQL
+setup and the consensus for a spawned child; the event reset, consensus
+and reset_stats() for the worker. The fetches of a real slice cost the
+same in both modes.
+
+FakeTor announces a consensus every --announce-every seconds, which both
+modes wait for before each slice.
+
+Usage:
+  ./bench_worker.py [--relays=N] [--slices=N] [--announce-every=SECS]
+                    [--modes=spawn,worker] [--out=report.json]
+"""
+
+import getopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+sys.path.append("../../../")
+import bwauthority
+from bench_speedrace import CONFIG, fake_network, relay_rates, median
+from fakenet import FakeTor
+import synthdata
+
+# bwauthority.py starts the child by its relative name from here
+CHILD_DIR = os.path.abspath("..")
+
+def announce_every(tor, secs, done):
+  while not done.isSet():
+    tor.announce_consensus()
+    done.wait(secs)
+
+def write_config(opts, workdir, tor):
+  tor_dir = workdir+"/tor"
+  out_dir = workdir+"/scan-data"
+  os.makedirs(tor_dir)
+  os.makedirs(out_dir)
+  f = file(tor_dir+"/control_auth_cookie", "w")
+  f.write(os.urandom(32))
+  f.close()
+  cfg = workdir+"/bench.cfg"
+  f = file(cfg, "w")
+  f.write(CONFIG % {"loglevel": opts["loglevel"],
+                    "socks_port": tor.socks_port, "control_port": tor.port,
+                    "out_dir": os.path.relpath(out_dir, CHILD_DIR),
+                    "tor_dir": tor_dir, "nodes_per_slice": 50,
+                    "circs_per_node": 1, "max_fetch_time": 60,
+                    "fetch_slots": 1, "fetch_loop": 0})
+  # The child's main() only runs with a pid file. Empty slices (see above).
+  f.write("pid_file = %s/bwauthority.pid\n" % workdir)
+  f.write("start_pct = 1\nstop_pct = 0\n")
+  f.close()
+  return cfg
+
+def run_spawn(cfg, slices):
+  times = []
+  for slice_num in xrange(slices):
+    t0 = time.time()
+    p = subprocess.Popen(["python", "bwauthority_child.py", cfg,
+                          str(slice_num)], cwd=CHILD_DIR)
+    p.wait()
+    times.append((slice_num, p.returncode, time.time()-t0))
+  return times
+
+def run_worker(cfg, slices):
+  times = []
+  cwd = os.getcwd()
+  os.chdir(CHILD_DIR)
+  try:
+    t0 = time.time()
+    worker = bwauthority.SliceWorker(cfg)
+    for slice_num in xrange(slices):
+      ret = worker.run_slice(slice_num)
+      times.append((slice_num, ret, time.time()-t0))
+      t0 = time.time()
+    worker.stop()
+  finally:
+    os.chdir(cwd)
+  return times
+
+def summarize(times):
+  turnaround = [t for (slice_num, ret, t) in times]
+  return {"slices": [{"slice": s, "exit_code": r, "time": t}
+                       for (s, r, t) in times],
+          "total": sum(turnaround),
+          "first": turnaround and turnaround[0] or None,
+          "median": median(turnaround),
+          "median_after_first": median(turnaround[1:])}
+
+def run(opts, workdir):
+  rlist = synthdata.make_relays(opts["relays"])
+  (relays, info) = fake_network(rlist, relay_rates(rlist, 50.0, 2000.0))
+  tor = FakeTor(relays, info)
+  done = threading.Event()
+  t = threading.Thread(target=announce_every,
+                       args=(tor, opts["announce_every"], done))
+  t.setDaemon(True)
+  t.start()
+
+  report = {"options": opts, "modes": {}}
+  for mode in opts["modes"]:
+    modedir = workdir+"/"+mode
+    os.makedirs(modedir)
+    cfg = write_config(opts, modedir, tor)
+    if mode == "spawn":
+      times = run_spawn(cfg, opts["slices"])
+    else:
+      times = run_worker(cfg, opts["slices"])
+    report["modes"][mode] = summarize(times)
+  done.set()
+  tor.close()
+  return report
+
+def usage():
+  print __doc__
+  sys.exit(1)
+
+def main(argv):
+  try:
+    (optlist, args) = getopt.getopt(argv[1:], "",
+                        ["relays=", "slices=", "announce-every=", "modes=",
+                         "out=", "loglevel=", "help"])
+  except getopt.GetoptError, e:
+    print str(e)
+    usage()
+  opts = {"relays": 500, "slices": 10, "announce_every": 0.5,
+          "modes": ["spawn", "worker"], "loglevel": "NOTICE"}
+  out = None
+  for (o, a) in optlist:
+    if o == "--help":
+      usage()
+    elif o == "--announce-every":
+      opts["announce_every"] = float(a)
+    elif o == "--modes":
+      opts["modes"] = a.split(",")
+    elif o == "--loglevel":
+      opts["loglevel"] = a
+    elif o == "--out":
+      out = a
+    else:
+      opts[o[2:].replace("-", "_")] = int(a)
+
+  workdir = tempfile.mkdtemp(prefix="bench_worker")
+  try:
+    report = run(opts, workdir)
+  finally:
+    shutil.rmtree(workdir)
+
+  for (mode, r) in sorted(report["modes"].iteritems()):
+    after = "-"
+    if r["median_after_first"] is not None:
+      after = "%.2fs" % r["median_after_first"]
+    print "%-6s %d slices in %.1fs: first %.2fs, median %.2fs, " \
+          "median after the first %s" % (mode, len(r["slices"]), r["total"],
+                                          r["first"], r["median"], after)
+    codes = set(s["exit_code"] for s in r["slices"])
+    if codes != set([bwauthority.STOP_PCT_REACHED]):
+      print "%-6s unexpected exit codes: %s" % (mode, sorted(codes))
+  if len(report["modes"]) == 2:
+    (spawn, worker) = (report["modes"]["spawn"], report["modes"]["worker"])
+    print "spawning costs %.2fs per slice" % \
+          ((spawn["total"]-worker["total"])/opts["slices"])
+  if out:
+    f = file(out, "w")
+    json.dump(report, f, indent=2)
+    f.close()
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Minimal scripted Tor control port for the BwAuthority benchmarks
+
+"""
+FakeControlPort
+
+Listens on a local TCP port and answers just enough of the Tor control
+protocol for TorCtl.Connection: PROTOCOLINFO, AUTHENTICATE, SETEVENTS and
+GETINFO of any number of keys from a fixed {key: value} dict. Every
+command is delayed by 'latency' seconds before it is answered, to stand
+in for a busy Tor process, so the cost of extra round trips shows up.
+"""
+
+import socket
+import threading
+import time
+
+class FakeControlPort:
+  def __init__(self, info, latency=0.0, host="127.0.0.1", port=0):
+    self.info = info
+    self.latency = latency
+    self.commands = 0
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind((host, port))
+    self.listener.listen(5)
+    self.host, self.port = self.listener.getsockname()
+    self.thread = threading.Thread(target=self._accept)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def connect(self):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((self.host, self.port))
+    return s
+
+  def close(self):
+    self.listener.close()
+
+  def _accept(self):
+    while True:
+      try:
+        (s, addr) = self.listener.accept()
+      except socket.error:
+        return
+      t = threading.Thread(target=self._serve, args=(s,))
+      t.setDaemon(True)
+      t.start()
+
+  def _serve(self, s):
+    f = s.makefile("rb")
+    try:
+      while True:
+        line = f.readline()
+        if not line:
+          break
+        words = line.strip().split(" ")
+        self.commands += 1
+        if self.latency:
+          time.sleep(self.latency)
+        s.sendall(self._reply(words[0].upper(), words[1:]))
+        if words[0].upper() == "QUIT":
+          break
+    except socket.error:
+      pass
+    f.close()
+    s.close()
+
+  def _reply(self, cmd, args):
+    if cmd == "PROTOCOLINFO":
+      return "250-PROTOCOLINFO 1\r\n" \
+             "250-AUTH METHODS=NULL\r\n" \
+             "250-VERSION Tor=\"0.2.2.35\"\r\n" \
+             "250 OK\r\n"
+    elif cmd in ("AUTHENTICATE", "SETEVENTS", "QUIT"):
+      return "250 OK\r\n"
+    elif cmd == "GETINFO":
+      for k in args:
+        if k not in self.info:
+          return "552 Unrecognized key \""+k+"\"\r\n"
+      out = []
+      for k in args:
+        v = self.info[k]
+        if "\n" in v:
+          body = "\r\n".join(("."+l) if l.startswith(".") else l
+                               for l in v.split("\n"))
+          out.append("250+"+k+"=\r\n"+body+"\r\n.\r\n")
+        else:
+          out.append("250-"+k+"="+v+"\r\n")
+      out.append("250 OK\r\n")
+      return "".join(out)
+    return "510 Unrecognized command \""+cmd+"\"\r\n"
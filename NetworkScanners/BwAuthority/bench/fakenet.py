@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+#
+# Local stand-ins for Tor and the bwfile hosts, so bwauthority_child.py
+# can be benchmarked offline.
+
+"""
+Fakenet
+
+BwFileServer serves /<size> (e.g. /512k, /16M or /123456) over HTTP, or
+HTTPS with a given certificate. The body is streamed from a fixed buffer
+of zeros.
+
+FakeTor is a FakeControlPort plus a SOCKS5 port. It knows a set of
+relays, each with a rate in bytes/sec, and plays Tor's part towards
+TorCtl's PathBuilder:
+
+  - A SOCKS connection becomes a stream and is announced with a STREAM
+    NEW event, including SOURCE_ADDR. The stream waits for ATTACHSTREAM.
+  - EXTENDCIRCUIT builds a circuit over the named relays. It sends
+    LAUNCHED, EXTENDED and BUILT events one hop delay apart.
+  - Once attached, the stream connects to its target. Data is relayed
+    through a token bucket for every relay on the circuit, so a relay's
+    rate is shared by all streams through it. STREAM_BW events report
+    the bytes, and the stream ends with STREAM CLOSED.
+  - CLOSESTREAM and CLOSECIRCUIT cut streams short with the given
+    reason.
+  - A BW event is sent every second, and NEWCONSENSUS can be sent on
+    demand.
+
+All emitted events can be recorded with their times, for a bench to
+check what a scanner did (bench_resume.py).
+"""
+
+import BaseHTTPServer
+import SocketServer
+import re
+import socket
+import ssl
+import struct
+import threading
+import time
+
+from fakecontrol import FakeControlPort
+
+CHUNK = 16384
+
+# Tor's stream end reasons, by the number CLOSESTREAM takes
+STREAM_REASONS = {1: "MISC", 2: "RESOLVEFAILED", 3: "CONNECTREFUSED",
+                  4: "EXITPOLICY", 5: "DESTROY", 6: "DONE", 7: "TIMEOUT",
+                  8: "NOROUTE", 9: "HIBERNATING", 10: "INTERNAL",
+                  11: "RESOURCELIMIT", 12: "CONNRESET", 13: "TORPROTOCOL",
+                  14: "NOTDIRECTORY"}
+
+def parse_size(name):
+  m = re.match(r"^(\d+)([kM]?)$", name)
+  if not m:
+    return None
+  return int(m.group(1))*{"": 1, "k": 1024, "M": 1024*1024}[m.group(2)]
+
+class _FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  zeros = "\0"*CHUNK
+
+  def do_GET(self):
+    size = parse_size(self.path.strip("/"))
+    if size is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header("Content-Length", str(size))
+    self.end_headers()
+    try:
+      while size > 0:
+        n = min(size, CHUNK)
+        self.wfile.write(self.zeros[:n])
+        size -= n
+    except socket.error:
+      pass
+    self.server.served += 1
+
+  def log_message(self, *args):
+    pass
+
+class BwFileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, certfile=None, keyfile=None, host="127.0.0.1", port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), _FileHandler)
+    self.served = 0
+    self.scheme = "http"
+    if certfile:
+      self.socket = ssl.wrap_socket(self.socket, keyfile, certfile,
+                                    server_side=True)
+      self.scheme = "https"
+    self.host, self.port = self.server_address
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def base_url(self):
+    return "%s://%s:%d/" % (self.scheme, self.host, self.port)
+
+class TokenBucket:
+  """'rate' bytes/sec. Only a tenth of a second's worth (or one CHUNK) is
+  banked, so short fetches see the configured rate too."""
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.burst = max(CHUNK, self.rate/10)
+    self.tokens = 0.0
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def take(self, n):
+    while True:
+      self.lock.acquire()
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate)
+      self.last = now
+      if self.tokens >= n:
+        self.tokens -= n
+        self.lock.release()
+        return
+      wait = (n - self.tokens)/self.rate
+      self.lock.release()
+      time.sleep(wait)
+
+class FakeRelay:
+  def __init__(self, idhex, nickname, rate):
+    self.idhex = idhex
+    self.nickname = nickname
+    self.rate = rate
+    self.bucket = TokenBucket(rate)
+
+  def path_name(self):
+    return "$"+self.idhex+"~"+self.nickname
+
+class FakeCircuit:
+  def __init__(self, circ_id, path):
+    self.circ_id = circ_id
+    self.path = path
+    self.built = False
+    self.closed = False
+
+  def path_str(self):
+    return ",".join(r.path_name() for r in self.path)
+
+class FakeStream:
+  def __init__(self, strm_id, client, host, port):
+    self.strm_id = strm_id
+    self.client = client
+    self.host = host
+    self.port = port
+    self.circ = None
+    self.attached = threading.Event()
+    self.close_reason = None
+    self.read = 0
+    self.written = 0
+
+  def target(self):
+    return "%s:%d" % (self.host, self.port)
+
+class FakeTor(FakeControlPort):
+  def __init__(self, relays, info=None, latency=0.0, hop_delay=0.05,
+               attach_timeout=120, record=False):
+    """'relays' is a list of FakeRelay. 'info' are the static GETINFO
+    answers (ns/all, desc/id/..., ...)."""
+    FakeControlPort.__init__(self, info or {}, latency)
+    self.relays = dict((r.idhex, r) for r in relays)
+    self.hop_delay = hop_delay
+    self.attach_timeout = attach_timeout
+    self.recorded = None
+    if record:
+      self.recorded = []
+    self.started = time.time()
+    self.lock = threading.RLock()
+    self.controllers = [] # (socket, send lock, set of event names)
+    self.circuits = {}
+    self.streams = {}
+    self.next_circ = 1
+    self.next_strm = 1
+    self.total_read = 0
+    self.total_written = 0
+    self.running = True
+
+    self.socks = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socks.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socks.bind((self.host, 0))
+    self.socks.listen(50)
+    self.socks_port = self.socks.getsockname()[1]
+    for target in (self._accept_socks, self._bw_events):
+      t = threading.Thread(target=target)
+      t.setDaemon(True)
+      t.start()
+
+  def close(self):
+    self.running = False
+    FakeControlPort.close(self)
+    self.socks.close()
+
+  # Control port
+
+  def _serve(self, s):
+    ctl = (s, threading.Lock(), set())
+    self.lock.acquire()
+    self.controllers.append(ctl)
+    self.lock.release()
+    f = s.makefile("rb")
+    try:
+      while True:
+        line = f.readline()
+        if not line:
+          break
+        words = line.strip().split(" ")
+        self.commands += 1
+        if self.latency:
+          time.sleep(self.latency)
+        cmd = words[0].upper()
+        if cmd == "SETEVENTS":
+          ctl[2].clear()
+          ctl[2].update(w.upper() for w in words[1:] if w != "EXTENDED")
+        (reply, after) = self._command(cmd, words[1:])
+        ctl[1].acquire()
+        s.sendall(reply)
+        ctl[1].release()
+        # Events a command causes come after its reply, as with Tor
+        if after:
+          after()
+        if cmd == "QUIT":
+          break
+    except socket.error:
+      pass
+    self.lock.acquire()
+    self.controllers.remove(ctl)
+    self.lock.release()
+    f.close()
+    s.close()
+
+  def _command(self, cmd, args):
+    if cmd in ("SETCONF", "RESETCONF", "SIGNAL", "USEFEATURE",
+               "SETEVENTS", "MAPADDRESS", "SETCIRCUITPURPOSE"):
+      return ("250 OK\r\n", None)
+    if cmd == "GETCONF":
+      return ("".join("250-"+k+"\r\n" for k in args[:-1]) +
+              "250 "+(args and args[-1] or "")+"\r\n", None)
+    if cmd == "GETINFO":
+      dynamic = {"stream-status": "", "circuit-status": "",
+                 "version": "0.2.2.35"}
+      for (k, v) in dynamic.iteritems():
+        self.info.setdefault(k, v)
+    if cmd == "EXTENDCIRCUIT":
+      return self._extend(args)
+    if cmd == "ATTACHSTREAM":
+      return self._attach(int(args[0]), int(args[1]))
+    if cmd == "CLOSESTREAM":
+      reason = len(args) > 1 and int(args[1]) or 1
+      return ("250 OK\r\n",
+              lambda: self._close_stream(int(args[0]),
+                                         STREAM_REASONS.get(reason, "MISC")))
+    if cmd == "CLOSECIRCUIT":
+      return ("250 OK\r\n", lambda: self._close_circuit(int(args[0])))
+    return (self._reply(cmd, args), None)
+
+  def emit(self, event, body):
+    """Send "650 <event> <body>" to every controller that asked for it.
+    A multi-line body is sent as 650+."""
+    if "\n" in body:
+      lines = body.rstrip("\n").split("\n")
+      data = "650+"+event+"\r\n"+"\r\n".join(("."+l) if l.startswith(".")
+                                                else l for l in lines) + \
+             "\r\n.\r\n650 OK\r\n"
+    else:
+      data = "650 "+event+" "+body+"\r\n"
+    if self.recorded is not None:
+      self.recorded.append((time.time()-self.started, event, body))
+    self.lock.acquire()
+    controllers = list(self.controllers)
+    self.lock.release()
+    for (s, send_lock, events) in controllers:
+      if event not in events:
+        continue
+      send_lock.acquire()
+      try:
+        s.sendall(data)
+      except socket.error:
+        pass
+      send_lock.release()
+
+  def announce_consensus(self):
+    self.emit("NEWCONSENSUS", self.info.get("ns/all", ""))
+
+  def _bw_events(self):
+    last = (0, 0)
+    while self.running:
+      time.sleep(1)
+      now = (self.total_read, self.total_written)
+      self.emit("BW", "%d %d" % (now[0]-last[0], now[1]-last[1]))
+      last = now
+
+  # Circuits
+
+  def _extend(self, args):
+    if args[0] != "0" or len(args) < 2:
+      return ("552 Only new circuits are supported\r\n", None)
+    path = []
+    for name in args[1].split(","):
+      idhex = name.lstrip("$").split("~")[0].split("=")[0].upper()
+      if idhex not in self.relays:
+        return ("552 No such router \""+name+"\"\r\n", None)
+      path.append(self.relays[idhex])
+    self.lock.acquire()
+    circ = FakeCircuit(self.next_circ, path)
+    self.next_circ += 1
+    self.circuits[circ.circ_id] = circ
+    self.lock.release()
+    return ("250 EXTENDED "+str(circ.circ_id)+"\r\n",
+            lambda: self._build(circ))
+
+  def _build(self, circ):
+    def build():
+      self.emit("CIRC", "%d LAUNCHED" % circ.circ_id)
+      for i in xrange(1, len(circ.path)+1):
+        time.sleep(self.hop_delay)
+        if circ.closed:
+          return
+        hops = ",".join(r.path_name() for r in circ.path[:i])
+        if i < len(circ.path):
+          self.emit("CIRC", "%d EXTENDED %s" % (circ.circ_id, hops))
+      circ.built = True
+      self.emit("CIRC", "%d BUILT %s PURPOSE=GENERAL" % (circ.circ_id,
+                                                         circ.path_str()))
+    t = threading.Thread(target=build)
+    t.setDaemon(True)
+    t.start()
+
+  def _close_circuit(self, circ_id):
+    circ = self.circuits.pop(circ_id, None)
+    if not circ or circ.closed:
+      return
+    circ.closed = True
+    for strm in self.streams.values():
+      if strm.circ is circ:
+        self._close_stream(strm.strm_id, "DESTROY")
+    self.emit("CIRC", "%d CLOSED %s REASON=REQUESTED" % (circ_id,
+                                                          circ.path_str()))
+
+  # Streams
+
+  def _attach(self, strm_id, circ_id):
+    strm = self.streams.get(strm_id)
+    circ = self.circuits.get(circ_id)
+    if not strm:
+      return ("552 Unknown stream \""+str(strm_id)+"\"\r\n", None)
+    if not circ or not circ.built:
+      return ("551 Can't attach stream to non-open circuit\r\n", None)
+    strm.circ = circ
+    return ("250 OK\r\n", strm.attached.set)
+
+  def _close_stream(self, strm_id, reason):
+    strm = self.streams.get(strm_id)
+    if not strm or strm.close_reason:
+      return
+    strm.close_reason = reason
+    try:
+      strm.client.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+
+  def _accept_socks(self):
+    while self.running:
+      try:
+        (s, addr) = self.socks.accept()
+      except socket.error:
+        return
+      t = threading.Thread(target=self._socks_stream, args=(s, addr))
+      t.setDaemon(True)
+      t.start()
+
+  def _recv_exact(self, s, n):
+    data = ""
+    while len(data) < n:
+      more = s.recv(n-len(data))
+      if not more:
+        raise socket.error("SOCKS client went away")
+      data += more
+    return data
+
+  def _socks_stream(self, client, addr):
+    try:
+      (ver, nmethods) = struct.unpack("BB", self._recv_exact(client, 2))
+      self._recv_exact(client, nmethods)
+      client.sendall("\x05\x00")
+      (ver, cmd, rsv, atyp) = struct.unpack("BBBB",
+                                            self._recv_exact(client, 4))
+      if atyp == 1:
+        host = socket.inet_ntoa(self._recv_exact(client, 4))
+      elif atyp == 3:
+        host = self._recv_exact(client, ord(self._recv_exact(client, 1)))
+      else:
+        client.close()
+        return
+      port = struct.unpack(">H", self._recv_exact(client, 2))[0]
+    except socket.error:
+      client.close()
+      return
+
+    self.lock.acquire()
+    strm = FakeStream(self.next_strm, client, host, port)
+    self.next_strm += 1
+    self.streams[strm.strm_id] = strm
+    self.lock.release()
+    self.emit("STREAM", "%d NEW 0 %s SOURCE_ADDR=%s:%d PURPOSE=USER" %
+                        (strm.strm_id, strm.target(), addr[0], addr[1]))
+    try:
+      self._run_stream(strm)
+    finally:
+      self.lock.acquire()
+      del self.streams[strm.strm_id]
+      self.lock.release()
+      try:
+        # Also wakes up the _upload() thread
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+      except socket.error:
+        pass
+
+  def _run_stream(self, strm):
+    strm.attached.wait(self.attach_timeout)
+    if not strm.attached.isSet() or strm.close_reason:
+      # Tor answers SOCKS with "TTL expired" when it gives up
+      strm.client.sendall("\x05\x06\x00\x01"+"\0"*6)
+      self.emit("STREAM", "%d FAILED 0 %s REASON=%s" %
+                (strm.strm_id, strm.target(), strm.close_reason or "TIMEOUT"))
+      return
+    circ = strm.circ
+    self.emit("STREAM", "%d SENTCONNECT %d %s" % (strm.strm_id, circ.circ_id,
+                                                   strm.target()))
+    try:
+      server = socket.create_connection((strm.host, strm.port))
+    except socket.error:
+      strm.client.sendall("\x05\x05\x00\x01"+"\0"*6)
+      self.emit("STREAM", "%d FAILED %d %s REASON=CONNECTREFUSED" %
+                          (strm.strm_id, circ.circ_id, strm.target()))
+      return
+    self.emit("STREAM", "%d SUCCEEDED %d %s" % (strm.strm_id, circ.circ_id,
+                                                strm.target()))
+    strm.client.sendall("\x05\x00\x00\x01"+"\0"*6)
+
+    up = threading.Thread(target=self._upload, args=(strm, server))
+    up.setDaemon(True)
+    up.start()
+    last_event = time.time()
+    reported = (0, 0)
+    try:
+      while not strm.close_reason:
+        data = server.recv(CHUNK)
+        if not data:
+          break
+        for r in circ.path:
+          r.bucket.take(len(data))
+        strm.client.sendall(data)
+        strm.written += len(data)
+        self.total_written += len(data)
+        if time.time() - last_event >= 1:
+          reported = self._stream_bw(strm, reported)
+          last_event = time.time()
+    except socket.error:
+      pass
+    server.close()
+    self._stream_bw(strm, reported)
+    self.emit("STREAM", "%d CLOSED %d %s REASON=%s" %
+                        (strm.strm_id, circ.circ_id, strm.target(),
+                         strm.close_reason or "DONE"))
+
+  def _upload(self, strm, server):
+    try:
+      while True:
+        data = strm.client.recv(CHUNK)
+        if not data:
+          break
+        server.sendall(data)
+        strm.read += len(data)
+        self.total_read += len(data)
+    except socket.error:
+      pass
+
+  def _stream_bw(self, strm, reported):
+    # Same field order as Tor's control_event_stream_bandwidth(): bytes
+    # read from the application, then bytes written to it
+    (read, written) = (strm.read-reported[0], strm.written-reported[1])
+    if read or written:
+      self.emit("STREAM_BW", "%d %d %d" % (strm.strm_id, read, written))
+    return (strm.read, strm.written)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Synthetic bandwidth scanner output for the aggregate.py benchmarks
+
+"""
+Synthdata
+
+Generates scanner.N/scan-data/bws-*-done-* trees that look like what
+bwauthority_child.py leaves behind, so aggregate.py can be benchmarked
+offline at arbitrary relay counts, scanner counts and history depths.
+Also makes matching router descriptors and a consensus document for the
+same relays.
+"""
+
+import hashlib
+import os
+import random
+import time
+
+FLAG_CHOICES = [["Fast", "Running", "Valid"],
+                ["Fast", "Running", "Valid", "Guard"],
+                ["Fast", "Running", "Valid", "Exit"],
+                ["Fast", "Running", "Valid", "Guard", "Exit"]]
+
+class SynthRelay:
+  def __init__(self, rand, num):
+    self.idhex = "%040X" % rand.getrandbits(160)
+    self.nickname = "synth%d" % num
+    self.flags = rand.choice(FLAG_CHOICES)
+    # Roughly log-normal like the real network, in bytes/sec
+    self.desc_bw = int(min(rand.lognormvariate(12.5, 1.5), 100*1024*1024))
+    self.ns_bw = max(1, int(self.desc_bw*rand.uniform(0.5, 1.5)/1000))
+    self.ip = "10.%d.%d.%d" % (rand.randint(0, 255), rand.randint(0, 255),
+                               rand.randint(1, 254))
+
+def make_relays(count, seed=0):
+  rand = random.Random(seed)
+  relays = [SynthRelay(rand, i) for i in xrange(count)]
+  relays.sort(lambda x, y: cmp(y.desc_bw, x.desc_bw))
+  return relays
+
+def descriptor(r, published, policy="reject *:*"):
+  pub = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(published))
+  fp = " ".join(r.idhex[i:i+4] for i in xrange(0, 40, 4))
+  return "router %s %s 9001 0 0\n" \
+         "platform Tor 0.2.2.35 on Linux\n" \
+         "published %s\n" \
+         "fingerprint %s\n" \
+         "uptime 86400\n" \
+         "bandwidth %d %d %d\n" \
+         "%s\n" \
+         "router-signature\n" \
+         "-----BEGIN SIGNATURE-----\n" \
+         "c3ludGhldGlj\n" \
+         "-----END SIGNATURE-----" % (r.nickname, r.ip, pub, fp,
+                                      r.desc_bw*2, r.desc_bw*3, r.desc_bw,
+                                      policy)
+
+def descriptor_digest(desc):
+  # The orhash a consensus lists for 'desc', as TorCtl checks it
+  signed = desc[:desc.find("\nrouter-signature\n")+len("\nrouter-signature\n")]
+  return hashlib.sha1(signed).digest().encode("base64")[:-2]
+
+def consensus(relays, descs, valid_after=None, params="bwauthpid=1"):
+  """A consensus document listing 'relays', whose r lines point at the
+  descriptors in descs ({idhex: descriptor text})."""
+  if valid_after is None:
+    valid_after = int(time.time()/3600)*3600
+  fmt = lambda t: time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+  lines = ["network-status-version 3",
+           "vote-status consensus",
+           "consensus-method 11",
+           "valid-after "+fmt(valid_after),
+           "fresh-until "+fmt(valid_after+3600),
+           "valid-until "+fmt(valid_after+3*3600),
+           "known-flags Exit Fast Guard Running Valid",
+           "params "+params]
+  for r in relays:
+    idhash = r.idhex.decode("hex").encode("base64")[:-2]
+    lines.append("r %s %s %s %s %s 9001 0" % (r.nickname, idhash,
+                   descriptor_digest(descs[r.idhex]), fmt(valid_after-1800),
+                   r.ip))
+    lines.append("s "+" ".join(sorted(r.flags)))
+    lines.append("w Bandwidth=%d" % r.ns_bw)
+  lines.append("directory-footer")
+  lines.append("bandwidth-weights Wbd=0 Wbe=0 Wbg=4130 Wbm=10000 Wdb=10000"
+               " Web=10000 Wed=10000 Wee=10000 Weg=10000 Wem=10000"
+               " Wgb=10000 Wgd=0 Wgg=5870 Wgm=5870 Wmb=10000 Wmd=0"
+               " Wme=0 Wmg=4130 Wmm=10000")
+  return "\n".join(lines)+"\n"
+
+def slice_line(rand, r):
+  strm_bw = int(r.desc_bw*rand.uniform(0.2, 2.0))
+  filt_bw = int(strm_bw*rand.uniform(1.0, 1.3))
+  return "node_id=$%s nick=%s strm_bw=%d filt_bw=%d circ_fail_rate=%f" \
+         " desc_bw=%d ns_bw=%d\n" % (r.idhex, r.nickname, strm_bw, filt_bw,
+                                     rand.uniform(0, 0.1), r.desc_bw,
+                                     r.ns_bw*1000)
+
+def write_slice(path, rand, slice_num, timestamp, relays):
+  f = file(path, "w")
+  f.write("slicenum="+str(slice_num)+"\n")
+  f.write(str(timestamp)+"\n")
+  for r in relays:
+    f.write(slice_line(rand, r))
+  f.close()
+  os.utime(path, (timestamp, timestamp))
+
+def write_scan_tree(datadir, relays, scanners=9, rounds=1, seed=0,
+                    start=None, round_secs=6*60*60, nodes_per_slice=50):
+  """Write 'rounds' complete passes over 'relays', split across
+  'scanners' scanner dirs by percentile, under 'datadir'. Returns the
+  list of files written."""
+  rand = random.Random(seed)
+  if start is None:
+    start = time.time() - rounds*round_secs
+  written = []
+  per_scanner = (len(relays)+scanners-1)/scanners
+  for s in xrange(scanners):
+    sdir = datadir+"/scanner."+str(s+1)+"/scan-data"
+    if not os.path.isdir(sdir):
+      os.makedirs(sdir)
+    mine = relays[s*per_scanner:(s+1)*per_scanner]
+    for rnd in xrange(rounds):
+      for slice_num in xrange(0, len(mine), nodes_per_slice):
+        chunk = mine[slice_num:slice_num+nodes_per_slice]
+        ts = start + rnd*round_secs + rand.uniform(0, round_secs)
+        lo = 100.0*(s*per_scanner+slice_num)/len(relays)
+        hi = 100.0*(s*per_scanner+slice_num+len(chunk))/len(relays)
+        name = "bws-%s:%s-done-%s-%d" % (round(lo,1), round(hi,1),
+                  time.strftime("20%y-%m-%d-%H:%M:%S", time.gmtime(ts)),
+                  rnd)
+        write_slice(sdir+"/"+name, rand, slice_num/nodes_per_slice, ts,
+                    chunk)
+        written.append(sdir+"/"+name)
+  return written
+
+def write_votes(path, relays, timestamp, seed=0):
+  """A previous-round vote file (as aggregate.py writes them) for
+  'relays', so the PID controller has history to feed back from."""
+  rand = random.Random(seed)
+  f = file(path, "w")
+  f.write(str(int(timestamp))+"\n")
+  for r in relays:
+    pid_error = rand.uniform(-0.5, 0.5)
+    bw = max(1, int(r.ns_bw*(1+pid_error)))
+    f.write("node_id=$%s bw=%d nick=%s measured_at=%d updated_at=%d"
+            " pid_error=%s pid_error_sum=%s pid_bw=%d pid_delta=%s"
+            " circ_fail=0.0\n" % (r.idhex, bw, r.nickname,
+                                   int(timestamp)-3600, int(timestamp)-3600,
+                                   pid_error, pid_error*2, bw*1000,
+                                   pid_error/2))
+  f.close()
@@ -2,12 +2,16 @@
 from sys import argv as s_argv
 from sys import path
 from sys import exit
-from subprocess import Popen
+from subprocess import Popen, PIPE
+import ConfigParser
+import os
+import time
 path.append("../../")
 import TorCtl.TorUtil
 from TorCtl.TorUtil import plog as plog
 from TorCtl.TorUtil import get_git_version as get_git_version
 from signal import signal, SIGTERM, SIGKILL
+from slicejournal import SliceJournal
 
 
 # exit code to indicate scan completion
@@ -21,29 +25,112 @@ PATH_TO_TORCTL_REPO = '../../.git/modules/TorCtl/'
 
 p = None
 
+def read_worker_config(filename):
+  # persistent_worker = 1 keeps one bwauthority_child.py running for many
+  # slices instead of spawning one per slice. worker_max_slices > 0
+  # replaces that worker after so many slices.
+  config = ConfigParser.SafeConfigParser()
+  config.read(filename)
+  persistent = 0
+  max_slices = 0
+  if config.has_option('BwAuthority', 'persistent_worker'):
+    persistent = config.getint('BwAuthority', 'persistent_worker')
+  if config.has_option('BwAuthority', 'worker_max_slices'):
+    max_slices = config.getint('BwAuthority', 'worker_max_slices')
+  return (persistent, max_slices)
+
+class SliceWorker:
+  """A bwauthority_child.py --worker process. It is told which slice to
+  run over its stdin and reports each slice's exit code over a pipe."""
+  def __init__(self, config):
+    (r, w) = os.pipe()
+    self.proc = Popen(["python", "bwauthority_child.py", config,
+                       "--worker="+str(w)], stdin=PIPE)
+    os.close(w)
+    self.results = os.fdopen(r, "r")
+    self.slices = 0
+
+  def run_slice(self, slice_num):
+    """Returns the slice's exit code, or the worker's own exit code (or
+    -signal) if it died."""
+    try:
+      self.proc.stdin.write("slice %d\n" % slice_num)
+      self.proc.stdin.flush()
+      line = self.results.readline()
+    except IOError:
+      line = ""
+    if not line:
+      self.proc.wait()
+      self.results.close()
+      return self.proc.returncode
+    self.slices += 1
+    return int(line.split()[2])
+
+  def alive(self):
+    return self.proc.poll() is None
+
+  def stop(self):
+    try:
+      self.proc.stdin.write("quit\n")
+      self.proc.stdin.close()
+    except IOError:
+      pass
+    self.proc.wait()
+    self.results.close()
+
+  def kill(self):
+    self.proc.kill()
+
+def read_resume_slice(filename):
+  # With checkpoint_every set, the child keeps a slice journal in its
+  # out_dir. Carry on with the slice it was working on when we stopped.
+  config = ConfigParser.SafeConfigParser()
+  config.read(filename)
+  if not config.has_option('BwAuthority', 'checkpoint_every') or \
+     not config.getint('BwAuthority', 'checkpoint_every'):
+    return 0
+  return SliceJournal(config.get('BwAuthority', 'out_dir')).resume_slice()
+
 def main(argv):
   TorCtl.TorUtil.read_config(argv[1])
   (branch, head) = get_git_version(PATH_TO_TORFLOW_REPO)
   plog('NOTICE', 'TorFlow Version: %s' % branch+' '+head)
   (branch, head) = get_git_version(PATH_TO_TORCTL_REPO)
   plog('NOTICE', 'TorCtl Version: %s' % branch+' '+head)
-  slice_num = 0 
+  (persistent, max_slices) = read_worker_config(argv[1])
+  slice_num = read_resume_slice(argv[1])
+  if slice_num:
+    plog('NOTICE', 'Resuming at slice '+str(slice_num))
   while True:
     plog('INFO', 'Beginning time loop')
     global p
-    p = Popen(["python", "bwauthority_child.py", argv[1], str(slice_num)])
-    p.wait()
-    if (p.returncode == 0):
+    t0 = time.time()
+    if persistent:
+      if p and (not p.alive() or (max_slices and p.slices >= max_slices)):
+        if p.alive():
+          plog('INFO', 'Replacing slice worker after '+str(p.slices)+' slices')
+          p.stop()
+        p = None
+      if not p:
+        p = SliceWorker(argv[1])
+      returncode = p.run_slice(slice_num)
+    else:
+      p = Popen(["python", "bwauthority_child.py", argv[1], str(slice_num)])
+      p.wait()
+      returncode = p.returncode
+    plog('INFO', 'Slice '+str(slice_num)+' returned '+str(returncode)+
+                 ' after '+str(round(time.time()-t0, 1))+'s')
+    if (returncode == 0):
       slice_num += 1
-    elif (p.returncode == RESTART_SLICE):
+    elif (returncode == RESTART_SLICE):
       plog('NOTICE', 'restarting slice_num '+str(slice_num))
-    elif (p.returncode == STOP_PCT_REACHED):
+    elif (returncode == STOP_PCT_REACHED):
       plog('NOTICE', 'restarting from slice 0')
       slice_num = 0
-    elif (abs(p.returncode) == SIGKILL):
+    elif (abs(returncode) == SIGKILL):
       plog('WARN', 'Child process recieved SIGKILL, exiting')
       exit()
-    elif (abs(p.returncode) == SIGTERM):
+    elif (abs(returncode) == SIGTERM):
       #XXX
       # see: https://trac.torproject.org/projects/tor/ticket/3701
       # if uncaught exceptions are raised in user-written handlers, TorCtl
@@ -55,7 +142,7 @@ def main(argv):
       #exit()
 
     else:
-      plog('WARN', 'Child process returned %s' % p.returncode)
+      plog('WARN', 'Child process returned %s' % returncode)
 
 def sigterm_handler(signum, frame):
   if p:
@@ -14,6 +14,7 @@ import socket
 import time
 import sys
 import urllib2
+import httplib
 import os
 import traceback
 import copy
@@ -23,13 +24,19 @@ import ConfigParser
 import sqlalchemy
 import sets
 import re
-import ssl
 import random
+import bisect
+import math
 
 sys.path.append("../../")
 
 from TorCtl.TorUtil import plog
-from aggregate import write_file_list
+from aggregate import write_file_list, read_slice_lines
+import bwrecords
+import fetchloop
+from slicejournal import SliceJournal
+import tlscache
+import sqlbulk
 
 # WAAAYYYYYY too noisy.
 #import gc
@@ -44,6 +51,16 @@ socket.socket = PathSupport.SmartSocket
 from SocksiPy import socks
 socket.socket = __origsocket
 
+# With fetch_slots > 1 the fetch threads need to find the SOCKS sockets
+# urllib2 creates for them, to time out and account their own streams.
+class FetchSocket(socks.socksocket):
+  current = threading.local()
+  def __init__(self, *args, **kwargs):
+    socks.socksocket.__init__(self, *args, **kwargs)
+    made = getattr(FetchSocket.current, "made", None)
+    if made is not None:
+      made.append(self)
+
 user_agent = "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; .NET CLR 1.0.3705; .NET CLR 1.1.4322)"
 
 # Note these urls should be https due to caching considerations.
@@ -74,6 +91,9 @@ __selmgr = PathSupport.SelectionManager(
 STOP_PCT_REACHED = 9
 RESTART_SLICE = 1
 
+# Also write each finished slice as a compact bwr- record file
+WRITE_BW_RECORDS = True
+
 def read_config(filename):
   config = ConfigParser.SafeConfigParser()
   config.read(filename)
@@ -101,55 +121,200 @@ def read_config(filename):
   only_unmeasured = config.getint('BwAuthority', 'only_unmeasured')
   min_unmeasured = config.getint('BwAuthority', 'min_unmeasured')
 
+  # Number of simultaneous fetches, each on its own circuit
+  fetch_slots = 1
+  if config.has_option('BwAuthority', 'fetch_slots'):
+    fetch_slots = max(1, config.getint('BwAuthority', 'fetch_slots'))
+  # Drive the fetches from one select() loop instead of a thread each
+  fetch_loop = 0
+  if config.has_option('BwAuthority', 'fetch_loop'):
+    fetch_loop = config.getint('BwAuthority', 'fetch_loop')
+  # Successful fetches between slice checkpoints (0: no checkpoints)
+  checkpoint_every = 0
+  if config.has_option('BwAuthority', 'checkpoint_every'):
+    checkpoint_every = config.getint('BwAuthority', 'checkpoint_every')
+  # Pick file sizes so fetches take about this many seconds (0: use the
+  # bwfiles table as is)
+  target_fetch_time = 0
+  if config.has_option('BwAuthority', 'target_fetch_time'):
+    target_fetch_time = config.getint('BwAuthority', 'target_fetch_time')
+  # Stream and circuit events per SQL transaction (0: one each)
+  sql_batch = 0
+  if config.has_option('BwAuthority', 'sql_batch'):
+    sql_batch = config.getint('BwAuthority', 'sql_batch')
+
   return (start_pct,stop_pct,nodes_per_slice,save_every,
             circs_per_node,out_dir,max_fetch_time,tor_dir,
             sleep_start,sleep_stop,min_streams,pid_file,db_url,only_unmeasured,
-            min_unmeasured)
-
-def choose_url(percentile):
-  # TODO: Maybe we don't want to read the file *every* time?
-  # Maybe once per slice?
-  # Read in the bw auths file
-  # here is a fine place to make sure we have bwfiles
-  try:
-    f = file("./data/bwfiles", "r")
-  except IOError:
-    write_file_list('./data')
-  lines = []
-  valid = False
-  for l in f.readlines():
-    if l == ".\n":
-      valid = True
-      break
-    pair = l.split()
-    lines.append((int(pair[0]), pair[1]))
-
-  if not valid:
-    plog("ERROR", "File size list is invalid!")
-
-  for (pct, fname) in lines:
-    if percentile < pct:
-      return random.choice(urls) + fname
+            min_unmeasured,fetch_slots,fetch_loop,checkpoint_every,
+            target_fetch_time,sql_batch)
+
+class BwFileList:
+  """The (percentile, file name) pairs of ./data/bwfiles, sorted by
+  percentile. The file is only parsed again when its mtime changes."""
+  def __init__(self, filename):
+    self.filename = filename
+    self.mtime = None
+    self.pcts = []
+    self.fnames = []
+    self.lock = threading.Lock()
+
+  def load(self):
+    # here is a fine place to make sure we have bwfiles
+    try:
+      mtime = os.stat(self.filename).st_mtime
+    except OSError:
+      write_file_list('./data')
+      mtime = os.stat(self.filename).st_mtime
+    if mtime == self.mtime:
+      return
+    f = file(self.filename, "r")
+    lines = []
+    valid = False
+    for l in f.readlines():
+      if l == ".\n":
+        valid = True
+        break
+      pair = l.split()
+      lines.append((int(pair[0]), pair[1]))
+    f.close()
+
+    if not valid:
+      plog("ERROR", "File size list is invalid!")
+
+    lines.sort(key=lambda (pct, fname): pct)
+    self.pcts = [pct for (pct, fname) in lines]
+    self.fnames = [fname for (pct, fname) in lines]
+    # A list still being written is read again next time
+    if valid:
+      self.mtime = mtime
+    plog("DEBUG", "Read "+str(len(lines))+" file sizes from "+self.filename)
+
+  def choose(self, percentile, want_bytes=None):
+    """The file for the first percentile above 'percentile', or None.
+    With 'want_bytes', the file closest to that size among the
+    MAX_SIZE_STEPS entries either side of it."""
+    self.lock.acquire()
+    try:
+      self.load()
+      i = bisect.bisect_right(self.pcts, percentile)
+      if i >= len(self.fnames):
+        return None
+      if not want_bytes or not file_size(self.fnames[i]):
+        return self.fnames[i]
+      near = [f for f in self.fnames[max(0, i-MAX_SIZE_STEPS):
+                                     i+MAX_SIZE_STEPS+1] if file_size(f)]
+      # On a log scale, so 2x too big is as bad as 2x too small
+      return min(near, key=lambda f:
+                   abs(math.log(float(file_size(f))/want_bytes)))
+    finally:
+      self.lock.release()
+
+# Shared by all the fetches of a slice
+bw_file_list = BwFileList("./data/bwfiles")
+
+def choose_url(percentile, want_bytes=None):
+  fname = bw_file_list.choose(percentile, want_bytes)
+  if fname:
+    return random.choice(urls) + fname
   raise PathSupport.NoNodesRemain("No nodes left for url choice!")
 
+def file_size(fname):
+  # "512k" -> 524288. None if the name does not say.
+  m = re.match(r"^(\d+)([kM]?)$", fname)
+  if not m:
+    return None
+  return int(m.group(1))*{"": 1, "k": 1024, "M": 1024*1024}[m.group(2)]
+
+# With target_fetch_time, how far (in bwfiles entries) the file may be
+# from the one the percentile table gives. Keeps slices comparable.
+MAX_SIZE_STEPS = 2
+# Closed streams a slice needs before its bandwidth is trusted
+SIZE_MIN_STREAMS = 5
+# Fetches between bandwidth estimates
+SIZE_UPDATE_EVERY = 5
+
+class FetchSizer:
+  """Picks how many bytes fetches of a slice should read so they take
+  about 'target_time' seconds. The rate is the median stream bandwidth
+  SQLSupport has recorded for this slice so far."""
+  def __init__(self, hdlr, target_time):
+    self.hdlr = hdlr
+    self.target_time = target_time
+    self.since = time.time()
+    self.fetches = 0
+    self.want_bytes = None
+
+  def want(self):
+    if self.fetches % SIZE_UPDATE_EVERY == 0:
+      bw = self.hdlr.get_stream_bw(self.since, SIZE_MIN_STREAMS)
+      if bw:
+        self.want_bytes = int(bw*self.target_time)
+        plog("DEBUG", "Median stream bandwidth is "+str(int(bw/1024))+
+                      " KB/s, fetching about "+str(self.want_bytes/1024)+" KB")
+    self.fetches += 1
+    return self.want_bytes
+
+# Bodies are read and dropped in pieces of this size, so a fetch never
+# holds more than this much of the file
+READ_SIZE = 65536
+
+# One SSL context for all fetches
+tls_cache = tlscache.TLSCache()
+# The handshake seconds of the fetch running in this thread
+current_tls = threading.local()
+
+class TLSCacheHTTPSConnection(httplib.HTTPSConnection):
+  def connect(self):
+    httplib.HTTPConnection.connect(self)
+    (self.sock, current_tls.handshake) = tls_cache.handshake(self.sock,
+                                                             self.host)
+
+class TLSCacheHTTPSHandler(urllib2.HTTPSHandler):
+  def https_open(self, req):
+    return self.do_open(TLSCacheHTTPSConnection, req)
+
+https_opener = None
+if tls_cache.context:
+  https_opener = urllib2.build_opener(TLSCacheHTTPSHandler())
+
+def log_read(read_len, decl_length, first_byte_at, last_byte_at,
+             handshake=None):
+  rate = ""
+  if first_byte_at and last_byte_at > first_byte_at:
+    rate = " at "+str(int(read_len/(last_byte_at-first_byte_at)/1024))+ \
+           " KB/s between first and last byte"
+  if handshake is not None:
+    rate += ", after a "+str(round(handshake, 3))+"s TLS handshake"
+  plog("DEBUG", "Read: "+str(read_len)+" of declared "+str(decl_length)+rate)
+
 def http_request(address):
   ''' perform an http GET-request and return 1 for success or 0 for failure '''
 
   request = urllib2.Request(address)
-  try:
-    context = ssl._create_unverified_context()
-  except:
-    context = None
   request.add_header('User-Agent', user_agent)
+  current_tls.handshake = None
 
   try:
-    if context:
-      reply = urllib2.urlopen(request, context=context)
+    if https_opener:
+      reply = https_opener.open(request)
     else:
       reply = urllib2.urlopen(request)
     decl_length = reply.info().get("Content-Length")
-    read_len = len(reply.read())
-    plog("DEBUG", "Read: "+str(read_len)+" of declared "+str(decl_length))
+    read_len = 0
+    first_byte_at = None
+    last_byte_at = None
+    while True:
+      n = len(reply.read(READ_SIZE))
+      if not n: break
+      last_byte_at = time.time()
+      if first_byte_at is None:
+        first_byte_at = last_byte_at
+      read_len += n
+    handshake = current_tls.handshake
+    current_tls.handshake = None
+    reply.close()
+    log_read(read_len, decl_length, first_byte_at, last_byte_at, handshake)
     return 1
   except (ValueError, urllib2.URLError) as e:
     plog('ERROR', 'The http-request address ' + address + ' is malformed')
@@ -173,11 +338,171 @@ def http_request(address):
     return 0
 
 class BwScanHandler(ScanSupport.SQLScanHandler):
-  def is_count_met(self, count, num_streams, position=0):
+  # See enable_fetch_slots()
+  fetch_slots = 0
+  fetch_loop = False
+  # Called from the event thread with (strm_id, status) when one of the
+  # fetch streams closes or fails
+  stream_listener = None
+  # Events per SQL transaction, and the sqlbulk.BatchedListener that
+  # queues them
+  sql_batch_events = 0
+  sql_batch = None
+  # Called with a job instead of waiting for it on a Condition (see
+  # run_job()). LoopFetchSlots keeps its fetches running meanwhile.
+  job_waiter = None
+
+  def enable_fetch_slots(self, slots, use_loop=False):
+    """Allow 'slots' fetches at once. Every stream then gets a new circuit
+    of its own, so the stream bandwidths written by write_strm_bws() are
+    not split between streams sharing a circuit. With use_loop, the
+    fetches run in a LoopFetchSlots rather than a FetchSlots."""
+    self.fetch_slots = slots
+    self.fetch_loop = use_loop
+    self.fetch_streams = {} # "ip:port" of our SOCKS connection -> strm_id
+    self.stream_exits = {}  # strm_id -> exit router
+
+  def attach_stream_any(self, stream, badcircs):
+    if self.fetch_slots:
+      # Instead of new_nym, which would also move the pending streams of a
+      # circuit still being built onto the new one.
+      self.new_nym = False
+      for circ in self.circuits.itervalues():
+        circ.dirty = True
+    ScanSupport.SQLScanHandler.attach_stream_any(self, stream, badcircs)
+
+  def stream_status_event(self, s):
+    ScanSupport.SQLScanHandler.stream_status_event(self, s)
+    if self.fetch_slots:
+      if s.status == "NEW" and s.source_addr:
+        self.fetch_streams[s.source_addr] = s.strm_id
+      strm = self.streams.get(s.strm_id)
+      if strm and strm.circ:
+        self.stream_exits[s.strm_id] = strm.circ.exit
+      if s.status in ("CLOSED", "FAILED") and self.stream_listener:
+        self.stream_listener(s.strm_id, s.status)
+
+  def fetch_done(self, local_addr):
+    """Forget the stream made from 'local_addr' and return the exit it
+    used, or None if it never got a circuit."""
+    strm_id = self.fetch_streams.pop(local_addr, None)
+    return self.stream_exits.pop(strm_id, None)
+
+  def close_fetch_stream(self, local_addr, reason):
+    """Like close_streams(), but only for the stream made from 'local_addr'"""
+    def notlambda(this):
+      strm_id = this.fetch_streams.get(local_addr)
+      if strm_id in this.streams:
+        try:
+          this.c.close_stream(strm_id, reason)
+        except TorCtl.ErrorReply, e:
+          plog("DEBUG", "Stream "+str(strm_id)+" already gone: "+str(e))
+    self.schedule_immediate(notlambda)
+
+  def attach_sql_listener(self, db_uri):
+    ScanSupport.SQLScanHandler.attach_sql_listener(self, db_uri)
+    if not self.sql_batch_events:
+      return
+    listeners = getattr(self, "pre_listeners", [])
+    for (i, l) in enumerate(listeners):
+      if isinstance(l, SQLSupport.StreamListener):
+        self.sql_batch = sqlbulk.BatchedListener(l, self.sql_batch_events)
+        listeners[i] = self.sql_batch
+        return
+    plog("WARN", "No SQL stream listener to batch events for")
+
+  def flush_sql(self):
+    # Queued before the low priority jobs that read the db
+    if self.sql_batch:
+      self.schedule_low_prio(lambda this: this.sql_batch.flush())
+
+  def commit(self):
+    self.flush_sql()
+    ScanSupport.SQLScanHandler.commit(self)
+
+  def reset_stats(self):
+    self.flush_sql()
+    ScanSupport.SQLScanHandler.reset_stats(self)
+
+  def write_sql_stats(self, rfilename=None, stats_filter=None):
+    self.flush_sql()
+    ScanSupport.SQLScanHandler.write_sql_stats(self, rfilename, stats_filter)
+
+  def run_job(self, job):
+    """Run job(this) as a low priority job on the event thread and return
+    what it returned."""
+    if self.job_waiter:
+      return self.job_waiter(job)
     cond = threading.Condition()
-    cond._finished = True # lol python haxx. Could make subclass, but why?? :)
+    cond._result = None
     def notlambda(this):
       cond.acquire()
+      try:
+        cond._result = job(this)
+      finally:
+        cond.notify()
+        cond.release()
+    cond.acquire()
+    self.schedule_low_prio(notlambda)
+    cond.wait()
+    cond.release()
+    return cond._result
+
+  def write_strm_bws(self, rfilename, slice_num=0, stats_filter=None):
+    """ScanSupport's write_strm_bws(), run with run_job(). With sql_batch
+    set, the routers are read in the same query as their stats
+    (sqlbulk.write_bws()); bench/bench_sqlexport.py checks both write the
+    same lines."""
+    self.flush_sql()
+    def notlambda(this):
+      f = file(rfilename, "w")
+      f.write("slicenum="+str(slice_num)+"\n")
+      if this.sql_batch_events:
+        sqlbulk.write_bws(f, stats_filter)
+      else:
+        SQLSupport.RouterStats.write_bws(f, 0, 100,
+                                         order_by=SQLSupport.RouterStats.sbw,
+                                         recompute=False,
+                                         disp_clause=stats_filter)
+      f.close()
+    self.run_job(notlambda)
+
+  def get_stream_bw(self, since, min_streams):
+    """Median read bandwidth of the streams closed since 'since', or None
+    if there are fewer than 'min_streams' of them."""
+    def notlambda(this):
+      try:
+        if this.sql_batch:
+          this.sql_batch.flush()
+        bws = [s.read_bandwidth for s in SQLSupport.ClosedStream.query.filter(
+                 SQLSupport.ClosedStream.end_time >= since).all()
+               if s.read_bandwidth]
+        if len(bws) >= min_streams:
+          bws.sort()
+          return bws[len(bws)/2]
+      except Exception, e:
+        # Never take the event thread down over this
+        plog("WARN", "Could not read stream bandwidths: "+str(e))
+      return None
+    return self.run_job(notlambda)
+
+  def skip_measured(self, idhexes, count):
+    """Count the routers in 'idhexes' as chosen 'count' times already, so
+    that the uniform generators pick the other routers first and
+    is_count_met() does not wait for them."""
+    def notlambda(this):
+      for idhex in idhexes:
+        r = this.routers.get(idhex)
+        if not r: continue
+        while len(r._generated) < this.selmgr.pathlen:
+          r._generated.append(0)
+        for i in xrange(len(r._generated)):
+          r._generated[i] = max(r._generated[i], count)
+    self.schedule_low_prio(notlambda)
+
+  def is_count_met(self, count, num_streams, position=0):
+    def notlambda(this):
+      finished = True
       # TODO: Using the entry_gen router list is somewhat ghetto..
       if this.selmgr.bad_restrictions:
         plog("NOTICE",
@@ -186,19 +511,19 @@ class BwScanHandler(ScanSupport.SQLScanHandler):
           this.selmgr.path_selector.exit_gen.rstr_routers):
         for r in this.selmgr.path_selector.entry_gen.rstr_routers:
           if r._generated[position] < count:
-            cond._finished = False
+            finished = False
             plog("DEBUG", "Entry router "+r.idhex+"="+r.nickname+" not done: "+str(r._generated[position])+", down: "+str(r.down)+", OK: "+str(this.selmgr.path_selector.entry_gen.rstr_list.r_is_ok(r))+", sorted_r: "+str(r in this.sorted_r))
             # XXX:
             #break
         for r in this.selmgr.path_selector.exit_gen.rstr_routers:
           if r._generated[position] < count:
-            cond._finished = False
+            finished = False
             plog("DEBUG", "Exit router "+r.idhex+"="+r.nickname+" not done: "+str(r._generated[position])+", down: "+str(r.down)+", OK: "+str(this.selmgr.path_selector.exit_gen.rstr_list.r_is_ok(r))+", sorted_r: "+str(r in this.sorted_r))
             # XXX:
             #break
         # Also run for at least 2*circs_per_node*nodes/3 successful fetches to
         # ensure we don't skip slices in the case of temporary network failure
-        if cond._finished:
+        if finished:
            num_routers = len(
                  sets.Set(this.selmgr.path_selector.entry_gen.rstr_routers
                            + this.selmgr.path_selector.exit_gen.rstr_routers))
@@ -207,66 +532,390 @@ class BwScanHandler(ScanSupport.SQLScanHandler):
            if num_streams < 0.65*((num_routers*count)/2.0):
              plog("WARN", "Not enough streams yet. "+str(num_streams)+" < "+
                         str(0.65*(num_routers*count/2.0)))
-             cond._finished = False
-      cond.notify()
-      cond.release()
+             finished = False
+      return finished
     plog("DEBUG", "Checking if scan count is met...")
-    cond.acquire()
-    self.schedule_low_prio(notlambda)
-    cond.wait()
-    cond.release()
-    plog("DEBUG", "Scan count met: "+str(cond._finished))
-    return cond._finished
+    finished = self.run_job(notlambda)
+    plog("DEBUG", "Scan count met: "+str(finished))
+    return finished
+
+def local_addr(sock):
+  try:
+    return sock.get_local_addr()
+  except AttributeError: # never connected
+    return None
+
+def forget_local_addr(addr):
+  # clear_port_table() would drop the other fetches' ports as well
+  PathSupport.SmartSocket._table_lock.acquire()
+  if addr in PathSupport.SmartSocket.port_table:
+    PathSupport.SmartSocket.port_table.remove(addr)
+  PathSupport.SmartSocket._table_lock.release()
+
+class FetchSlots:
+  """Runs up to 'slots' http_request()s at a time, each in a thread of its
+  own and on a circuit of its own (see BwScanHandler.enable_fetch_slots).
+  Finished fetches are reported as (ret, delta_build, build_exit) just
+  like the one-at-a-time loop in speedrace() computes them."""
+  def __init__(self, hdlr, slots, max_fetch_time):
+    self.hdlr = hdlr
+    self.slots = slots
+    self.max_fetch_time = max_fetch_time
+    self.running = 0
+    self.done = []
+    self.cond = threading.Condition()
+
+  def launch(self, url):
+    self.cond.acquire()
+    self.running += 1
+    self.cond.release()
+    t = threading.Thread(target=self.fetch, args=(url,))
+    t.setDaemon(True)
+    t.start()
+
+  def fetch(self, url):
+    t0 = time.time()
+    made = []
+    FetchSocket.current.made = made
+    # Same TIMEOUT reason as the single fetch timer, so the stream's
+    # bandwidth is not counted
+    def timeout():
+      for sock in made:
+        if local_addr(sock):
+          self.hdlr.close_fetch_stream(local_addr(sock), 7)
+    timer = threading.Timer(self.max_fetch_time, timeout)
+    timer.start()
+
+    ret = http_request(url)
+    timer.cancel()
+    delta_build = time.time() - t0
+
+    build_exit = None
+    for sock in made:
+      addr = local_addr(sock)
+      if not addr: continue
+      build_exit = self.hdlr.fetch_done(addr) or build_exit
+      forget_local_addr(addr)
+    self.finished(ret, delta_build, build_exit)
+
+  def finished(self, ret, delta_build, build_exit):
+    self.cond.acquire()
+    self.running -= 1
+    self.done.append((ret, delta_build, build_exit))
+    self.cond.notify()
+    self.cond.release()
+
+  def busy(self):
+    return self.running > 0
+
+  def collect(self):
+    """Wait for a free slot and return the fetches finished so far."""
+    self.cond.acquire()
+    while self.running >= self.slots:
+      self.cond.wait()
+    done = self.done
+    self.done = []
+    self.cond.release()
+    return done
+
+  def drain(self):
+    """Wait for all running fetches and return them."""
+    self.cond.acquire()
+    while self.running:
+      self.cond.wait()
+    done = self.done
+    self.done = []
+    self.cond.release()
+    PathSupport.SmartSocket.clear_port_table()
+    return done
+
+  def close(self):
+    pass
+
+# How long a fetch may linger after Tor closed its stream, or after we
+# asked Tor to close it
+STREAM_CLOSE_GRACE = 10
+
+class LoopFetchSlots(FetchSlots):
+  """FetchSlots whose fetches all run from one fetchloop.FetchLoop, driven
+  by the thread that runs speedrace(). collect(), drain() and the jobs the
+  handler waits for (BwScanHandler.run_job()) run the loop until they
+  have what they wait for, instead of sleeping on a Condition while other
+  threads do the fetching. Timeouts are loop timers. Only the stream
+  close events still come from TorCtl's event thread, which reads the
+  control connection; they are posted into the loop."""
+  def __init__(self, hdlr, slots, max_fetch_time):
+    FetchSlots.__init__(self, hdlr, slots, max_fetch_time)
+    self.loop = fetchloop.FetchLoop()
+    self.fetches = {} # local addr -> fetchloop.Fetch
+    hdlr.stream_listener = self.stream_event
+    hdlr.job_waiter = self.run_job
+
+  def run_once(self):
+    try:
+      self.loop.run_once()
+    except Exception, e:
+      # Keep serving the other fetches
+      plog('ERROR', 'Fetch loop error: '+str(e))
+      traceback.print_exc()
+
+  def run_job(self, job):
+    result = []
+    def notlambda(this):
+      try:
+        ret = job(this)
+      except:
+        self.loop.call_from_thread(lambda: result.append(None))
+        raise
+      self.loop.call_from_thread(lambda: result.append(ret))
+    self.hdlr.schedule_low_prio(notlambda)
+    while not result:
+      self.run_once()
+    return result[0]
+
+  def close(self):
+    self.hdlr.stream_listener = None
+    self.hdlr.job_waiter = None
+    self.loop.close()
+
+  def launch(self, url):
+    self.running += 1
+    try:
+      fetch = fetchloop.Fetch(self.loop, url,
+                              (TorUtil.tor_host, TorUtil.tor_port),
+                              PathSupport.SmartSocket, user_agent,
+                              self.fetch_done, tls_cache, self.redirected)
+    except socket.error, e:
+      plog('ERROR', 'Could not connect to the SOCKS port: '+str(e))
+      self.finished(0, 0, None)
+      return
+    fetch.local_addr = local_addr(fetch.raw)
+    self.fetches[fetch.local_addr] = fetch
+    fetch.timer = self.loop.call_later(self.max_fetch_time,
+                                       lambda: self.timeout(fetch))
+
+  def finished(self, ret, delta_build, build_exit):
+    self.running -= 1
+    self.done.append((ret, delta_build, build_exit))
+
+  def collect(self):
+    while self.running >= self.slots:
+      self.run_once()
+    (done, self.done) = (self.done, [])
+    return done
+
+  def drain(self):
+    while self.running:
+      self.run_once()
+    (done, self.done) = (self.done, [])
+    PathSupport.SmartSocket.clear_port_table()
+    return done
+
+  def timeout(self, fetch):
+    # Same TIMEOUT reason as the single fetch timer, so the stream's
+    # bandwidth is not counted
+    self.hdlr.close_fetch_stream(fetch.local_addr, 7)
+    self.loop.call_later(STREAM_CLOSE_GRACE,
+                         lambda: fetch.abort("Timed out"))
+
+  def stream_event(self, strm_id, status):
+    # TorCtl's event thread
+    self.loop.call_from_thread(lambda: self.stream_closed(strm_id))
+
+  def stream_closed(self, strm_id):
+    for (addr, fetch) in self.fetches.iteritems():
+      if self.hdlr.fetch_streams.get(addr) == strm_id:
+        self.loop.call_later(STREAM_CLOSE_GRACE,
+                             lambda: fetch.abort("Tor closed the stream"))
+        return
+
+  def redirected(self, fetch):
+    # Like urllib2, the fetch goes on over a new stream. It is accounted
+    # to the exit of the last one.
+    del self.fetches[fetch.local_addr]
+    self.hdlr.fetch_done(fetch.local_addr)
+    forget_local_addr(fetch.local_addr)
+    fetch.local_addr = local_addr(fetch.raw)
+    self.fetches[fetch.local_addr] = fetch
+
+  def fetch_done(self, fetch):
+    self.loop.cancel(fetch.timer)
+    del self.fetches[fetch.local_addr]
+    if fetch.error:
+      plog('NOTICE', 'Fetch of '+fetch.url+' failed: '+fetch.error)
+    else:
+      log_read(fetch.read_len, fetch.decl_length, fetch.first_byte_at,
+               fetch.last_byte_at, fetch.handshake_time)
+    build_exit = self.hdlr.fetch_done(fetch.local_addr)
+    forget_local_addr(fetch.local_addr)
+    self.finished(int(fetch.ok), time.time() - fetch.started, build_exit)
+
+def write_bw_records(bws_file):
+  # Compact binary copy of a finished slice file (see bwrecords.py).
+  # aggregate.py reads it instead of the text file.
+  try:
+    fp = file(bws_file, "r")
+    slicenum = int(fp.readline().split("=")[-1]) # "slicenum=N"
+    timestamp = float(fp.readline())
+    rows = [l.to_row() for l in read_slice_lines(fp, slicenum, timestamp)]
+    fp.close()
+    bwrecords.write_records(bwrecords.records_name(bws_file), slicenum,
+                            timestamp, rows)
+  except Exception, e:
+    # The text file is still there for aggregate.py to read
+    plog("WARN", "Could not write records for "+bws_file+": "+str(e))
+
+def fetch_one(hdlr, url, start_pct, stop_pct, max_fetch_time):
+  t0 = time.time()
+  hdlr.new_exit()
+
+  # TODO: This noise is due to a difficult to find Tor bug that
+  # causes some exits to hang forever on streams :(
+  # FIXME: Hrmm, should we change the reason on this? Right now,
+  # 7 == TIMEOUT, which means we do not count the bandwidth of this
+  # stream.. however, we count it as 'successful' below
+  timer = threading.Timer(max_fetch_time, lambda: hdlr.close_streams(7))
+  timer.start()
+
+  plog("DEBUG", "Launching stream request for url "+url+" in "+str(start_pct)+'-'+str(stop_pct) + '%')
+  ret = http_request(url)
+  timer.cancel()
+  PathSupport.SmartSocket.clear_port_table()
+
+  delta_build = time.time() - t0
+  return (ret, delta_build, hdlr.get_exit_node())
+
+def account_fetch(ret, delta_build, build_exit, start_pct, stop_pct,
+                  max_fetch_time):
+  """Log a finished fetch and return 1 if it counts as successful."""
+  if delta_build >= max_fetch_time:
+    plog('WARN', 'Timer exceeded limit: ' + str(delta_build) + '\n')
+
+  # FIXME: Timeouts get counted as 'sucessful' here, but do not
+  # count in the SQL stats!
+  if ret == 1 and build_exit:
+    plog('DEBUG', str(start_pct) + '-' + str(stop_pct) + '% circuit build+fetch took ' + str(delta_build) + ' for ' + str(build_exit))
+    return 1
+  plog('DEBUG', str(start_pct)+'-'+str(stop_pct)+'% circuit build+fetch failed for ' + str(build_exit))
+  return 0
+
+def related_file(filename, prefix):
+  # bws-X -> sql-X and friends
+  (dirname, basename) = os.path.split(filename)
+  return os.path.join(dirname, prefix+basename[len("bws-"):])
+
+def write_checkpoint(hdlr, journal, slice_num, start_pct, stop_pct, out_dir,
+                     min_streams, successful, attempt):
+  """Write what the slice measured so far the way the final bws-/sql- files
+  are written, but named -ckpt- so aggregate.py ignores them, and record
+  it in the journal. Returns the bws- file name."""
+  hdlr.commit()
+  lo = str(round(start_pct,1))
+  hi = str(round(stop_pct,1))
+  race_time = time.strftime("20%y-%m-%d-%H:%M:%S")
+  bws_file = os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-ckpt-"+race_time
+  hdlr.write_sql_stats(related_file(bws_file, "sql-"), stats_filter=sqlalchemy.or_(SQLSupport.RouterStats.circ_try_from > 0, SQLSupport.RouterStats.circ_try_to > 0))
+  hdlr.write_strm_bws(bws_file, slice_num, stats_filter=sqlalchemy.and_(SQLSupport.RouterStats.strm_closed >= min_streams, SQLSupport.RouterStats.filt_sbw >= 0, SQLSupport.RouterStats.sbw >=0 ))
+  fp = file(bws_file, "r")
+  routers = len(fp.readlines()) - 2 # slicenum and timestamp
+  fp.close()
+  journal.checkpoint(slice_num, bws_file, successful, attempt, routers)
+  plog("INFO", "Checkpoint of slice "+str(slice_num)+": "+str(routers)+
+               " routers after "+str(successful)+" fetches")
+  return bws_file
+
+def remove_checkpoint(bws_file):
+  for f in (bws_file, related_file(bws_file, "sql-")):
+    try:
+      os.remove(f)
+    except OSError:
+      pass
+
+def keep_checkpoint(bws_file):
+  # The last checkpoint of a run that was killed becomes a finished slice
+  # file of its own. aggregate.py uses the newest measurement of each
+  # router, so routers measured again after the restart are not counted
+  # twice.
+  done_file = bws_file.replace("-ckpt-", "-done-")
+  if not os.path.exists(bws_file):
+    return
+  os.rename(bws_file, done_file)
+  if os.path.exists(related_file(bws_file, "sql-")):
+    os.rename(related_file(bws_file, "sql-"), related_file(done_file, "sql-"))
+  if WRITE_BW_RECORDS:
+    write_bw_records(done_file)
+  plog("NOTICE", "Kept measurements of an interrupted run in "+done_file)
 
 def speedrace(hdlr, start_pct, stop_pct, circs_per_node, save_every, out_dir,
               max_fetch_time, sleep_start_tp, sleep_stop_tp, slice_num,
-              min_streams, sql_file, only_unmeasured):
+              min_streams, sql_file, only_unmeasured, journal=None,
+              checkpoint_every=0, target_fetch_time=0):
   plog("NOTICE", "Starting slice for percentiles "+str(start_pct)+"-"+str(stop_pct))
   hdlr.set_pct_rstr(start_pct, stop_pct)
+  # TLS handshakes are reported per slice
+  tls_cache.take_stats()
+
+  fetcher = None
+  if hdlr.fetch_loop:
+    fetcher = LoopFetchSlots(hdlr, hdlr.fetch_slots, max_fetch_time)
+  elif hdlr.fetch_slots:
+    fetcher = FetchSlots(hdlr, hdlr.fetch_slots, max_fetch_time)
+  sizer = None
+  if target_fetch_time:
+    sizer = FetchSizer(hdlr, target_fetch_time)
 
   attempt = 0
   successful = 0
+  checkpoint = None
+  if journal:
+    # Carry on from where killed runs of this slice got to. Their last
+    # checkpoints are kept as -done- files when this run finishes.
+    (measured, successful, attempt) = journal.interrupted_progress(slice_num)
+    if measured:
+      hdlr.skip_measured(measured, circs_per_node)
+      plog("NOTICE", "Resuming slice "+str(slice_num)+" after "+
+                     str(successful)+" fetches, skipping "+str(len(measured))+
+                     " routers measured before the restart")
   while True:
-    if hdlr.is_count_met(circs_per_node, successful): break
-    t0 = time.time()
-
-    hdlr.new_exit()
-    attempt += 1
-
-    # TODO: This noise is due to a difficult to find Tor bug that
-    # causes some exits to hang forever on streams :(
-    # FIXME: Hrmm, should we change the reason on this? Right now,
-    # 7 == TIMEOUT, which means we do not count the bandwidth of this
-    # stream.. however, we count it as 'successful' below
-    timer = threading.Timer(max_fetch_time, lambda: hdlr.close_streams(7))
-    timer.start()
-
+    if hdlr.is_count_met(circs_per_node, successful):
+      if not (fetcher and fetcher.busy()): break
+      # Account for the fetches still running, then check again
+      for (ret, delta_build, build_exit) in fetcher.drain():
+        successful += account_fetch(ret, delta_build, build_exit,
+                                    start_pct, stop_pct, max_fetch_time)
+      continue
+
+    want_bytes = None
+    if sizer:
+      want_bytes = sizer.want()
     # Always use median URL size for unmeasured nodes
     # They may be too slow..
     if only_unmeasured:
-      url = choose_url(50)
+      url = choose_url(50, want_bytes)
     else:
-      url = choose_url(start_pct)
-
-    plog("DEBUG", "Launching stream request for url "+url+" in "+str(start_pct)+'-'+str(stop_pct) + '%')
-    ret = http_request(url)
-    timer.cancel()
-    PathSupport.SmartSocket.clear_port_table()
-
-    delta_build = time.time() - t0
-    if delta_build >= max_fetch_time:
-      plog('WARN', 'Timer exceeded limit: ' + str(delta_build) + '\n')
-
-    build_exit = hdlr.get_exit_node()
-    # FIXME: Timeouts get counted as 'sucessful' here, but do not
-    # count in the SQL stats!
-    if ret == 1 and build_exit:
-      successful += 1
-      plog('DEBUG', str(start_pct) + '-' + str(stop_pct) + '% circuit build+fetch took ' + str(delta_build) + ' for ' + str(build_exit))
+      url = choose_url(start_pct, want_bytes)
+
+    if fetcher:
+      hdlr.new_exit()
+      attempt += 1
+      plog("DEBUG", "Launching stream request for url "+url+" in "+str(start_pct)+'-'+str(stop_pct) + '%')
+      fetcher.launch(url)
+      results = fetcher.collect()
     else:
-      plog('DEBUG', str(start_pct)+'-'+str(stop_pct)+'% circuit build+fetch failed for ' + str(build_exit))
-
-    if save_every and ret and successful and (successful % save_every) == 0:
+      results = [fetch_one(hdlr, url, start_pct, stop_pct, max_fetch_time)]
+      attempt += 1
+
+    saved_at = successful
+    for (ret, delta_build, build_exit) in results:
+      successful += account_fetch(ret, delta_build, build_exit,
+                                  start_pct, stop_pct, max_fetch_time)
+
+    if save_every and successful/save_every > saved_at/save_every:
+      if fetcher:
+        # close_circuits() would cut the running fetches short
+        for (ret, delta_build, build_exit) in fetcher.drain():
+          successful += account_fetch(ret, delta_build, build_exit,
+                                      start_pct, stop_pct, max_fetch_time)
       race_time = time.strftime("20%y-%m-%d-%H:%M:%S")
       hdlr.close_circuits()
       hdlr.commit()
@@ -277,7 +926,28 @@ def speedrace(hdlr, start_pct, stop_pct, circs_per_node, save_every, out_dir,
       hdlr.write_sql_stats(os.getcwd()+'/'+out_dir+'/sql-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, sqlalchemy.or_(SQLSupport.RouterStats.circ_try_from > 0, SQLSupport.RouterStats.circ_try_to > 0))
       hdlr.write_strm_bws(os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-"+str(successful)+"-"+race_time, stats_filter=SQLSupport.RouterStats.strm_closed >= 1)
 
+    if journal and checkpoint_every and \
+       successful/checkpoint_every > saved_at/checkpoint_every:
+      if hdlr.fetch_loop:
+        # commit() and write_sql_stats() wait for TorCtl's event thread,
+        # and nothing runs the fetch loop meanwhile
+        for (ret, delta_build, build_exit) in fetcher.drain():
+          successful += account_fetch(ret, delta_build, build_exit,
+                                      start_pct, stop_pct, max_fetch_time)
+      # Each checkpoint has everything the previous one had
+      last = checkpoint
+      checkpoint = write_checkpoint(hdlr, journal, slice_num, start_pct,
+                                    stop_pct, out_dir, min_streams,
+                                    successful, attempt)
+      if last: remove_checkpoint(last)
+
   plog('INFO', str(start_pct) + '-' + str(stop_pct) + '% ' + str(successful) + ' fetches took ' + str(attempt) + ' tries.')
+  (handshakes, handshake_time) = tls_cache.take_stats()
+  if handshakes:
+    plog('INFO', str(handshakes)+' TLS handshakes took '+
+                 str(round(handshake_time/handshakes, 3))+'s on average')
+  if fetcher:
+    fetcher.close()
 
   hdlr.close_circuits()
   hdlr.commit()
@@ -294,19 +964,165 @@ def speedrace(hdlr, start_pct, stop_pct, circs_per_node, save_every, out_dir,
   hdlr.write_sql_stats(os.getcwd()+'/'+out_dir+'/sql-'+lo+':'+hi+"-done-"+time.strftime("20%y-%m-%d-%H:%M:%S"), stats_filter=sqlalchemy.or_(SQLSupport.RouterStats.circ_try_from > 0, SQLSupport.RouterStats.circ_try_to > 0))
   # Warning, don't remove the sql stats call without changing the recompute
   # param in write_strm_bws to True
-  hdlr.write_strm_bws(os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-done-"+time.strftime("20%y-%m-%d-%H:%M:%S"), slice_num, stats_filter=sqlalchemy.and_(SQLSupport.RouterStats.strm_closed >= min_streams, SQLSupport.RouterStats.filt_sbw >= 0, SQLSupport.RouterStats.sbw >=0 ))
+  bws_file = os.getcwd()+'/'+out_dir+'/bws-'+lo+':'+hi+"-done-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+  hdlr.write_strm_bws(bws_file, slice_num, stats_filter=sqlalchemy.and_(SQLSupport.RouterStats.strm_closed >= min_streams, SQLSupport.RouterStats.filt_sbw >= 0, SQLSupport.RouterStats.sbw >=0 ))
+  if WRITE_BW_RECORDS:
+    write_bw_records(bws_file)
   plog('DEBUG', 'Wrote stats')
+  if journal:
+    for f in journal.interrupted_checkpoints(slice_num):
+      keep_checkpoint(f)
+    journal.finish_slice(slice_num, bws_file)
+    if checkpoint: remove_checkpoint(checkpoint)
   #hdlr.save_sql_file(sql_file, os.getcwd()+"/"+out_dir+"/bw-db-"+str(lo)+":"+str(hi)+"-"+time.strftime("20%y-%m-%d-%H:%M:%S")+".sqlite")
 
   return successful
 
+def setup_scanner(conf):
+  (start_pct,stop_pct,nodes_per_slice,save_every,circs_per_node,out_dir,
+      max_fetch_time,tor_dir,sleep_start,sleep_stop,
+             min_streams,pid_file_name,db_url,only_unmeasured,
+             min_unmeasured,fetch_slots,fetch_loop,checkpoint_every,
+             target_fetch_time,sql_batch) = conf
+  try:
+    (c,hdlr) = setup_handler(out_dir, tor_dir+"/control_auth_cookie")
+  except Exception, e:
+    traceback.print_exc()
+    plog("WARN", "Can't connect to Tor: "+str(e))
+    sys.exit(STOP_PCT_REACHED)
+
+  hdlr.sql_batch_events = sql_batch
+  if db_url:
+    hdlr.attach_sql_listener(db_url)
+    sql_file = None
+  else:
+    plog("INFO", "db_url not found in config. Defaulting to sqlite")
+    sql_file = os.getcwd()+'/'+out_dir+'/bwauthority.sqlite'
+    #hdlr.attach_sql_listener('sqlite:///'+sql_file)
+    hdlr.attach_sql_listener('sqlite://')
+
+  # set SOCKS proxy
+  socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
+  socket.socket = socks.socksocket
+  plog("INFO", "Set socks proxy to "+TorUtil.tor_host+":"+str(TorUtil.tor_port))
+
+  if fetch_loop:
+    hdlr.enable_fetch_slots(fetch_slots, True)
+    plog("INFO", "Running "+str(fetch_slots)+" fetches at a time from a select() loop")
+  elif fetch_slots > 1:
+    socket.socket = FetchSocket
+    hdlr.enable_fetch_slots(fetch_slots)
+    plog("INFO", "Running "+str(fetch_slots)+" fetches at a time")
+
+  hdlr.schedule_selmgr(lambda s: setattr(s, "only_unmeasured", only_unmeasured))
+  return (c,hdlr,sql_file)
+
+def wait_for_consensus(c, hdlr):
+  hdlr.wait_for_consensus()
+
+  # Now that we have the consensus, we shouldn't need to listen
+  # for new consensus events.
+  c.set_events([TorCtl.EVENT_TYPE.STREAM,
+        TorCtl.EVENT_TYPE.BW,
+        TorCtl.EVENT_TYPE.CIRC,
+        TorCtl.EVENT_TYPE.STREAM_BW], True)
+
+def run_slice(hdlr, conf, slice_num, sql_file):
+  """Measure slice 'slice_num' and return the exit code bwauthority.py
+  expects for it: 0, RESTART_SLICE or STOP_PCT_REACHED."""
+  (start_pct,stop_pct,nodes_per_slice,save_every,circs_per_node,out_dir,
+      max_fetch_time,tor_dir,sleep_start,sleep_stop,
+             min_streams,pid_file_name,db_url,only_unmeasured,
+             min_unmeasured,fetch_slots,fetch_loop,checkpoint_every,
+             target_fetch_time,sql_batch) = conf
+
+  journal = None
+  if checkpoint_every:
+    journal = SliceJournal(out_dir)
+
+  # We should go to sleep if there are less than 5 unmeasured nodes after
+  # consensus update
+  if min_unmeasured and hdlr.get_unmeasured() < min_unmeasured:
+    plog("NOTICE", "Less than "+str(min_unmeasured)+" unmeasured nodes ("+str(hdlr.get_unmeasured())+"). Sleeping for a bit")
+    time.sleep(3600) # Until next consensus arrives
+    plog("NOTICE", "Woke up from waiting for more unmeasured nodes.  Requesting slice restart.")
+    return RESTART_SLICE
+
+  pct_step = hdlr.rank_to_percent(nodes_per_slice)
+  plog("INFO", "Percent per slice is: "+str(pct_step))
+  if pct_step > 100: pct_step = 100
+
+  # check to see if we are done
+  if (slice_num * pct_step + start_pct > stop_pct):
+      plog('NOTICE', 'Child stop point %s reached. Exiting with %s' % (stop_pct, STOP_PCT_REACHED))
+      if journal: journal.scan_done()
+      return STOP_PCT_REACHED
+
+  if journal:
+    journal.start_slice(slice_num, slice_num*pct_step + start_pct,
+                        (slice_num + 1)*pct_step + start_pct)
+
+  successful = speedrace(hdlr, slice_num*pct_step + start_pct, (slice_num + 1)*pct_step + start_pct, circs_per_node,
+            save_every, out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num,
+            min_streams, sql_file, only_unmeasured, journal, checkpoint_every,
+            target_fetch_time)
+
+  # For debugging memory leak..
+  #TorUtil.dump_class_ref_counts(referrer_depth=1)
+
+  # TODO: Change pathlen to 3 and kill exit+ConserveExit restrictions
+  # And record circ failure rates..
+
+  #circ_measure(hdlr, pct, pct+pct_step, circs_per_node, save_every, 
+  #  out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num, sql_file)
+
+  # XXX: Hack this to return a codelen double the slice size on failure?
+  plog("INFO", "Slice success count: "+str(successful))
+  if successful == 0:
+    plog("WARN", "Slice success count was ZERO!")
+
+  return 0
+
+def serve_slices(c, hdlr, conf, sql_file, commands, results):
+  # Persistent worker mode: bwauthority.py writes "slice <num>" lines to
+  # 'commands' and we answer each with "done <num> <exit code>" on
+  # 'results', using the exit codes a per-slice child would have used.
+  # EOF or "quit" ends the worker.
+  first = True
+  while True:
+    line = commands.readline()
+    if not line or line.strip() == "quit":
+      return
+    slice_num = int(line.split()[1])
+    t0 = time.time()
+    if not first:
+      # A freshly spawned child would start from the current consensus
+      # and empty stats
+      c.set_events([TorCtl.EVENT_TYPE.STREAM,
+            TorCtl.EVENT_TYPE.BW,
+            TorCtl.EVENT_TYPE.NEWCONSENSUS,
+            TorCtl.EVENT_TYPE.NEWDESC,
+            TorCtl.EVENT_TYPE.CIRC,
+            TorCtl.EVENT_TYPE.STREAM_BW], True)
+      wait_for_consensus(c, hdlr)
+      hdlr.reset_stats()
+    first = False
+    plog("INFO", "Slice "+str(slice_num)+" setup took "+
+                 str(round(time.time()-t0, 2))+"s")
+    ret = run_slice(hdlr, conf, slice_num, sql_file)
+    results.write("done %d %d\n" % (slice_num, ret))
+    results.flush()
+
 def main(argv):
   TorUtil.read_config(argv[1])
+  conf = read_config(argv[1])
   (start_pct,stop_pct,nodes_per_slice,save_every,circs_per_node,out_dir,
       max_fetch_time,tor_dir,sleep_start,sleep_stop,
              min_streams,pid_file_name,db_url,only_unmeasured,
-             min_unmeasured) = read_config(argv[1])
+             min_unmeasured,fetch_slots,fetch_loop,checkpoint_every,
+             target_fetch_time,sql_batch) = conf
   plog("NOTICE", "Child Process Spawned...")
+  t0 = time.time()
 
   # make sure necessary out_dir directory exists
   path = os.getcwd()+'/'+out_dir
@@ -318,76 +1134,16 @@ def main(argv):
     pidfd.write('%d\n' % os.getpid())
     pidfd.close()
 
-    slice_num = int(argv[2])
-
-    try:
-      (c,hdlr) = setup_handler(out_dir, tor_dir+"/control_auth_cookie")
-    except Exception, e:
-      traceback.print_exc()
-      plog("WARN", "Can't connect to Tor: "+str(e))
-      sys.exit(STOP_PCT_REACHED)
-
-    if db_url:
-      hdlr.attach_sql_listener(db_url)
-      sql_file = None
-    else:
-      plog("INFO", "db_url not found in config. Defaulting to sqlite")
-      sql_file = os.getcwd()+'/'+out_dir+'/bwauthority.sqlite'
-      #hdlr.attach_sql_listener('sqlite:///'+sql_file)
-      hdlr.attach_sql_listener('sqlite://')
-
-    # set SOCKS proxy
-    socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
-    socket.socket = socks.socksocket
-    plog("INFO", "Set socks proxy to "+TorUtil.tor_host+":"+str(TorUtil.tor_port))
-
-    hdlr.schedule_selmgr(lambda s: setattr(s, "only_unmeasured", only_unmeasured))
-
-    hdlr.wait_for_consensus()
-
-    # Now that we have the consensus, we shouldn't need to listen
-    # for new consensus events.
-    c.set_events([TorCtl.EVENT_TYPE.STREAM,
-          TorCtl.EVENT_TYPE.BW,
-          TorCtl.EVENT_TYPE.CIRC,
-          TorCtl.EVENT_TYPE.STREAM_BW], True)
-
-    # We should go to sleep if there are less than 5 unmeasured nodes after
-    # consensus update
-    if min_unmeasured and hdlr.get_unmeasured() < min_unmeasured:
-      plog("NOTICE", "Less than "+str(min_unmeasured)+" unmeasured nodes ("+str(hdlr.get_unmeasured())+"). Sleeping for a bit")
-      time.sleep(3600) # Until next consensus arrives
-      plog("NOTICE", "Woke up from waiting for more unmeasured nodes.  Requesting slice restart.")
-      sys.exit(RESTART_SLICE)
-
-    pct_step = hdlr.rank_to_percent(nodes_per_slice)
-    plog("INFO", "Percent per slice is: "+str(pct_step))
-    if pct_step > 100: pct_step = 100
-
-    # check to see if we are done
-    if (slice_num * pct_step + start_pct > stop_pct):
-        plog('NOTICE', 'Child stop point %s reached. Exiting with %s' % (stop_pct, STOP_PCT_REACHED))
-        sys.exit(STOP_PCT_REACHED)
-
-    successful = speedrace(hdlr, slice_num*pct_step + start_pct, (slice_num + 1)*pct_step + start_pct, circs_per_node,
-              save_every, out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num,
-              min_streams, sql_file, only_unmeasured)
-
-    # For debugging memory leak..
-    #TorUtil.dump_class_ref_counts(referrer_depth=1)
-
-    # TODO: Change pathlen to 3 and kill exit+ConserveExit restrictions
-    # And record circ failure rates..
-
-    #circ_measure(hdlr, pct, pct+pct_step, circs_per_node, save_every, 
-    #  out_dir, max_fetch_time, sleep_start, sleep_stop, slice_num, sql_file)
+    (c,hdlr,sql_file) = setup_scanner(conf)
+    wait_for_consensus(c, hdlr)
+    plog("INFO", "Scanner setup took "+str(round(time.time()-t0, 2))+"s")
 
-    # XXX: Hack this to return a codelen double the slice size on failure?
-    plog("INFO", "Slice success count: "+str(successful))
-    if successful == 0:
-      plog("WARN", "Slice success count was ZERO!")
+    if argv[2].startswith("--worker="):
+      results = os.fdopen(int(argv[2][len("--worker="):]), "w")
+      serve_slices(c, hdlr, conf, sql_file, sys.stdin, results)
+      sys.exit(0)
 
-    sys.exit(0)
+    sys.exit(run_slice(hdlr, conf, int(argv[2]), sql_file))
 
 def ignore_streams(c,hdlr):
   for stream in c.get_info("stream-status")['stream-status'].rstrip("\n").split("\n"):
@@ -430,7 +1186,7 @@ def setup_handler(out_dir, cookie_file):
   return (c,h)
 
 def usage(argv):
-  print "Usage: "+argv[0]+" <configfile>"
+  print "Usage: "+argv[0]+" <configfile> <slice num>|--worker=<result fd>"
   return
 
 # initiate the program
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Compact binary copies of finished bws-* slice files
+
+"""
+BwRecords
+
+A bwr-<lo>:<hi>-done-<time> file holds the same measurements as the
+bws-<lo>:<hi>-done-<time> text file it sits next to, as fixed-width
+little-endian records that aggregate.py reads through mmap without any
+text parsing:
+
+  header:  magic "BWR1", slice number (int32), measurement time (double),
+           record count (uint32), nick table length (uint32)
+  records: relay fingerprint (20 raw bytes), nick index (uint32),
+           strm_bw, filt_bw, ns_bw, desc_bw (uint32, bytes/sec),
+           circ_fail_rate, strm_fail_rate (double)
+  nicks:   the nicknames, NUL separated, indexed by the records
+
+That is 56 bytes per relay instead of the ~200 of a text line. Every
+record in a slice was measured at the same time, so the timestamp is
+stored once in the header.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = "BWR1"
+HEADER = struct.Struct("<4sidII")
+RECORD = struct.Struct("<20sIIIIIdd")
+
+def records_name(bws_file):
+  """The bwr- file name that goes with the bws- file 'bws_file'."""
+  (head, tail) = os.path.split(bws_file)
+  return os.path.join(head, tail.replace("bws-", "bwr-", 1))
+
+def write_records(filename, slicenum, timestamp, rows):
+  """Write 'rows' (tuples in sliceindex.LINE_FIELDS order) to 'filename'.
+  The file is written under a temporary name and renamed into place, so
+  aggregate.py never sees a partial one. Raises struct.error if a value
+  does not fit its field; no file is written then."""
+  nicks = []
+  out = [None] # header, once the nick table size is known
+  for (idhex, nick, strm_bw, filt_bw, ns_bw, desc_bw, circ_fail_rate,
+       strm_fail_rate) in rows:
+    out.append(RECORD.pack(idhex.lstrip("$").decode("hex"), len(nicks),
+                           strm_bw, filt_bw, ns_bw, desc_bw,
+                           circ_fail_rate, strm_fail_rate))
+    nicks.append(nick)
+  nick_table = "\0".join(nicks)
+  out[0] = HEADER.pack(MAGIC, slicenum, timestamp, len(rows),
+                       len(nick_table))
+  out.append(nick_table)
+  (head, tail) = os.path.split(filename)
+  tmp = os.path.join(head, "."+tail)
+  f = file(tmp, "wb")
+  f.write("".join(out))
+  f.close()
+  os.rename(tmp, filename)
+
+def _unpack_header(buf, size, filename):
+  if size < HEADER.size:
+    raise ValueError("Truncated record file "+filename)
+  (magic, slicenum, timestamp, count, nick_len) = HEADER.unpack_from(buf, 0)
+  if magic != MAGIC:
+    raise ValueError("Not a record file: "+filename)
+  if size != HEADER.size + count*RECORD.size + nick_len:
+    raise ValueError("Truncated record file "+filename)
+  return (slicenum, timestamp, count, nick_len)
+
+def read_header(filename):
+  """Return (slicenum, timestamp) of the record file 'filename'."""
+  f = file(filename, "rb")
+  buf = f.read(HEADER.size)
+  size = os.fstat(f.fileno()).st_size
+  f.close()
+  return _unpack_header(buf, size, filename)[:2]
+
+def read_rows(filename):
+  """Return the records of 'filename' as a list of tuples in
+  sliceindex.LINE_FIELDS order."""
+  f = file(filename, "rb")
+  size = os.fstat(f.fileno()).st_size
+  if size == 0:
+    f.close()
+    raise ValueError("Truncated record file "+filename)
+  buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+  f.close()
+  try:
+    (slicenum, timestamp, count, nick_len) = \
+       _unpack_header(buf, size, filename)
+    start = HEADER.size + count*RECORD.size
+    nicks = buf[start:start+nick_len].split("\0")
+    rows = []
+    unpack = RECORD.unpack_from
+    for off in xrange(HEADER.size, start, RECORD.size):
+      (raw_id, nick, strm_bw, filt_bw, ns_bw, desc_bw, circ_fail_rate,
+       strm_fail_rate) = unpack(buf, off)
+      rows.append(("$"+raw_id.encode("hex").upper(), nicks[nick], strm_bw,
+                   filt_bw, ns_bw, desc_bw, circ_fail_rate, strm_fail_rate))
+  finally:
+    buf.close()
+  return rows
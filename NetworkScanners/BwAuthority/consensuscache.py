@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Local snapshot of the current consensus for aggregate.py
+
+"""
+ConsensusSnapshot
+
+aggregate.py needs three things from Tor: the consensus router list, the
+params and bandwidth-weights lines for ConsensusJunk, and descriptors for
+routers we did not measure. This parses the consensus document once,
+remembers the (down, bw) pairs of every descriptor looked up so far,
+keyed by idhex, and pickles it all into the data dir. Until the
+snapshot's fresh-until time passes no newer consensus can exist, so
+later runs in the same consensus period are served from the
+snapshot without talking to the control port.
+"""
+
+import calendar
+import copy
+import cPickle as pickle
+import hashlib
+import os
+import time
+
+from TorCtl.TorUtil import plog
+from TorCtl import TorCtl
+
+# Bump when the pickled layout changes so old snapshots get ignored
+SNAPSHOT_VERSION = 1
+
+# Descriptors requested per GETINFO when filling the snapshot
+DESC_BATCH_SIZE = 100
+
+def _parse_time(val):
+  return calendar.timegm(time.strptime(val, "%Y-%m-%d %H:%M:%S"))
+
+def _build_router(desc, ns):
+  """Same checks TorCtl.Connection.get_router() does on a descriptor it
+  fetched."""
+  if not desc:
+    return None
+  sig_start = desc.find("\nrouter-signature\n")+len("\nrouter-signature\n")
+  fp_base64 = hashlib.sha1(desc[:sig_start]).digest().encode("base64")[:-2]
+  if fp_base64 != ns.orhash:
+    plog("INFO", "Router descriptor for "+ns.idhex+" does not match ns fingerprint (NS @ "+str(ns.updated)+")")
+    return None
+  return TorCtl.Router.build_from_desc(desc.split("\n"), ns)
+
+def fetch_descriptors(c, ns_list, batch_size=DESC_BATCH_SIZE):
+  """Fetch the descriptors for every NetworkStatus in ns_list over the
+  control connection c, asking for batch_size of them per GETINFO
+  instead of one round trip each. Returns {idhex: TorCtl.Router}, with
+  None for routers Tor has no (matching) descriptor for."""
+  routers = {}
+  pending = [ns_list[i:i+batch_size]
+               for i in xrange(0, len(ns_list), batch_size)]
+  while pending:
+    batch = pending.pop()
+    try:
+      descs = c.get_info(["desc/id/"+ns.idhex for ns in batch])
+    except TorCtl.ErrorReply, e:
+      # Tor fails the whole GETINFO if it lacks any one descriptor. It
+      # usually names the key it choked on; otherwise split the batch
+      # until the missing ones are isolated.
+      bad = filter(lambda ns: "desc/id/"+ns.idhex+"\"" in str(e), batch)
+      if len(bad) == 1:
+        routers[bad[0].idhex] = None
+        batch.remove(bad[0])
+        if batch:
+          pending.append(batch)
+      elif len(batch) == 1:
+        routers[batch[0].idhex] = None
+      else:
+        pending.append(batch[:len(batch)/2])
+        pending.append(batch[len(batch)/2:])
+      continue
+    for ns in batch:
+      routers[ns.idhex] = _build_router(descs.get("desc/id/"+ns.idhex), ns)
+  return routers
+
+class RouterDesc:
+  """Just the parts of TorCtl.Router aggregate.py uses."""
+  def __init__(self, idhex, down, bw):
+    self.idhex = idhex
+    self.down = down
+    self.bw = bw
+
+class ConsensusSnapshot:
+  def __init__(self, cs_bytes):
+    self.version = SNAPSHOT_VERSION
+    self.valid_after = 0
+    self.fresh_until = 0
+    self.params = ""
+    self.bw_weights = ""
+    # idhex -> (down, bw), or None if Tor had no descriptor
+    self.descs = {}
+    self.dirty = True
+
+    for l in cs_bytes.split("\n"):
+      if l.startswith("valid-after "):
+        self.valid_after = _parse_time(l[len("valid-after "):].strip())
+      elif l.startswith("fresh-until "):
+        self.fresh_until = _parse_time(l[len("fresh-until "):].strip())
+      elif l.startswith("params "):
+        self.params = l.strip()
+      elif l.startswith("bandwidth-weights "):
+        self.bw_weights = l.strip()
+
+    # Same NetworkStatus objects get_network_status() would return, so
+    # TorCtl's get_router() accepts them
+    self.ns_list = TorCtl.parse_ns_body(cs_bytes)
+
+  def is_fresh(self, now=None):
+    if now is None:
+      now = time.time()
+    return self.valid_after <= now < self.fresh_until
+
+  def consensus_junk_text(self):
+    """The consensus lines ConsensusJunk parses."""
+    return self.params+"\n"+self.bw_weights+"\n"
+
+  def network_status(self):
+    """Return copies of the consensus NetworkStatus entries, in consensus
+    order. Callers may hang their own attributes off them."""
+    return map(copy.copy, self.ns_list)
+
+  def fetch_routers(self, ns_list, get_conn):
+    """Fill in the descriptors of every NetworkStatus in ns_list that is
+    not cached yet, in batches. get_router() is then served from the
+    cache."""
+    missing = filter(lambda ns: ns.idhex not in self.descs, ns_list)
+    if not missing:
+      return
+    t0 = time.time()
+    routers = fetch_descriptors(get_conn(), missing)
+    for (idhex, r) in routers.iteritems():
+      if r:
+        self.descs[idhex] = (r.down, r.bw)
+      else:
+        self.descs[idhex] = None
+    self.dirty = True
+    plog("INFO", "Fetched "+str(len(missing))+" descriptors in "+
+                 str(round(time.time()-t0, 2))+"s")
+
+  def get_router(self, ns, get_conn):
+    """Return a RouterDesc for the NetworkStatus 'ns', or None if Tor has
+    no descriptor for it. get_conn() is only called (to get a control
+    connection) if the descriptor is not cached yet."""
+    if ns.idhex not in self.descs:
+      try:
+        r = get_conn().get_router(ns)
+      except TorCtl.ErrorReply:
+        r = None
+      if r:
+        self.descs[ns.idhex] = (r.down, r.bw)
+      else:
+        self.descs[ns.idhex] = None
+      self.dirty = True
+    d = self.descs[ns.idhex]
+    if d is None:
+      return None
+    return RouterDesc(ns.idhex, d[0], d[1])
+
+  def save(self, filename):
+    if not self.dirty:
+      return
+    f = file(filename+".new", "wb")
+    pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    # atomic on POSIX
+    os.rename(filename+".new", filename)
+    self.dirty = False
+
+  @staticmethod
+  def load(filename):
+    """Return the snapshot stored in 'filename' if it is still fresh,
+    else None."""
+    try:
+      f = file(filename, "rb")
+      snapshot = pickle.load(f)
+      f.close()
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError), e:
+      if not isinstance(e, IOError):
+        plog("NOTICE", "Ignoring unreadable consensus snapshot: "+str(e))
+      return None
+    if getattr(snapshot, "version", None) != SNAPSHOT_VERSION:
+      return None
+    if not snapshot.is_fresh():
+      plog("INFO", "Consensus snapshot from "+
+                   time.asctime(time.gmtime(snapshot.valid_after))+
+                   " is stale")
+      return None
+    snapshot.dirty = False
+    return snapshot
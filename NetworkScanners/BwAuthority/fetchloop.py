@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# select() based fetch scheduler for bwauthority_child.py
+
+"""
+FetchLoop
+
+Runs many HTTP(S) GETs through a SOCKS5 proxy from a single thread. Each
+fetch is a small state machine (SOCKS handshake, TLS handshake, request,
+response) driven by one select() loop, which also runs timers and
+callbacks posted from other threads through a wakeup pipe. TorCtl's
+event thread uses that pipe to hand stream events to the loop, so the
+fetch state itself is only ever touched from the loop's thread.
+
+Redirects are followed on a new SOCKS connection, the way urllib2's
+HTTPRedirectHandler does. The response body is only counted, never kept.
+"""
+
+import errno
+import fcntl
+import heapq
+import os
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+import urlparse
+
+import tlscache
+
+RECV_SIZE = 65536
+MAX_HEADER_LEN = 16384
+
+# SOCKS5 reply codes
+SOCKS_TTL_EXPIRED = 6
+
+# The redirects urllib2 follows for a GET, and how many in a row
+REDIRECT_CODES = (301, 302, 303, 307)
+MAX_REDIRECTS = 10
+
+# States of a Fetch
+SOCKS_HELLO, SOCKS_CONNECT, TLS_HANDSHAKE, REQUEST, RESPONSE, DONE = range(6)
+
+class FetchError(Exception):
+  pass
+
+class Redirect(Exception):
+  def __init__(self, url):
+    Exception.__init__(self, url)
+    self.url = url
+
+class FetchLoop:
+  def __init__(self):
+    self.fetches = {} # fileno -> Fetch
+    self.timers = []  # heap of [when, seq, func]
+    # Every fetch receives into this one buffer
+    self.buf = bytearray(RECV_SIZE)
+    self.seq = 0
+    self.posted = []
+    self.posted_lock = threading.Lock()
+    (self.wake_r, self.wake_w) = os.pipe()
+    for fd in (self.wake_r, self.wake_w):
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+  def close(self):
+    os.close(self.wake_r)
+    os.close(self.wake_w)
+
+  def call_later(self, delay, func):
+    """Run func() from the loop after 'delay' seconds. Returns a handle for
+    cancel()."""
+    self.seq += 1
+    timer = [time.time()+delay, self.seq, func]
+    heapq.heappush(self.timers, timer)
+    return timer
+
+  def cancel(self, timer):
+    timer[2] = None
+
+  def call_from_thread(self, func):
+    """Run func() from the loop as soon as possible. Safe to call from any
+    thread."""
+    self.posted_lock.acquire()
+    self.posted.append(func)
+    self.posted_lock.release()
+    try:
+      os.write(self.wake_w, "x")
+    except OSError, e:
+      if e.errno != errno.EAGAIN: # Already awake
+        raise
+
+  def add(self, fetch):
+    self.fetches[fetch.fileno()] = fetch
+
+  def remove(self, fetch):
+    self.fetches.pop(fetch.fileno(), None)
+
+  def run_once(self, max_wait=None):
+    now = time.time()
+    while self.timers and (self.timers[0][2] is None or
+                           self.timers[0][0] <= now):
+      func = heapq.heappop(self.timers)[2]
+      if func: func()
+    wait = max_wait
+    if self.timers:
+      wait = max(0, self.timers[0][0] - now)
+      if max_wait is not None: wait = min(wait, max_wait)
+
+    readers = [self.wake_r]
+    writers = []
+    for (fd, fetch) in self.fetches.iteritems():
+      if fetch.wants_write(): writers.append(fd)
+      else: readers.append(fd)
+    try:
+      (readable, writable, _) = select.select(readers, writers, [], wait)
+    except select.error, e:
+      if e.args[0] == errno.EINTR: return
+      raise
+
+    if self.wake_r in readable:
+      try:
+        while os.read(self.wake_r, 512): pass
+      except OSError:
+        pass
+      self.posted_lock.acquire()
+      (posted, self.posted) = (self.posted, [])
+      self.posted_lock.release()
+      for func in posted:
+        func()
+    for fd in writable + readable:
+      fetch = self.fetches.get(fd)
+      if fetch and fetch.state != DONE:
+        fetch.step()
+
+class Fetch:
+  """One GET of 'url' through the SOCKS5 proxy at 'proxy' (host, port).
+  The proxy connection is made with socket class 'sockclass'. When the
+  fetch is over, done(fetch) is called from the loop; then 'ok' says
+  whether it succeeded like http_request() would have returned 1, and
+  'first_byte_at'/'last_byte_at'/'read_len' describe the body. HTTPS
+  fetches get their SSL context from the TLSCache 'tls', and
+  'handshake_time' is how long their handshake took. A redirect is
+  followed over a new proxy connection, and redirected(fetch) is called
+  once that is made."""
+  def __init__(self, loop, url, proxy, sockclass, user_agent, done,
+               tls=None, redirected=None):
+    self.loop = loop
+    self.proxy = proxy
+    self.sockclass = sockclass
+    self.user_agent = user_agent
+    self.done = done
+    self.redirected = redirected
+    self.tls = tls
+    self.started = time.time()
+    self.redirects = 0
+    self.ok = False
+    self.error = None
+    self.open(url)
+
+  def open(self, url):
+    self.url = url
+    self.first_byte_at = None
+    self.last_byte_at = None
+    self.read_len = 0
+    self.header_done = False
+    self.decl_length = None
+    self.handshake_time = None
+
+    parts = urlparse.urlsplit(url)
+    self.https = (parts.scheme == "https")
+    self.host = parts.hostname
+    self.port = parts.port or (self.https and 443 or 80)
+    path = parts.path or "/"
+    if parts.query: path += "?"+parts.query
+    self.request = "GET "+path+" HTTP/1.0\r\nHost: "+self.host+ \
+                   "\r\nUser-Agent: "+self.user_agent+"\r\n\r\n"
+
+    # Connecting to the local SOCKS port does not block for long, and it
+    # lets a SmartSocket record our source port before Tor sees the stream
+    self.raw = self.sockclass(socket.AF_INET, socket.SOCK_STREAM)
+    self.raw.connect(self.proxy)
+    self.raw.setblocking(0)
+    self.sock = self.raw
+    self.fd = self.raw.fileno()
+    self.out = "\x05\x01\x00"
+    self.inbuf = ""
+    self.want_write = False
+    self.state = SOCKS_HELLO
+    self.loop.add(self)
+
+  def fileno(self):
+    return self.fd
+
+  def wants_write(self):
+    return bool(self.out) or self.want_write
+
+  def abort(self, why):
+    if self.state != DONE:
+      self.finish(why)
+
+  def redirect(self, url):
+    self.redirects += 1
+    if self.redirects > MAX_REDIRECTS:
+      self.finish("More than "+str(MAX_REDIRECTS)+" redirects")
+      return
+    if urlparse.urlsplit(url).scheme not in ("http", "https"):
+      self.finish("Redirect to "+url+" not allowed")
+      return
+    self.loop.remove(self)
+    try:
+      self.sock.close()
+    except socket.error:
+      pass
+    try:
+      self.open(url)
+    except socket.error, e:
+      self.finish("Could not connect to the SOCKS port: "+str(e))
+      return
+    if self.redirected:
+      self.redirected(self)
+
+  def finish(self, error=None):
+    self.state = DONE
+    self.error = error
+    self.loop.remove(self)
+    try:
+      self.sock.close()
+    except socket.error:
+      pass
+    self.done(self)
+
+  def step(self):
+    try:
+      if self.out:
+        n = self.sock.send(self.out)
+        self.out = self.out[n:]
+        if self.out: return
+        if self.state == REQUEST:
+          self.state = RESPONSE
+        return
+      if self.state == TLS_HANDSHAKE:
+        self.handshake()
+      elif self.state in (SOCKS_HELLO, SOCKS_CONNECT):
+        self.socks_step()
+      elif self.state == RESPONSE:
+        self.read_response()
+    except ssl.SSLError, e:
+      if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+        self.want_write = False
+      elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+        self.want_write = True
+      elif self.state == RESPONSE and (e.args[0] == ssl.SSL_ERROR_EOF or
+                                       "EOF" in str(e).upper()):
+        # Servers that close without a TLS close_notify
+        try:
+          self.end_of_response()
+        except FetchError, e:
+          self.finish(str(e))
+      else:
+        self.finish("TLS error: "+str(e))
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+        self.finish("Socket error: "+str(e))
+    except FetchError, e:
+      self.finish(str(e))
+    except Redirect, e:
+      self.redirect(e.url)
+
+  def recv_exact(self, n):
+    data = self.sock.recv(n - len(self.inbuf))
+    if not data:
+      raise FetchError("SOCKS proxy closed the connection")
+    self.inbuf += data
+    if len(self.inbuf) < n:
+      return None
+    (data, self.inbuf) = (self.inbuf, "")
+    return data
+
+  def socks_step(self):
+    if self.state == SOCKS_HELLO:
+      reply = self.recv_exact(2)
+      if not reply: return
+      if reply != "\x05\x00":
+        raise FetchError("SOCKS proxy refused our greeting")
+      try:
+        addr = "\x01"+socket.inet_aton(self.host)
+      except socket.error:
+        addr = "\x03"+chr(len(self.host))+self.host
+      self.out = "\x05\x01\x00"+addr+struct.pack(">H", self.port)
+      self.state = SOCKS_CONNECT
+      return
+    # Tor always answers with an IPv4 address
+    reply = self.recv_exact(10)
+    if not reply: return
+    if reply[1] != "\x00":
+      if ord(reply[1]) == SOCKS_TTL_EXPIRED:
+        raise FetchError("Tor timed out our SOCKS stream request.")
+      raise FetchError("SOCKS error "+str(ord(reply[1])))
+    if self.https:
+      if not self.tls:
+        self.tls = tlscache.TLSCache()
+      self.sock = self.tls.wrap(self.raw, self.host)
+      self.state = TLS_HANDSHAKE
+      self.handshake_started = time.time()
+      self.handshake()
+    else:
+      self.out = self.request
+      self.state = REQUEST
+
+  def handshake(self):
+    self.sock.do_handshake()
+    self.handshake_time = time.time() - self.handshake_started
+    self.tls.handshake_done(self.handshake_time)
+    self.want_write = False
+    self.out = self.request
+    self.state = REQUEST
+
+  def read_response(self):
+    while True:
+      n = self.sock.recv_into(self.loop.buf)
+      if not n:
+        self.end_of_response()
+        return
+      now = time.time()
+      if not self.header_done:
+        self.read_header(str(self.loop.buf[:n]))
+      else:
+        if self.first_byte_at is None:
+          self.first_byte_at = now
+        self.read_len += n
+      self.last_byte_at = now
+      # TLS may hold more decrypted data than select() can see
+      if not (self.https and self.sock.pending()):
+        return
+
+  def read_header(self, data):
+    self.inbuf += data
+    end = self.inbuf.find("\r\n\r\n")
+    if end < 0:
+      if len(self.inbuf) > MAX_HEADER_LEN:
+        raise FetchError("Response header too long")
+      return
+    (header, body) = (self.inbuf[:end], self.inbuf[end+4:])
+    self.inbuf = ""
+    self.header_done = True
+    lines = header.split("\r\n")
+    status = lines[0].split()
+    if len(status) < 2 or not status[1].isdigit():
+      raise FetchError("Bad status line: "+lines[0])
+    self.status = int(status[1])
+    headers = {}
+    for l in lines[1:]:
+      (name, _, val) = l.partition(":")
+      headers[name.strip().lower()] = val.strip()
+    location = headers.get("location") or headers.get("uri")
+    if self.status in REDIRECT_CODES and location:
+      raise Redirect(urlparse.urljoin(self.url, location))
+    # Like urllib2, any other non-2xx answer is an HTTPError
+    if not 200 <= self.status < 300:
+      raise FetchError("HTTP error "+str(self.status))
+    self.decl_length = headers.get("content-length")
+    if body:
+      self.first_byte_at = time.time()
+      self.read_len += len(body)
+
+  def end_of_response(self):
+    if not self.header_done:
+      raise FetchError("Connection closed before the response header")
+    # Like urllib2's reply.read(), a short body still counts
+    self.ok = True
+    self.finish()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Per-phase wall/CPU time and memory accounting for aggregate.py
+
+"""
+PhaseStats
+
+Splits a run into named phases and records, for each one, the wall clock
+time, the CPU time (user+system, including child processes that were
+waited for) and the peak resident set size reached by the end of the
+phase. Arbitrary counters (files, lines, nodes, ...) can be attached.
+The result can be logged as one line or written out as JSON.
+"""
+
+import json
+import os
+import time
+
+try:
+  import resource
+except ImportError:
+  # Not on Windows; peak RSS is then just not reported
+  resource = None
+
+def _cpu():
+  t = os.times()
+  return t[0]+t[1]+t[2]+t[3]
+
+def _peak_rss():
+  # kB on Linux. Child processes count once they were reaped.
+  if not resource:
+    return None
+  return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class PhaseStats:
+  def __init__(self):
+    self.started = time.time()
+    self.phases = []
+    self.counts = {}
+    self.current = None
+
+  def start(self, name):
+    """End the running phase, if any, and start timing 'name'."""
+    self.stop()
+    self.current = (name, time.time(), _cpu())
+
+  def stop(self):
+    if not self.current:
+      return
+    (name, wall, cpu) = self.current
+    self.phases.append({"name": name,
+                        "wall": round(time.time()-wall, 3),
+                        "cpu": round(_cpu()-cpu, 3),
+                        "peak_rss_kb": _peak_rss()})
+    self.current = None
+
+  def count(self, key, val):
+    self.counts[key] = val
+
+  def as_dict(self):
+    self.stop()
+    return {"time": int(self.started),
+            "wall": round(time.time()-self.started, 3),
+            "peak_rss_kb": _peak_rss(),
+            "phases": self.phases,
+            "counts": self.counts}
+
+  def summary_line(self):
+    d = self.as_dict()
+    out = []
+    for p in d["phases"]:
+      out.append("%s=%.2fs/%.2fcpu" % (p["name"], p["wall"], p["cpu"]))
+    out.append("total=%.2fs" % d["wall"])
+    if d["peak_rss_kb"] is not None:
+      out.append("peak_rss=%dMB" % (d["peak_rss_kb"]/1024))
+    for k in sorted(self.counts.iterkeys()):
+      out.append("%s=%s" % (k, self.counts[k]))
+    return " ".join(out)
+
+  def write(self, filename):
+    f = file(filename+".tmp", "w")
+    json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+    f.write("\n")
+    f.close()
+    os.rename(filename+".tmp", filename)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Offline what-if replay of the aggregate.py PID controller
+
+"""
+PID Replay
+
+Reruns the aggregate.py PID feedback over an archive of past slice files,
+once per aggregation round, for one or more alternate sets of consensus
+params (bwauthkp, bwauthti, bwauthtd, bwauthtidecay, bwauthguardrate, ...).
+Round times come from archived vote files (data/bwscan.YYYYMMDD-HHMM as
+written by cron.sh); the oldest one seeds the controller's previous votes.
+
+Each round only sees the slice files whose measurement timestamp is not
+newer than the round and not older than MAX_AGE, just like the live
+aggregation would have. Without a live Tor there is no consensus to take
+flags from, so pass --consensus=<cached-consensus> to get Guard/Exit
+classes; otherwise every node is treated as a Middle.
+
+Usage:
+  ./pidreplay.py [--consensus=FILE] [--params="bwauthkp=..."]...
+                 [--out=DIR] [--loglevel=LEVEL] <scan data dir> <vote file>...
+
+Each --params is one parameter set, written like a consensus params line.
+The params line of --consensus (or the aggregate.py defaults) is used if
+none are given. Per-round trajectories go to --out, one directory per
+parameter set, and a convergence summary is printed for each set.
+"""
+
+import getopt
+import os
+import re
+import sys
+import time
+
+sys.path.append("../../")
+from TorCtl import TorUtil
+from TorCtl.TorUtil import plog
+
+import aggregate
+import bwrecords
+from aggregate import Node, Vote, ConsensusJunk
+from consensuscache import ConsensusSnapshot
+
+class ReplayRouter:
+  def __init__(self, idhex, nickname, flags=None, bandwidth=None):
+    self.idhex = idhex
+    self.nickname = nickname
+    self.flags = flags or []
+    self.bandwidth = bandwidth
+
+class ReplayVotes:
+  # Stands in for aggregate.VoteSet; pid_feedback() only uses vote_map
+  def __init__(self, vote_map):
+    self.vote_map = vote_map
+
+def round_time(vote_file):
+  # cron.sh archives votes as bwscan.YYYYMMDD-HHMM (local time)
+  m = re.search("(\d{8}-\d{4})$", vote_file)
+  if m:
+    return time.mktime(time.strptime(m.group(1), "%Y%m%d-%H%M"))
+  return os.stat(vote_file).st_mtime
+
+def load_votes(vote_file):
+  vote_map = {}
+  f = file(vote_file, "r")
+  f.readline()
+  for l in f:
+    vote = Vote(l)
+    vote_map[vote.idhex] = vote
+  f.close()
+  return vote_map
+
+def load_measurements(datadir):
+  """Return [(timestamp, [Line])] for every slice file under datadir,
+  oldest first. Nothing is deleted."""
+  bw_files = []
+  aggregate.find_slice_files([datadir], bw_files, max_age=None)
+  slices = []
+  for (s, t, f) in bw_files:
+    if os.path.basename(f).startswith("bwr-"):
+      slices.append((t, [aggregate.Line.from_row(r, s, t)
+                           for r in bwrecords.read_rows(f)]))
+      continue
+    fp = file(f, "r")
+    fp.readline() # slicenum
+    fp.readline() # timestamp
+    slices.append((t, list(aggregate.read_slice_lines(fp, s, t))))
+    fp.close()
+  slices.sort(key=lambda x: x[0])
+  return slices
+
+class Replay:
+  def __init__(self, name, cs_junk, slices, rounds, seed_votes,
+               consensus=None):
+    self.name = name
+    self.cs_junk = cs_junk
+    self.slices = slices
+    self.rounds = rounds
+    self.seed_votes = seed_votes
+    self.consensus = consensus
+    self.trajectory = [] # [(round time, {idhex: Vote})]
+    self.metrics = []
+
+  def run(self):
+    latest = {} # idhex -> newest Line seen so far
+    next_slice = 0
+    prev_votes = self.seed_votes
+    for (rnd, (t, hist_votes)) in enumerate(self.rounds):
+      while next_slice < len(self.slices) and self.slices[next_slice][0] <= t:
+        for l in self.slices[next_slice][1]:
+          if l.idhex not in latest or l.measured_at > latest[l.idhex].measured_at:
+            latest[l.idhex] = l
+        next_slice += 1
+      nodes = {}
+      for l in latest.itervalues():
+        if t - l.measured_at <= aggregate.MAX_AGE:
+          n = Node()
+          n.add_line(l)
+          nodes[l.idhex] = n
+      if not nodes:
+        continue
+      prev_consensus = self.prev_consensus(nodes)
+      votes = self.step(nodes, prev_votes, prev_consensus)
+      self.trajectory.append((t, votes))
+      self.metrics.append(self.round_metrics(rnd, t, nodes, votes,
+                                             prev_votes, hist_votes))
+      prev_votes = votes
+
+  def prev_consensus(self, nodes):
+    if self.consensus:
+      return self.consensus
+    return dict((idhex, ReplayRouter(idhex, n.nick, [], n.ns_bw/1000))
+                  for (idhex, n) in nodes.iteritems())
+
+  def step(self, nodes, prev_votes, prev_consensus):
+    cs_junk = self.cs_junk
+    for n in nodes.itervalues():
+      if n.idhex in prev_consensus:
+        n.flags = prev_consensus[n.idhex].flags
+    avgs = aggregate.class_averages(nodes, cs_junk)
+    aggregate.pid_feedback(nodes, cs_junk, ReplayVotes(prev_votes),
+                           prev_consensus, *avgs)
+    tot_net_bw = 0
+    for n in nodes.itervalues():
+      if n.idhex in prev_consensus and \
+         prev_consensus[n.idhex].bandwidth != None:
+        tot_net_bw += n.new_bw
+    aggregate.mark_ignored(nodes, prev_consensus)
+    aggregate.clip_votes(nodes, cs_junk, prev_consensus, tot_net_bw)
+    # Round-trip through the vote file format, so the next round sees
+    # exactly what it would have read back from disk
+    return dict((n.idhex, Vote(aggregate.vote_line(n)))
+                  for n in nodes.itervalues() if not n.ignore)
+
+  def round_metrics(self, rnd, t, nodes, votes, prev_votes, hist_votes):
+    errs = [n.pid_error for n in nodes.itervalues()]
+    churn = [abs(v.bw - prev_votes[i].bw)/float(prev_votes[i].bw)
+               for (i, v) in votes.iteritems()
+               if i in prev_votes and prev_votes[i].bw > 0]
+    hist = [abs(v.bw - hist_votes[i].bw)/float(hist_votes[i].bw)
+               for (i, v) in votes.iteritems()
+               if i in hist_votes and hist_votes[i].bw > 0]
+    return {"round": rnd,
+            "time": int(t),
+            "nodes": len(nodes),
+            "total_bw": sum(v.bw for v in votes.itervalues()),
+            "mean_pid_error": sum(errs)/len(errs),
+            "mean_abs_pid_error": sum(map(abs, errs))/len(errs),
+            "mean_bw_churn": churn and sum(churn)/len(churn) or 0.0,
+            "mean_hist_diff": hist and sum(hist)/len(hist) or 0.0}
+
+  def summary(self):
+    if not self.metrics:
+      return {"name": self.name, "rounds": 0}
+    final = self.metrics[-1]["mean_abs_pid_error"]
+    # First round after which mean |pid_error| stays within 10% of its
+    # final value
+    settled = len(self.metrics)-1
+    for m in reversed(self.metrics):
+      if abs(m["mean_abs_pid_error"] - final) > 0.1*final:
+        break
+      settled = m["round"]
+    churn = [m["mean_bw_churn"] for m in self.metrics[1:]]
+    return {"name": self.name,
+            "rounds": len(self.metrics),
+            "settled_round": settled,
+            "final_mean_abs_pid_error": final,
+            "mean_bw_churn": churn and sum(churn)/len(churn) or 0.0,
+            "final_hist_diff": self.metrics[-1]["mean_hist_diff"]}
+
+  def write(self, outdir):
+    d = outdir+"/"+re.sub("[^\w=.,-]+", "_", self.name)
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    for (t, votes) in self.trajectory:
+      out = file(d+"/bwscan."+time.strftime("%Y%m%d-%H%M",
+                                            time.localtime(t)), "w")
+      out.write(str(int(t))+"\n")
+      for v in votes.itervalues():
+        out.write("node_id=%s bw=%d nick=%s measured_at=%d updated_at=%d"
+                  " pid_error=%s pid_error_sum=%s pid_bw=%d pid_delta=%s\n"
+                  % (v.idhex, v.bw, v.nick, v.measured_at, v.updated_at,
+                     v.pid_error, v.pid_error_sum, v.pid_bw, v.pid_delta))
+      out.close()
+    keys = ["round", "time", "nodes", "total_bw", "mean_pid_error",
+            "mean_abs_pid_error", "mean_bw_churn", "mean_hist_diff"]
+    out = file(d+"/metrics.csv", "w")
+    out.write(",".join(keys)+"\n")
+    for m in self.metrics:
+      out.write(",".join(str(m[k]) for k in keys)+"\n")
+    out.close()
+
+def usage(argv):
+  print "Usage: "+argv[0]+" [--consensus=FILE] [--params=\"bwauthkp=...\"]..."
+  print "         [--out=DIR] [--loglevel=LEVEL] <scan data dir> <vote file>..."
+
+def main(argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "",
+                    ["consensus=", "params=", "out=", "loglevel="])
+  except getopt.GetoptError, e:
+    print str(e)
+    usage(argv)
+    sys.exit(1)
+  if len(args) < 2:
+    usage(argv)
+    sys.exit(1)
+
+  consensus_file = None
+  param_sets = []
+  outdir = None
+  TorUtil.loglevel = "WARN"
+  for (flag, val) in opts:
+    if flag == "--consensus":
+      consensus_file = val
+    elif flag == "--params":
+      param_sets.append(val)
+    elif flag == "--out":
+      outdir = val
+    elif flag == "--loglevel":
+      TorUtil.loglevel = val
+
+  weights = ""
+  consensus = None
+  if consensus_file:
+    snapshot = ConsensusSnapshot(file(consensus_file, "r").read())
+    weights = snapshot.bw_weights
+    consensus = dict(("$"+ns.idhex, ns) for ns in snapshot.ns_list)
+    if not param_sets:
+      param_sets.append(snapshot.params[len("params "):])
+  if not param_sets:
+    # Not a real param; just something for ConsensusJunk to parse
+    param_sets.append("bwauthpid=1")
+
+  vote_files = sorted(args[1:], key=round_time)
+  rounds = [(round_time(f), load_votes(f)) for f in vote_files]
+  seed_votes = rounds[0][1]
+  slices = load_measurements(args[0])
+  plog("NOTICE", "Replaying "+str(len(rounds)-1)+" rounds over "+
+                 str(len(slices))+" slice files")
+
+  for params in param_sets:
+    cs_junk = ConsensusJunk(None, "params "+params+"\n"+weights+"\n")
+    replay = Replay(params, cs_junk, slices, rounds[1:],
+                    seed_votes, consensus)
+    t0 = time.time()
+    replay.run()
+    s = replay.summary()
+    print "%s: %d rounds in %.2fs" % (s["name"], s["rounds"], time.time()-t0)
+    if s["rounds"]:
+      print "  settled after round %d, final mean |pid_error| %.4f" % \
+            (s["settled_round"], s["final_mean_abs_pid_error"])
+      print "  mean vote churn per round %.4f, final diff vs. history %.4f" % \
+            (s["mean_bw_churn"], s["final_hist_diff"])
+    if outdir:
+      replay.write(outdir)
+
+if __name__ == "__main__":
+  main(sys.argv)
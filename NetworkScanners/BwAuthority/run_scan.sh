@@ -36,8 +36,9 @@ done
 sleep 5
 
 # FIXME: We resume in a ghetto way by saving the bws-*done* files.
-# A more accurate resume could be implemented in bwauthority.py
-find data/scanner.* -name .svn -prune -o -type f -a ! -name '*-done-*' -a ! -name bwauthority.cfg -a ! -name .gitignore -exec rm {} +
+# With checkpoint_every set, bwauthority.py also resumes the interrupted
+# slice from its slice-journal and the *-ckpt-* files.
+find data/scanner.* -name .svn -prune -o -type f -a ! -name '*-done-*' -a ! -name '*-ckpt-*' -a ! -name slice-journal -a ! -name bwauthority.cfg -a ! -name .gitignore -exec rm {} +
 
 for n in `seq $TOR_COUNT`; do
 	rm -f ./data/tor.${n}/tor.log
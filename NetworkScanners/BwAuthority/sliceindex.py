@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Persistent index of already-parsed slice files for aggregate.py
+
+"""
+SliceIndex
+
+aggregate.py runs every hour over weeks of bws-*-done-* files, nearly all
+of which are unchanged since the previous run. This index remembers the
+header (slicenum, timestamp) and the per-node measurement rows of every
+slice file it has seen, keyed by path, mtime and size, so a rerun only has
+to open and parse the slices that finished since last time. Entries for
+files that disappeared (or were aged out by MAX_AGE) are dropped by
+expire().
+"""
+
+import os
+import sqlite3
+
+from TorCtl.TorUtil import plog
+
+# Bump this whenever the table layout or the meaning of a column changes.
+# Older index files are then thrown away and rebuilt from the slice files.
+INDEX_VERSION = 1
+
+# Column order of the rows returned by get_lines() and taken by store()
+LINE_FIELDS = ("idhex", "nick", "strm_bw", "filt_bw", "ns_bw", "desc_bw",
+               "circ_fail_rate", "strm_fail_rate")
+
+class SliceIndex:
+  def __init__(self, filename):
+    self.filename = filename
+    # Paths whose cached entry matched the file on disk this run
+    self.fresh = set()
+    # Every path the caller asked about this run, fresh or not
+    self.seen = set()
+    self.hits = 0
+    self.misses = 0
+    try:
+      self._open()
+    except sqlite3.DatabaseError, e:
+      plog("WARN", "Slice index "+filename+" is unusable ("+str(e)+
+                   "). Rebuilding it.")
+      os.remove(filename)
+      self._open()
+
+  def _open(self):
+    self.conn = sqlite3.connect(self.filename)
+    self.conn.text_factory = str
+    cur = self.conn.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version != INDEX_VERSION:
+      cur.execute("DROP TABLE IF EXISTS slices")
+      cur.execute("DROP TABLE IF EXISTS lines")
+    cur.execute("CREATE TABLE IF NOT EXISTS slices (path TEXT PRIMARY KEY,"
+                " mtime REAL, size INTEGER, slicenum TEXT, timestamp REAL)")
+    cur.execute("CREATE TABLE IF NOT EXISTS lines (path TEXT, idhex TEXT,"
+                " nick TEXT, strm_bw INTEGER, filt_bw INTEGER,"
+                " ns_bw INTEGER, desc_bw INTEGER, circ_fail_rate REAL,"
+                " strm_fail_rate REAL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS lines_path ON lines (path)")
+    cur.execute("PRAGMA user_version = %d" % INDEX_VERSION)
+    self.conn.commit()
+
+  def lookup(self, path, st):
+    """Return the cached (slicenum, timestamp) header of 'path' if the
+    index entry still matches the os.stat() result 'st', else None."""
+    self.seen.add(path)
+    row = self.conn.execute("SELECT mtime, size, slicenum, timestamp"
+                            " FROM slices WHERE path = ?", (path,)).fetchone()
+    if row and row[0] == st.st_mtime and row[1] == st.st_size:
+      self.fresh.add(path)
+      self.hits += 1
+      return (row[2], row[3])
+    self.misses += 1
+    return None
+
+  def get_lines(self, path):
+    """Return the cached measurement rows of 'path' as tuples ordered
+    like LINE_FIELDS, or None if the file has to be parsed again."""
+    if path not in self.fresh:
+      return None
+    return self.conn.execute("SELECT "+", ".join(LINE_FIELDS)+
+                             " FROM lines WHERE path = ?", (path,)).fetchall()
+
+  def store(self, path, st, slicenum, timestamp, rows):
+    """Replace the entry for 'path' with a freshly parsed header and
+    measurement rows. Committed by close()."""
+    self.seen.add(path)
+    self.conn.execute("DELETE FROM lines WHERE path = ?", (path,))
+    self.conn.execute("INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?, ?)",
+                      (path, st.st_mtime, st.st_size, slicenum, timestamp))
+    self.conn.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          ((path,)+tuple(r) for r in rows))
+    self.fresh.add(path)
+
+  def forget(self, path):
+    """Stop tracking 'path' this run, e.g. because its file was removed.
+    Its entry is dropped by the next expire()."""
+    self.seen.discard(path)
+    self.fresh.discard(path)
+
+  def expire(self):
+    """Drop every entry whose path was not looked up or stored this run."""
+    stale = [r[0] for r in self.conn.execute("SELECT path FROM slices")
+                  if r[0] not in self.seen]
+    for path in stale:
+      self.conn.execute("DELETE FROM lines WHERE path = ?", (path,))
+      self.conn.execute("DELETE FROM slices WHERE path = ?", (path,))
+    if stale:
+      plog("INFO", "Expired "+str(len(stale))+" slice files from the index")
+    return len(stale)
+
+  def close(self):
+    self.conn.commit()
+    self.conn.close()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Crash-safe slice progress journal for bwauthority.py/bwauthority_child.py
+
+"""
+SliceJournal
+
+An append-only log, one JSON record per line, of the slices a scanner
+works on:
+
+  {"event": "start", "slice": 3, "lo": 9.5, "hi": 12.0, "run": "...", ...}
+  {"event": "checkpoint", "slice": 3, "file": ".../bws-...-ckpt-...",
+   "successful": 40, "attempt": 52, "routers": 31, "run": "...", ...}
+  {"event": "finish", "slice": 3, "file": ".../bws-...-done-...", ...}
+  {"event": "scan_done", ...}
+
+Every record is fsync()ed before the writer carries on, and a torn last
+line from a crash is ignored on replay. When a slice finishes, the
+journal is compacted down to that one record.
+
+bwauthority.py uses resume_slice() to carry on with the slice a killed
+child was working on, instead of starting over at slice 0. The child
+uses interrupted_progress() to skip the routers an earlier, killed run of
+the same slice already measured, and interrupted_checkpoints() to keep
+that run's last checkpoint, so those measurements are not lost.
+"""
+
+import json
+import os
+import re
+import time
+
+JOURNAL_NAME = "slice-journal"
+
+NODE_ID_RE = re.compile(r"node_id=\$?([0-9A-Fa-f]{40})")
+
+class SliceJournal:
+  def __init__(self, out_dir):
+    self.filename = out_dir+"/"+JOURNAL_NAME
+    # Tells checkpoints of this process apart from those of earlier runs
+    self.run = str(os.getpid())+"-"+str(int(time.time()))
+    self.repaired = False
+
+  def repair(self):
+    # Cut off a torn last line, so that what we append can be read back
+    try:
+      f = file(self.filename, "r+")
+    except IOError:
+      return
+    data = f.read()
+    if data and not data.endswith("\n"):
+      f.truncate(data.rfind("\n")+1)
+    f.close()
+
+  def records(self):
+    try:
+      f = file(self.filename, "r")
+    except IOError:
+      return []
+    records = []
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        # Torn write from a crash. Nothing valid can follow it.
+        break
+    f.close()
+    return records
+
+  def append(self, event, **fields):
+    if not self.repaired:
+      self.repair()
+      self.repaired = True
+    fields["event"] = event
+    fields["time"] = time.time()
+    f = file(self.filename, "a")
+    f.write(json.dumps(fields, sort_keys=True)+"\n")
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+  def compact(self, record):
+    tmp = self.filename+".tmp"
+    f = file(tmp, "w")
+    f.write(json.dumps(record, sort_keys=True)+"\n")
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp, self.filename)
+
+  def start_slice(self, slice_num, lo, hi):
+    self.append("start", slice=slice_num, lo=lo, hi=hi, run=self.run)
+
+  def checkpoint(self, slice_num, filename, successful, attempt, routers):
+    self.append("checkpoint", slice=slice_num, file=filename,
+                successful=successful, attempt=attempt, routers=routers,
+                run=self.run)
+
+  def finish_slice(self, slice_num, filename):
+    self.compact({"event": "finish", "slice": slice_num, "file": filename,
+                  "time": time.time()})
+
+  def scan_done(self):
+    self.compact({"event": "scan_done", "time": time.time()})
+
+  def resume_slice(self):
+    """The slice to run next: the one that was started but never
+    finished, or the one after the last finished slice."""
+    records = self.records()
+    if not records:
+      return 0
+    last = records[-1]
+    if last["event"] == "scan_done":
+      return 0
+    if last["event"] == "finish":
+      return last["slice"] + 1
+    return last["slice"]
+
+  def interrupted_runs(self, slice_num):
+    """The last checkpoint record of every earlier run that was killed
+    while measuring 'slice_num'. Each checkpoint of a run contains
+    everything that run measured up to then, so only the last one is
+    needed."""
+    last = {}
+    for r in self.records():
+      if r["event"] == "checkpoint" and r["slice"] == slice_num and \
+         r["run"] != self.run:
+        last[r["run"]] = r
+      elif r["event"] in ("finish", "scan_done"):
+        last = {}
+    return last.values()
+
+  def interrupted_checkpoints(self, slice_num):
+    return [r["file"] for r in self.interrupted_runs(slice_num)]
+
+  def interrupted_progress(self, slice_num):
+    """(routers, successful, attempt) of the killed runs of 'slice_num':
+    the idhexes in their last checkpoints, which only list routers with
+    min_streams closed streams, and the fetch counts to carry on from.
+    A restarted run counts on from the checkpoint it resumed, so the
+    largest counts are the latest."""
+    routers = set()
+    successful = 0
+    attempt = 0
+    for r in self.interrupted_runs(slice_num):
+      successful = max(successful, r["successful"])
+      attempt = max(attempt, r["attempt"])
+      try:
+        f = file(r["file"], "r")
+      except IOError:
+        continue
+      for line in f:
+        m = NODE_ID_RE.search(line)
+        if m:
+          routers.add(m.group(1).upper())
+      f.close()
+    return (routers, successful, attempt)
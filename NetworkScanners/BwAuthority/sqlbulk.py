@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Batched SQLSupport writes and bulk bws export for bwauthority_child.py
+
+"""
+SQLBulk
+
+SQLSupport's StreamListener commits (and closes its session) after every
+event it handles, so a slice commits once per stream and circuit event.
+BatchedListener sits in its place in the handler's listener list. It
+queues the events and replays a batch at a time, with commit() and
+remove() on the session turned into flush() and a no-op while it does,
+so each batch is one transaction.
+
+write_bws() writes a bws- file like SQLSupport.RouterStats.write_bws()
+with recompute=False, but loads every router together with its stats in
+one query instead of one query per router.
+"""
+
+import time
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from TorCtl import SQLSupport
+
+# Flush a batch when it is this many events or this many seconds old
+BATCH_EVENTS = 500
+BATCH_SECS = 5.0
+
+class BatchedListener:
+  def __init__(self, listener, max_events=BATCH_EVENTS, max_secs=BATCH_SECS):
+    self.listener = listener
+    self.max_events = max_events
+    self.max_secs = max_secs
+    self.events = []
+    self.first_at = None
+    self.flushes = 0
+
+  def __getattr__(self, name):
+    # parent_handler and friends stay the wrapped listener's
+    return getattr(self.listener, name)
+
+  def listen(self, event):
+    if not self.events:
+      self.first_at = time.time()
+    self.events.append(event)
+    if len(self.events) >= self.max_events or \
+       time.time() - self.first_at >= self.max_secs:
+      self.flush()
+
+  def flush(self):
+    """Hand the queued events to the listener in one transaction. Must run
+    in the thread the listener runs in."""
+    if not self.events:
+      return
+    (events, self.events) = (self.events, [])
+    session = SQLSupport.tc_session
+    (commit, remove) = (session.commit, session.remove)
+    session.commit = session.flush
+    session.remove = lambda: None
+    try:
+      for event in events:
+        self.listener.listen(event)
+    finally:
+      (session.commit, session.remove) = (commit, remove)
+    commit()
+    remove()
+    self.flushes += 1
+
+def cvt(a, b, c=1):
+  # As in RouterStats.write_bws()
+  if type(a) == float: return int(round(a/c,b))
+  elif type(a) == int: return a
+  elif type(a) == type(None): return "None"
+  else: return type(a)
+
+def eager(relation):
+  # joinedload() was called eagerload() before SQLAlchemy 0.6
+  load = getattr(sqlalchemy.orm, "joinedload", None) or \
+           sqlalchemy.orm.eagerload
+  return load(relation)
+
+def write_bws(f, stats_filter=None, order_by=None):
+  """Write the bws- lines for the RouterStats rows matching
+  'stats_filter' to f, after its slicenum line."""
+  if order_by is None:
+    order_by = SQLSupport.RouterStats.sbw
+  session = SQLSupport.tc_session()
+  q = session.query(SQLSupport.RouterStats).options(eager("router"))
+  if stats_filter is not None:
+    q = q.filter(stats_filter)
+  lines = [str(int(time.time()))+"\n"]
+  for s in q.order_by(order_by).all():
+    lines.append("node_id=$"+s.router.idhex+" nick="+s.router.nickname+
+                 " strm_bw="+str(cvt(s.sbw,0))+
+                 " filt_bw="+str(cvt(s.filt_sbw,0))+
+                 " circ_fail_rate="+str(s.circ_to_rate)+
+                 " desc_bw="+str(int(cvt(s.avg_desc_bw,0)))+
+                 " ns_bw="+str(int(cvt(s.avg_bw,0)))+"\n")
+  f.writelines(lines)
+  f.flush()
+  SQLSupport.tc_session.remove()
+  return len(lines)-1
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Shared SSL context and TLS handshake timing for bwauthority_child.py
+
+"""
+TLSCache
+
+Every fetch goes over a new circuit, so a new TCP connection and a full
+TLS handshake with the bwfile host are unavoidable. What can be shared
+between fetches is the SSL context, built once instead of once per
+fetch.
+
+The time each handshake takes is measured separately from the rest of
+the fetch. take_stats() hands out the totals for the slice.
+"""
+
+import ssl
+import threading
+import time
+
+def make_context():
+  try:
+    return ssl._create_unverified_context()
+  except AttributeError:
+    # Before 2.7.9 urllib2 and wrap_socket() do not take a context
+    return None
+
+class TLSCache:
+  def __init__(self):
+    self.context = make_context()
+    self.lock = threading.Lock()
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.handshakes = 0
+    self.handshake_time = 0.0
+
+  def wrap(self, sock, host):
+    """Wrap a connected socket for 'host' without doing the handshake."""
+    if self.context:
+      return self.context.wrap_socket(sock, server_hostname=host,
+                                      do_handshake_on_connect=False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+  def handshake_done(self, elapsed):
+    """Account a finished handshake."""
+    self.lock.acquire()
+    self.handshakes += 1
+    self.handshake_time += elapsed
+    self.lock.release()
+
+  def handshake(self, sock, host):
+    """Wrap a connected, blocking socket and do the handshake. Returns
+    (SSL socket, handshake seconds)."""
+    ssl_sock = self.wrap(sock, host)
+    t0 = time.time()
+    ssl_sock.do_handshake()
+    elapsed = time.time()-t0
+    self.handshake_done(elapsed)
+    return (ssl_sock, elapsed)
+
+  def take_stats(self):
+    """(handshakes, total handshake seconds) since the last call."""
+    self.lock.acquire()
+    stats = (self.handshakes, self.handshake_time)
+    self.reset_stats()
+    self.lock.release()
+    return stats
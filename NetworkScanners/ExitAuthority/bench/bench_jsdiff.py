@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Benchmark compare_js's JSDiffer with and without the AST count cache, on
+# a corpus of scripts. Run from the ExitAuthority directory, as soat.py is:
+#
+#   ./bench/bench_jsdiff.py [--rounds=N] <script or dir> [...]
+#
+# Directories are searched for .js files. Each script is compared against
+# a copy with its numbers changed, as a dynamic script fetched through an
+# exit would be.
+
+import getopt
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+from libsoat import JSDiffer
+
+def find_scripts(paths):
+  scripts = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        for f in files:
+          if f.endswith(".js"):
+            scripts.append(os.path.join(root, f))
+    else:
+      scripts.append(path)
+  return scripts
+
+def vary(js_string):
+  return re.sub("[0-9]+", lambda m: str(int(m.group(0))+1), js_string)
+
+def timed(func):
+  t0 = time.time()
+  ret = func()
+  return (ret, time.time()-t0)
+
+def main(argv):
+  try:
+    (optlist, args) = getopt.getopt(argv[1:], "", ["rounds="])
+  except getopt.GetoptError, e:
+    print str(e)
+    args = []
+  if not args:
+    print "Usage: "+argv[0]+" [--rounds=N] <script or dir> [...]"
+    sys.exit(1)
+  rounds = 3
+  for (o, a) in optlist:
+    if o == "--rounds":
+      rounds = int(a)
+
+  scripts = find_scripts(args)
+  cache_dir = tempfile.mkdtemp(prefix="bench_jsdiff")
+  totals = {"uncached": 0.0, "cold": 0.0, "cached": 0.0}
+  size = 0
+  mismatches = 0
+  try:
+    for (i, script) in enumerate(scripts):
+      f = file(script)
+      old = f.read()
+      f.close()
+      new = vary(old)
+      size += len(old)
+      cache_file = os.path.join(cache_dir, str(i)+".jscounts")
+
+      (uncached, t) = timed(lambda: [JSDiffer(old).contains_differences(new)
+                                      for r in xrange(rounds)])
+      totals["uncached"] += t
+      (cold, t) = timed(lambda: JSDiffer(old,
+                                   cache_file).contains_differences(new))
+      totals["cold"] += t
+      (cached, t) = timed(lambda: [JSDiffer(old,
+                                     cache_file).contains_differences(new)
+                                    for r in xrange(rounds)])
+      totals["cached"] += t
+      if uncached != cached or uncached[0] != cold:
+        print "Different result for "+script
+        mismatches += 1
+  finally:
+    shutil.rmtree(cache_dir)
+
+  compares = len(scripts)*rounds
+  print "%d scripts, %d KB, %d compares each way" % (len(scripts), size/1024,
+                                                      compares)
+  print "%-10s %8.1f ms/compare" % ("uncached", 1000*totals["uncached"]/compares)
+  print "%-10s %8.1f ms/compare" % ("cold", 1000*totals["cold"]/len(scripts))
+  print "%-10s %8.1f ms/compare" % ("cached", 1000*totals["cached"]/compares)
+  if mismatches:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -11,11 +11,20 @@ import re
 import socket
 import struct
 import sys
+import threading
 import time
 import traceback
 
 if sys.version_info < (2, 5):
     from sets import Set as set
+    from sha import sha
+else:
+    from hashlib import sha1 as sha
+
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
 
 from OpenSSL import crypto
 
@@ -44,7 +53,7 @@ __all__ = [ # Classes
            "LoggingJSParser", "LoggingJSLexer", "TestResult", "SSLTestResult", "SSLDomain", "HttpTestResult",
            "CookieTestResult", "JsTestResult", "HtmlTestResult", "SSHTestResult", "DNSTestResult",
            "DNSRebindTestResult", "SMTPTestResult", "IMAPTestResult", "POPTestResult", "DataHandler",
-           "SnakePickler", "SoupDiffer", "HeaderDiffer", "JSDiffer", "JSSoupDiffer",
+           "ResultStore", "SnakePickler", "TestJournal", "SoupSets", "SoupDiffer", "HeaderDiffer", "JSDiffer", "JSSoupDiffer",
             # Functions
            "FullyStrainedSoup",
             # Constants
@@ -613,9 +622,142 @@ class POPTestResult(TestResult):
     super(POPTestResult, self).__init__(exit_obj, pop_site, status)
     self.proto = "pop"
 
+class ResultStore:
+  """ The test results of a data dir in one sqlite table, with a column
+      for each field that results are looked up by and the pickled result
+      in a blob. The .result filename a result would have been saved under
+      is its key. """
+  _schema = """
+    CREATE TABLE IF NOT EXISTS results (
+      filename TEXT PRIMARY KEY,
+      proto TEXT,
+      test_class TEXT,
+      exit_node TEXT,
+      site TEXT,
+      status INTEGER,
+      reason TEXT,
+      timestamp REAL,
+      finish_timestamp REAL,
+      result BLOB);
+    CREATE INDEX IF NOT EXISTS results_exit ON results(exit_node);
+    CREATE INDEX IF NOT EXISTS results_site ON results(site);
+    CREATE INDEX IF NOT EXISTS results_class ON results(test_class, status);
+    CREATE INDEX IF NOT EXISTS results_proto ON results(proto, status);
+    CREATE INDEX IF NOT EXISTS results_reason ON results(reason);
+    CREATE INDEX IF NOT EXISTS results_time ON results(timestamp);
+  """
+  _stores = {}
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.created = not os.path.exists(filename)
+    self.lock = threading.Lock()
+    # soat's worker threads share the connection, under self.lock
+    self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.executescript(self._schema)
+
+  def open(filename):
+    """ One store per database file, shared by all DataHandlers """
+    filename = os.path.normpath(filename)
+    if filename not in ResultStore._stores:
+      ResultStore._stores[filename] = ResultStore(filename)
+    return ResultStore._stores[filename]
+  open = Callable(open)
+
+  def _row(self, result):
+    return (result.filename, result.proto.lower(),
+            result.__class__.__name__, result.exit_node, result.site,
+            result.status, result.reason, result.timestamp,
+            result.finish_timestamp,
+            sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+
+  def save(self, result):
+    self.saveMany([result])
+
+  def saveMany(self, results):
+    rows = map(self._row, results)
+    self.lock.acquire()
+    try:
+      self.db.executemany("INSERT OR REPLACE INTO results VALUES "+
+                          "(?,?,?,?,?,?,?,?,?,?)", rows)
+      self.db.commit()
+    finally:
+      self.lock.release()
+
+  def has(self, filename):
+    self.lock.acquire()
+    try:
+      return self.db.execute("SELECT 1 FROM results WHERE filename = ?",
+                             (filename,)).fetchone() is not None
+    finally:
+      self.lock.release()
+
+  def _where(self, filters):
+    """ Builds a WHERE clause from column=value filters. A list, tuple or
+        set of values matches any of them. 'after' and 'before' bound the
+        timestamp, inclusively. """
+    clauses = []
+    args = []
+    for (column, value) in filters.iteritems():
+      if value is None:
+        continue
+      if column == "after":
+        clauses.append("timestamp >= ?")
+        args.append(value)
+      elif column == "before":
+        clauses.append("timestamp <= ?")
+        args.append(value)
+      elif type(value) in (list, tuple, set):
+        value = list(value)
+        clauses.append(column+" IN ("+",".join(["?"]*len(value))+")")
+        args.extend(value)
+      else:
+        clauses.append(column+" = ?")
+        args.append(value)
+    if not clauses:
+      return ("", args)
+    return (" WHERE "+" AND ".join(clauses), args)
+
+  def _select(self, what, filters, tail=""):
+    (where, args) = self._where(filters)
+    self.lock.acquire()
+    try:
+      return self.db.execute("SELECT "+what+" FROM results"+where+tail,
+                             args).fetchall()
+    finally:
+      self.lock.release()
+
+  def load(self, **filters):
+    results = []
+    for (blob,) in self._select("result", filters):
+      result = pickle.loads(str(blob))
+      result.depickle_upgrade()
+      results.append(result)
+    return results
+
+  def exits(self, **filters):
+    return set([r[0] for r in self._select("DISTINCT exit_node", filters)])
+
+  def counts(self, **filters):
+    return self._select("exit_node, test_class, status, reason, COUNT(*)",
+                        filters,
+                        " GROUP BY exit_node, test_class, status, reason")
+
 class DataHandler:
-  def __init__(self, my_data_dir=soat_dir):
+  def __init__(self, my_data_dir=soat_dir, use_db=True):
     self.data_dir = my_data_dir
+    self.store = None
+    self.journals = {}
+    if use_db and result_db:
+      if sqlite3:
+        self.store = ResultStore.open(self.__storeFilename())
+        if self.store.created and self.__hasResultFiles():
+          plog("WARN", "Found .result files next to the new result database "
+               +self.store.filename+". Run ./soatimport.py to import them.")
+          self.store.created = False
+      else:
+        plog("WARN", "No sqlite3 module. Keeping results in .result files.")
 
   ''' Class for saving and managing test result data '''
   def filterResults(self, results, protocols=[], show_good=False, 
@@ -648,39 +790,101 @@ class DataHandler:
 
   def getAll(self):
     ''' get all available results'''
-    return self.__getResults(self.data_dir)
+    return self.getResults()
 
   def getSsh(self):
     ''' get results of ssh tests '''
-    return self.__getResults(self.data_dir + 'ssh/')
+    return self.getResults(proto='ssh')
     
   def getHttp(self):
     ''' get results of http tests '''
-    return self.__getResults(self.data_dir + 'http/')
+    return self.getResults(proto='http')
 
   def getSsl(self):
     ''' get results of ssl tests '''
-    return self.__getResults(self.data_dir + 'ssl/')
+    return self.getResults(proto='ssl')
 
   def getSmtp(self):
     ''' get results of smtp tests '''
-    return self.__getResults(self.data_dir + 'smtp/')
+    return self.getResults(proto='smtp')
 
   def getPop(self):
     ''' get results of pop tests '''
-    return self.__getResults(self.data_dir + 'pop/')
+    return self.getResults(proto='pop')
 
   def getImap(self):
     ''' get results of imap tests '''
-    return self.__getResults(self.data_dir + 'imap/')
+    return self.getResults(proto='imap')
 
   def getDns(self):
     ''' get results of basic dns tests '''
-    return self.__getResults(self.data_dir + 'dns')
+    return self.getResults(proto='dns')
 
   def getDnsRebind(self):
     ''' get results of dns rebind tests '''
-    return self.__getResults(self.data_dir + 'dnsbrebind/')
+    return self.getResults(test_class='DNSRebindTestResult')
+
+  def getResults(self, **filters):
+    '''
+    get the results matching all of the filters: proto, test_class,
+    exit_node, site, status and reason (each a value or a list of them),
+    and after and before (timestamps)
+    '''
+    if self.store:
+      results = self.store.load(**filters)
+      for result in results:
+        # The filename stays the key the result was saved under
+        key = result.filename
+        result.rebase(self.data_dir)
+        result.filename = key
+      return results
+    rdir = self.data_dir
+    if filters.get('proto') and type(filters['proto']) == str and \
+       os.path.isdir(rdir+filters['proto']):
+      rdir += filters['proto']+'/'
+    return filter(lambda r: self.__matches(r, filters),
+                  self.__getResults(rdir))
+
+  def getExits(self, **filters):
+    ''' get the set of exits with results matching the filters '''
+    if self.store:
+      return self.store.exits(**filters)
+    return set(map(lambda r: r.exit_node, self.getResults(**filters)))
+
+  def getCounts(self, **filters):
+    '''
+    count the results matching the filters by exit, result class, status
+    and reason. Returns a list of (exit_node, class name, status, reason,
+    count) tuples.
+    '''
+    if self.store:
+      return self.store.counts(**filters)
+    counts = {}
+    for r in self.getResults(**filters):
+      key = (r.exit_node, r.__class__.__name__, r.status, r.reason)
+      counts[key] = counts.get(key, 0) + 1
+    return [key+(n,) for (key, n) in counts.iteritems()]
+
+  def __matches(self, result, filters):
+    for (field, value) in filters.iteritems():
+      if value is None:
+        continue
+      if field == 'after':
+        if result.timestamp < value: return False
+      elif field == 'before':
+        if result.timestamp > value: return False
+      else:
+        if field == 'test_class':
+          have = result.__class__.__name__
+        elif field == 'proto':
+          have = result.proto.lower()
+        else:
+          have = getattr(result, field)
+        if type(value) in (list, tuple, set):
+          if have not in value: return False
+        elif have != value:
+          return False
+    return True
 
   def __getResults(self, rdir):
     ''' 
@@ -698,8 +902,57 @@ class DataHandler:
     return results
 
   def getResult(self, file):
+    if self.store:
+      results = self.store.load(filename=os.path.normpath(file))
+      if results:
+        return results[0]
     return SnakePickler.load(file)
 
+  def importResults(self, remove=False):
+    '''
+    copy the .result files under the data dir into the result database,
+    and delete them afterwards if remove is set. Returns the number of
+    results imported.
+    '''
+    if not self.store:
+      raise Exception, "No result database to import into."
+    imported = 0
+    batch = []
+    for root, dirs, files in os.walk(self.data_dir):
+      for f in files:
+        if not f.endswith('.result'):
+          continue
+        filename = os.path.join(root, f)
+        result = SnakePickler.load(filename)
+        if result is None:
+          continue
+        result.filename = os.path.normpath(filename)
+        batch.append(result)
+        if len(batch) >= 1000:
+          imported += self.__importBatch(batch, remove)
+          batch = []
+    return imported + self.__importBatch(batch, remove)
+
+  def __importBatch(self, batch, remove):
+    self.store.saveMany(batch)
+    if remove:
+      for result in batch:
+        os.unlink(result.filename)
+    return len(batch)
+
+  def __hasResultFiles(self):
+    for root, dirs, files in os.walk(self.data_dir):
+      for f in files:
+        if f.endswith('.result'):
+          return True
+    return False
+
+  def __storeFilename(self):
+    # snakeinspector is pointed at the data dir above soat/
+    if os.path.isdir(os.path.join(self.data_dir, 'soat')):
+      return os.path.join(self.data_dir, 'soat', result_db)
+    return os.path.join(self.data_dir, result_db)
+
   def uniqueFilename(afile):
     (prefix,suffix)=os.path.splitext(afile)
     i=0
@@ -743,7 +996,14 @@ class DataHandler:
     elif result.status == TEST_FAILURE:
       rdir += 'failed/'
 
-    return DataHandler.uniqueFilename(str((rdir+address+'.'+result.exit_node[1:]+".result").decode('ascii', 'ignore')))
+    afile = str((rdir+address+'.'+result.exit_node[1:]+".result").decode('ascii', 'ignore'))
+    if self.store:
+      (prefix,suffix)=os.path.splitext(os.path.normpath(afile))
+      i=0
+      while self.store.has(prefix+"."+str(i)+suffix):
+        i+=1
+      return prefix+"."+str(i)+suffix
+    return DataHandler.uniqueFilename(afile)
 
   def checkResultDir(self, dir):
     if not dir.startswith(self.data_dir):
@@ -762,7 +1022,10 @@ class DataHandler:
     ''' generic method for saving test results '''
     if result.filename is None:
       result.filename = self.__resultFilename(result)
-    SnakePickler.dump(result, result.filename)
+    if self.store:
+      self.store.save(result)
+    else:
+      SnakePickler.dump(result, result.filename)
 
   def __testFilename(self, test, position=-1):
     if hasattr(test, "save_name"):
@@ -782,13 +1045,21 @@ class DataHandler:
         i+=1
       position = i-1
     
-    test = SnakePickler.load(filename+"."+str(position)+".test")
+    filename = filename+"."+str(position)+".test"
+    test = SnakePickler.load(filename)
+    if test and os.path.exists(filename+".journal"):
+      TestJournal.replay(test, filename+".journal")
     return test
 
   def saveTest(self, test):
     if not test.filename:
       test.filename = self.__testFilename(test)
-    SnakePickler.dump(test, test.filename)
+    if not test_journal_compact:
+      SnakePickler.dump(test, test.filename)
+      return
+    if test.filename not in self.journals:
+      self.journals[test.filename] = TestJournal(test.filename)
+    self.journals[test.filename].save(test)
 
 # These three bits are needed to fully recursively strain the parsed soup.
 # For some reason, the SoupStrainer does not get applied recursively..
@@ -877,26 +1148,215 @@ class SnakePickler:
     f.close()
     return obj
   load = Callable(load)
+
+class TestJournal:
+  """ Saves a Test as a full pickle (its .test file) plus a journal of
+      what changed in it since. Each save compares the test's attributes
+      against a copy of what was last saved, and appends only the
+      differences: dict entries set or deleted, set members added or
+      removed, items appended to lists, and any other attribute whose
+      pickle changed. Only containers are compared one level deep, so
+      objects changed in place inside them (such as test results) are only
+      picked up when the journal is compacted into a new .test file. """
+  def __init__(self, filename):
+    self.filename = filename
+    self.journal = filename+".journal"
+    self.lock = threading.Lock()
+    self.shadow = {}
+    self.saves = 0
+    self.test_size = 0
+    self.journal_size = 0
+
+  def save(self, test):
+    self.lock.acquire()
+    try:
+      if not self.shadow or self.saves >= test_journal_compact or \
+         self.journal_size > self.test_size:
+        self.compact(test)
+      else:
+        self.append(self.diff(test.__dict__))
+    finally:
+      self.lock.release()
+
+  def compact(self, test):
+    tmp = self.filename+".tmp"
+    SnakePickler.dump(test, tmp)
+    if not os.path.exists(tmp):
+      return # Already logged by SnakePickler
+    # If we die before the rename, the old .test file without its journal
+    # is still a consistent, if older, state.
+    if os.path.exists(self.journal):
+      os.unlink(self.journal)
+    os.rename(tmp, self.filename)
+    self.test_size = os.path.getsize(self.filename)
+    self.journal_size = 0
+    self.saves = 0
+    self.shadow = {}
+    self.diff(test.__dict__) # Refill the shadow
+
+  def append(self, ops):
+    data = []
+    for op in ops:
+      try:
+        data.append(pickle.dumps(op, pickle.HIGHEST_PROTOCOL))
+      except Exception, e:
+        plog("WARN", "Not journaling "+op[0]+" of "+op[1]+": "+str(e))
+    data = "".join(data)
+    f = file(self.journal, "ab")
+    f.write(data)
+    f.close()
+    self.journal_size += len(data)
+    self.saves += 1
+
+  def _copy(value):
+    if type(value) in (dict, set, list):
+      return copy.copy(value)
+    return value
+  _copy = Callable(_copy)
+
+  def diff(self, state):
+    """ Returns the ops that turn the shadow into state, and updates the
+        shadow to match. """
+    ops = []
+    for attr in self.shadow.keys():
+      if attr not in state:
+        ops.append(("del", attr))
+        del self.shadow[attr]
+    for (attr, value) in state.iteritems():
+      kind = type(value)
+      if kind not in (dict, set, list):
+        kind = None
+      if attr not in self.shadow or self.shadow[attr][0] != kind:
+        old = None
+      else:
+        old = self.shadow[attr][1]
+
+      if kind is dict and old is not None:
+        for key in old.keys():
+          if key not in value:
+            ops.append(("ddel", attr, key))
+            del old[key]
+        for (key, v) in value.iteritems():
+          if key not in old or old[key] != v:
+            ops.append(("dset", attr, key, v))
+            old[key] = TestJournal._copy(v)
+      elif kind is set and old is not None:
+        added = value - old
+        removed = old - value
+        if added:
+          ops.append(("sadd", attr, added))
+        if removed:
+          ops.append(("srem", attr, removed))
+        old |= added
+        old -= removed
+      elif kind is list and old is not None and len(value) >= len(old) \
+           and value[:len(old)] == old:
+        if len(value) > len(old):
+          ops.append(("lext", attr, value[len(old):]))
+          old.extend(value[len(old):])
+      elif kind is None:
+        try:
+          data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+          data = None # Not picklable. SnakePickler logs this on compaction
+        if data != old:
+          ops.append(("set", attr, value))
+          self.shadow[attr] = (kind, data)
+      else:
+        ops.append(("set", attr, value))
+        self.shadow[attr] = (kind, dict([(k, TestJournal._copy(v))
+                          for (k, v) in value.iteritems()])
+                            if kind is dict else copy.copy(value))
+    return ops
+
+  def replay(test, journal):
+    """ Applies the ops in the journal file to test """
+    f = file(journal, "rb")
+    ops = 0
+    try:
+      while True:
+        try:
+          op = pickle.load(f)
+        except EOFError:
+          break
+        except Exception, e:
+          plog("WARN", "Journal "+journal+" is cut short after "+str(ops)+
+               " entries: "+str(e))
+          break
+        state = test.__dict__
+        if op[0] == "set":
+          state[op[1]] = op[2]
+        elif op[0] == "del":
+          state.pop(op[1], None)
+        elif op[0] == "dset":
+          state[op[1]][op[2]] = op[3]
+        elif op[0] == "ddel":
+          state[op[1]].pop(op[2], None)
+        elif op[0] == "sadd":
+          state[op[1]] |= op[2]
+        elif op[0] == "srem":
+          state[op[1]] -= op[2]
+        elif op[0] == "lext":
+          state[op[1]].extend(op[2])
+        ops += 1
+    finally:
+      f.close()
+    plog("INFO", "Replayed "+str(ops)+" journal entries onto "+
+         test.__class__.__name__)
+  replay = Callable(replay)
      
+class SoupSets:
+  """ The tag, attribute and content sets that SoupDiffer compares a soup
+      by. SoupDiffer takes these in place of a soup, so a soup that is
+      diffed many times only needs to be parsed once. """
+  def __init__(self, soup):
+    self.tags = SoupSets.get_tags(soup)
+    self.attrs = SoupSets.get_attributes(soup)
+    self.content = SoupSets.get_content(soup)
+
+  def get_tags(soup):
+    return set(map(str,
+           [tag for tag in soup.findAll() if isinstance(tag, Tag)]))
+  get_tags = Callable(get_tags)
+
+  def get_attributes(soup):
+    attr_soup = [(tag.name, tag.attrs) for tag in soup.findAll()]
+    attrs = set([])
+    for (tag, attr_list) in attr_soup:
+      for at in attr_list:
+        attrs.add((tag, at)) 
+    return attrs
+  get_attributes = Callable(get_attributes)
+
+  def get_content(soup):
+    return set(map(str,
+      [tag for tag in soup.findAll() if not isinstance(tag, Tag)]))
+  get_content = Callable(get_content)
+
 class SoupDiffer:
   """ Diff two soup tag sets, optionally writing diffs to outfile. """
   def __init__(self, soup_old, soup_new):
-    tags_old = self._get_tags(soup_old)
-    tags_new = self._get_tags(soup_new)
+    if not isinstance(soup_old, SoupSets):
+      soup_old = SoupSets(soup_old)
+    if not isinstance(soup_new, SoupSets):
+      soup_new = SoupSets(soup_new)
+
+    tags_old = soup_old.tags
+    tags_new = soup_new.tags
     self.tag_pool = tags_new | tags_old
     self.changed_tag_map = {}
     self._update_changed_tag_map(tags_old, tags_new)
     self._update_changed_tag_map(tags_new, tags_old)
 
-    attrs_new = self._get_attributes(soup_new)
-    attrs_old = self._get_attributes(soup_old)
+    attrs_new = soup_new.attrs
+    attrs_old = soup_old.attrs
     self.attr_pool = attrs_new | attrs_old
     self.changed_attr_map = {}
     self._update_changed_attr_map(attrs_new, attrs_old)
     self._update_changed_attr_map(attrs_old, attrs_new)
 
-    cntnt_new = self._get_content(soup_new)
-    cntnt_old = self._get_content(soup_old)
+    cntnt_new = soup_new.content
+    cntnt_old = soup_old.content
     self.content_pool = cntnt_new | cntnt_old
     self.content_changed = bool(cntnt_new ^ cntnt_old) 
     self._pickle_revision = 0    
@@ -905,20 +1365,13 @@ class SoupDiffer:
     pass
 
   def _get_tags(self, soup):
-    return set(map(str,
-           [tag for tag in soup.findAll() if isinstance(tag, Tag)]))
+    return SoupSets.get_tags(soup)
 
   def _get_attributes(self, soup):
-    attr_soup = [(tag.name, tag.attrs) for tag in soup.findAll()]
-    attrs = set([])
-    for (tag, attr_list) in attr_soup:
-      for at in attr_list:
-        attrs.add((tag, at)) 
-    return attrs
+    return SoupSets.get_attributes(soup)
 
   def _get_content(self, soup):
-    return set(map(str,
-      [tag for tag in soup.findAll() if not isinstance(tag, Tag)]))
+    return SoupSets.get_content(soup)
   
   def _update_changed_tag_map(self, tags_old, tags_new):
     """ Create a map of changed tags to ALL attributes that tag
@@ -1032,9 +1485,15 @@ class HeaderDiffer:
       return ret
 
 class JSDiffer:
-  def __init__(self, js_string):
+  def __init__(self, js_string, cache_file=None):
+    """ With a cache_file, the AST element counts of js_string are kept
+        there under the sha1 of js_string, so the same script is only
+        parsed once, also across runs. """
     self._pickle_revision = 0    
-    self.ast_cnts = self._count_ast_elements(js_string)
+    if cache_file:
+      self.ast_cnts = self._cached_ast_elements(js_string, cache_file)
+    else:
+      self.ast_cnts = self._count_ast_elements(js_string)
 
   def depickle_upgrade(self):
     pass
@@ -1086,6 +1545,29 @@ class JSDiffer:
       else: ast_cnts["ParseError:"+name] +=1
     return ast_cnts
 
+  def _cached_ast_elements(self, js_string, cache_file):
+    sha1sum = sha(js_string).hexdigest()
+    if os.path.exists(cache_file):
+      try:
+        f = file(cache_file, "rb")
+        try:
+          (cached_sum, ast_cnts) = pickle.load(f)
+        finally:
+          f.close()
+        if cached_sum == sha1sum:
+          # prune_differences() zeroes counts, so hand out a copy
+          return dict(ast_cnts)
+      except Exception, e:
+        plog("INFO", "Ignoring bad AST count cache "+cache_file+": "+str(e))
+    ast_cnts = self._count_ast_elements(js_string)
+    try:
+      f = file(cache_file, "wb")
+      pickle.dump((sha1sum, ast_cnts), f, pickle.HIGHEST_PROTOCOL)
+      f.close()
+    except IOError, e:
+      plog("WARN", "Could not save AST counts to "+cache_file+": "+str(e))
+    return dict(ast_cnts)
+
   def _difference_pruner(self, other_cnts):
     for node in self.ast_cnts.iterkeys():
       if node not in other_cnts:
@@ -199,10 +199,14 @@ def main(argv):
 
   if conf.use_file:
     results = [dh.getResult(conf.use_file)]
-  elif conf.node:
-    results = dh.filterByNode(dh.getAll(), conf.node)
   else:
-    results = dh.getAll()
+    # Let the result database do what filtering it can
+    results = dh.getResults(exit_node=conf.node,
+                            reason=conf.reasons or None,
+                            status=conf.statuscode or None,
+                            proto=conf.proto and conf.proto.lower(),
+                            test_class=conf.resultfilter,
+                            after=conf.after, before=conf.before)
 
   if conf.sortby == "url":
     results.sort(lambda x, y: cmp(x.site, y.site))
@@ -145,24 +145,101 @@ class BindingSocket(_origsocket):
     if BindingSocket.bind_to:
       plog("DEBUG", "Binding socket to "+BindingSocket.bind_to)
       self.bind((BindingSocket.bind_to, 0))
-socket.socket = BindingSocket
 
+class WorkerState(threading.local):
+  """ What each scanning thread keeps to itself. Without --workers the
+      main thread is the only one. """
+  tag = None # SOCKS username of a pool worker's streams
+  torified = False
+  tor_cookie_jar = None
+  cookie_jar = None
+  def __init__(self):
+    self.sources = [] # Local addresses of our streams, for the port table
+worker = WorkerState()
+
+# Pool workers hold this while they run tests, and let go of it only while
+# they wait on Tor in torify()
+scan_lock = threading.Lock()
+
+class TorSocket(socks.socksocket):
+  """ A SOCKS socket to Tor. A pool worker's streams carry its tag as
+      SOCKS username, so Tor keeps them apart from every other worker's. """
+  def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None):
+    socks.socksocket.__init__(self, family, type, proto, _sock)
+    self.setproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port,
+                  True, worker.tag, worker.tag)
+
+  def _socksocket__negotiatesocks5(self, destaddr, destport):
+    # Tor reports the stream as soon as we ask for it, so tell
+    # ExitScanHandler whose stream it is first
+    addr = self.getsockname()
+    source = addr[0]+":"+str(addr[1])
+    worker.sources.append(source)
+    if worker.tag:
+      scanhdlr.add_worker_source(source, worker.tag)
+    return socks.socksocket._socksocket__negotiatesocks5(self, destaddr,
+                                                         destport)
+
+def scan_socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None):
+  # Sockets go through Tor only for the thread that is inside torify()
+  if worker.torified:
+    return TorSocket(family, type, proto, _sock)
+  return BindingSocket(family, type, proto, _sock)
+socket.socket = scan_socket
+
+
+def forget_sources():
+  # Like SmartSocket.clear_port_table(), but for this thread's streams only
+  PathSupport.SmartSocket._table_lock.acquire()
+  for s in worker.sources:
+    if s in PathSupport.SmartSocket.port_table:
+      PathSupport.SmartSocket.port_table.remove(s)
+  PathSupport.SmartSocket._table_lock.release()
+  if worker.tag:
+    scanhdlr.remove_worker_sources(worker.sources)
+  worker.sources = []
 
 def torify(func, *args):
-  defaultsocket = socket.socket
-  socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, TorUtil.tor_host, TorUtil.tor_port)
-  socket.socket = socks.socksocket
-  rval = None
+  worker.torified = True
+  # Let the other workers run while this one waits on Tor
+  if worker.tag:
+    scan_lock.release()
   try:
-    rval = apply(func, args)
-  except:
-    PathSupport.SmartSocket.clear_port_table()
-    socket.socket = defaultsocket
-    raise
-  # reset the connection method back to direct
-  PathSupport.SmartSocket.clear_port_table()
-  socket.socket = defaultsocket
-  return rval
+    return apply(func, args)
+  finally:
+    if worker.tag:
+      scan_lock.acquire()
+    # reset the connection method back to direct
+    worker.torified = False
+    forget_sources()
+
+def in_main_thread():
+  return threading.currentThread().getName() == "MainThread"
+
+class ThreadAlarm:
+  """ signal.alarm() for threads other than the main one, which never see
+      SIGALRM. Instead of raising ReadTimeout it shuts the socket down, so
+      whatever is blocked on it fails, and sets 'fired'. """
+  def __init__(self, sock):
+    self.sock = sock
+    self.timer = None
+    self.fired = False
+
+  def alarm(self, secs):
+    if self.timer:
+      self.timer.cancel()
+      self.timer = None
+    if secs:
+      self.timer = threading.Timer(secs, self._fire)
+      self.timer.setDaemon(True)
+      self.timer.start()
+
+  def _fire(self):
+    self.fired = True
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
 
 
 # Nice.. HTTPConnection.connect is doing DNS for us! Fix that:
@@ -210,6 +287,14 @@ class ExitScanHandler(ScanSupport.ScanHandler):
     for f in fixed_exits:
       x = self.name_to_key.get(f, f)
       self.fixed_exits.add(x.lstrip("$"))
+    # Pool workers each have an exit and circuits of their own. We know
+    # a worker's streams by the local address they come from.
+    self.worker_lock = threading.Lock()
+    self.worker_sources = {} # "ip:port" -> worker tag
+    self.worker_exits = {} # worker tag -> exit idhex
+    self.worker_last_exit = {} # worker tag -> Router
+    self.stream_workers = {} # strm_id -> worker tag
+    self.circ_workers = {} # circ_id -> worker tag
 
   def has_new_nodes(self):
     # XXX: Hrmm.. could do this with conditions instead..
@@ -287,6 +372,105 @@ class ExitScanHandler(ScanSupport.ScanHandler):
         break
     return current_exit_idhex
 
+  def add_worker_source(self, source, tag):
+    self.worker_lock.acquire()
+    self.worker_sources[source] = tag
+    self.worker_lock.release()
+
+  def remove_worker_sources(self, sources):
+    self.worker_lock.acquire()
+    for s in sources:
+      if s in self.worker_sources:
+        del self.worker_sources[s]
+    self.worker_lock.release()
+
+  def set_worker_exit(self, tag, idhex):
+    """ Makes idhex the exit for the streams of worker 'tag'. Returns False
+        if it can't be used. """
+    cond = threading.Condition()
+    def notlambda(sm):
+      cond.acquire()
+      sm.set_exit("$"+idhex)
+      cond._result = not sm.bad_restrictions
+      if cond._result:
+        self.worker_exits[tag] = idhex
+        self.worker_last_exit[tag] = None
+        # Retire the circuits to the worker's previous exit
+        for (circ_id, t) in self.circ_workers.items():
+          if t == tag:
+            if circ_id in self.circuits:
+              self.circuits[circ_id].dirty = True
+            del self.circ_workers[circ_id]
+      cond.notify()
+      cond.release()
+    cond.acquire()
+    self.schedule_selmgr(notlambda)
+    cond.wait()
+    cond.release()
+    return cond._result
+
+  def select_worker_exit(self, tag, exits):
+    # As select_exit_from_set(), for one worker of a pool. The exits of the
+    # other workers stay as they are.
+    rand_ord_exits = list(exits)
+    random.shuffle(rand_ord_exits)
+    for e in rand_ord_exits:
+      plog("DEBUG", "Requesting $"+e+" for worker "+tag+".")
+      if self.set_worker_exit(tag, e):
+        return e
+      plog("DEBUG", "$"+e+" is not available.")
+      exits.remove(e)
+    return None
+
+  def get_exit_node(self):
+    # A pool worker's results belong to its own exit
+    if worker.tag is None:
+      return ScanSupport.ScanHandler.get_exit_node(self)
+    ret = copy.copy(self.worker_last_exit.get(worker.tag)) # GIL FTW
+    if ret: plog("DEBUG", "Got last exit of "+ret.idhex+" for "+worker.tag)
+    else: plog("DEBUG", "No last exit for "+worker.tag)
+    return ret
+
+  def get_stream_exit(self, strm_id):
+    tag = self.stream_workers.get(strm_id)
+    if tag is None:
+      return ScanSupport.ScanHandler.get_exit_node(self)
+    return copy.copy(self.worker_last_exit.get(tag))
+
+  def stream_status_event(self, s):
+    if s.status in ("NEW", "NEWRESOLVE") and s.source_addr:
+      self.worker_lock.acquire()
+      tag = self.worker_sources.get(s.source_addr)
+      self.worker_lock.release()
+      if tag:
+        self.stream_workers[s.strm_id] = tag
+    ScanSupport.ScanHandler.stream_status_event(self, s)
+    if s.status == "CLOSED" and s.strm_id in self.stream_workers:
+      del self.stream_workers[s.strm_id]
+
+  def attach_stream_any(self, stream, badcircs):
+    tag = self.stream_workers.get(stream.strm_id)
+    if tag is None or tag not in self.worker_exits:
+      return ScanSupport.ScanHandler.attach_stream_any(self, stream, badcircs)
+    idhex = self.worker_exits[tag]
+    for circ_id in self.circ_workers.keys():
+      if circ_id not in self.circuits:
+        del self.circ_workers[circ_id]
+    # Only the worker's own circuits through its exit will do. If there
+    # are none, the selection manager builds one to its exit.
+    badcircs = list(badcircs)
+    for circ in self.circuits.itervalues():
+      if self.circ_workers.get(circ.circ_id) != tag or \
+         circ.exit.idhex != idhex:
+        badcircs.append(circ.circ_id)
+    self.selmgr.set_exit("$"+idhex)
+    ScanSupport.ScanHandler.attach_stream_any(self, stream, badcircs)
+    if stream.pending_circ:
+      self.circ_workers[stream.pending_circ.circ_id] = tag
+    # last_exit is only ours if the stream went to our exit
+    if self.last_exit and self.last_exit.idhex == idhex:
+      self.worker_last_exit[tag] = self.last_exit
+
   # FIXME: Hrmm is this in the right place?
   def check_all_exits_port_consistency(self):
     '''
@@ -475,13 +659,19 @@ def _ssl_request(address, method='TLSv1_METHOD'):
 
   def _raise_timeout(signum, frame):
     raise ReadTimeout("SSL connection timed out")
-  signal.signal(signal.SIGALRM, _raise_timeout)
+  if in_main_thread():
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    alarm = signal.alarm
+    thread_alarm = None
+  else:
+    thread_alarm = ThreadAlarm(s)
+    alarm = thread_alarm.alarm
   # open an ssl connection
   rval = (None, None, None)
   try:
     c = SSL.Connection(ctx, s)
     c.set_connect_state()
-    signal.alarm(int(read_timeout)) # raise a timeout after read_timeout
+    alarm(int(read_timeout)) # raise a timeout after read_timeout
     c.connect((address_name, port)) # DNS OK.
     # XXX: A PEM encoded certificate request was a bizarre and fingerprintable
     # thing to send here. All we actually need to do is perform a handshake,
@@ -516,7 +706,7 @@ def _ssl_request(address, method='TLSv1_METHOD'):
       traceback.print_exc()
       rval = (E_MISC, None, e.__class__.__name__+str(e))
   except SSL.Error, e:
-    signal.alarm(0) # Since we might recurse
+    alarm(0) # Since we might recurse
     for (lib, func, reason) in e[0]:
       if reason in ('wrong version number','sslv3 alert illegal parameter'):
         # Check if the server supports a different SSL version
@@ -529,13 +719,15 @@ def _ssl_request(address, method='TLSv1_METHOD'):
       traceback.print_exc()
       rval = (E_MISC, None,  e.__class__.__name__+str(e))
   except KeyboardInterrupt:
-    signal.alarm(0)
+    alarm(0)
     raise
   except Exception, e:
     plog('WARN', 'An unknown SSL error occured for '+address+': '+str(e))
     traceback.print_exc()
     rval = (E_MISC, None,  e.__class__.__name__+str(e))
-  signal.alarm(0)
+  alarm(0)
+  if thread_alarm and thread_alarm.fired:
+    rval = (E_TIMEOUT, None, "Socket timeout")
   plog("INFO", "SSL Request done for addrress: "+str(address))
   return rval
 
@@ -728,12 +920,7 @@ class Test:
     self.refill_targets()
 
   def load_rescan(self, type, since=None):
-    self.rescan_nodes = set([])
-    results = datahandler.getAll()
-    for r in results:
-      if r.status == type:
-        if not since or r.timestamp >= since:
-          self.rescan_nodes.add(r.exit_node)
+    self.rescan_nodes = datahandler.getExits(status=type, after=since)
     plog("INFO", "Loaded "+str(len(self.rescan_nodes))+" nodes to rescan")
     if self.nodes and self.rescan_nodes:
       self.nodes &= self.rescan_nodes
@@ -789,7 +976,8 @@ class Test:
       self.node_results[node] = []
     self.node_results[node].append(result)
     if len(self.node_results[node]) >= self.tests_per_node:
-      self.nodes.remove(node)
+      # A node update may have dropped it already
+      self.nodes.discard(node)
       self.scan_nodes = len(self.nodes)
       self.nodes_to_mark = self.scan_nodes*self.tests_per_node
       plog("INFO", "Removed node "+node+". "+str(len(self.nodes))+" nodes remain")
@@ -1024,17 +1212,17 @@ class Test:
 class BaseHTTPTest(Test):
   def __init__(self):
     # FIXME: Handle http urls w/ non-80 ports..
-    self.fetch_queue = []
     Test.__init__(self, "HTTP", 80)
     self.save_name = "HTTPTest"
     self.compare_funcs = {'html': self.compare_html, "js": self.compare_js}
 
+  # Parsed baseline content, by context: (sha1 of the content, SoupSets).
+  # Kept on the class so it is not saved with the test.
+  baseline_soups = {}
+
   def _reset(self):
     self.httpcode_fails = {}
     self.httpcode_fails_per_exit = {}
-    # Default cookie jar for new test
-    self.tor_cookie_jar = None
-    self.cookie_jar = None
     # Default headers for new test
     self.headers = copy.copy(firefox_headers)
 
@@ -1055,9 +1243,9 @@ class BaseHTTPTest(Test):
     tor_cookies = "\n"
     plain_cookies = "\n"
     # FIXME: do we need to sort these? So far we have worse problems..
-    for cookie in self.tor_cookie_jar:
+    for cookie in worker.tor_cookie_jar:
       tor_cookies += "\t"+cookie.name+":"+cookie.domain+cookie.path+" discard="+str(cookie.discard)+"\n"
-    for cookie in self.cookie_jar:
+    for cookie in worker.cookie_jar:
       plain_cookies += "\t"+cookie.name+":"+cookie.domain+cookie.path+" discard="+str(cookie.discard)+"\n"
     if tor_cookies != plain_cookies:
       exit_node = "$"+scanhdlr.get_exit_node().idhex
@@ -1073,20 +1261,22 @@ class BaseHTTPTest(Test):
     return TEST_SUCCESS
 
   def run_test(self):
-    # A single test should have a single cookie jar
-    self.tor_cookie_jar = cookielib.MozillaCookieJar()
-    self.cookie_jar = cookielib.MozillaCookieJar()
+    # A single test should have a single cookie jar. Pool workers can be
+    # running this test at the same time, so each keeps its own jars and
+    # queue.
+    worker.tor_cookie_jar = cookielib.MozillaCookieJar()
+    worker.cookie_jar = cookielib.MozillaCookieJar()
 
     self.tests_run += 1
 
-    self.fetch_queue.extend(self.select_targets())
+    fetch_queue = self.select_targets()
 
-    plog('INFO',str(self.fetch_queue))
+    plog('INFO',str(fetch_queue))
 
     n_success = n_fail = n_inconclusive = 0
 
-    while self.fetch_queue:
-      address, filetype = self.fetch_queue.pop(0)
+    while fetch_queue:
+      address, filetype = fetch_queue.pop(0)
       # FIXME: Set referrer to random or none for each of these
       result = self.check_http(address,filetype)
       if result == TEST_INCONCLUSIVE:
@@ -1096,9 +1286,8 @@ class BaseHTTPTest(Test):
       if result == TEST_SUCCESS:
         n_success += 1
 
-    # Cookie jars contain locks and can't be pickled. Clear them away.
-    self.tor_cookie_jar = None
-    self.cookie_jar = None
+    worker.tor_cookie_jar = None
+    worker.cookie_jar = None
 
     if n_fail:
       return TEST_FAILURE
@@ -1113,6 +1302,7 @@ class BaseHTTPTest(Test):
     # Delete results in httpcode_fails
     if target in self.httpcode_fails:
       del self.httpcode_fails[target]
+    BaseHTTPTest.baseline_soups.pop(self.address_to_context(target), None)
     Test.remove_target(self, target, reason)
 
   def remove_false_positives(self):
@@ -1153,7 +1343,7 @@ class BaseHTTPTest(Test):
     address = orig_address
 
     # Reqest the content using a direct connection
-    req = http_request(orig_address,self.cookie_jar, self.headers)
+    req = http_request(orig_address,worker.cookie_jar, self.headers)
 
     # Make a good faith effort to follow redirects
     count = 0
@@ -1163,7 +1353,7 @@ class BaseHTTPTest(Test):
       address = req.content
       if address in trail: break
       trail.add(address)
-      req = http_request(address, self.cookie_jar, self.headers)
+      req = http_request(address, worker.cookie_jar, self.headers)
 
       count += 1
       if count > 4: break
@@ -1215,11 +1405,11 @@ class BaseHTTPTest(Test):
     # Keep a copy of the cookie jar before mods for refetch or
     # to restore on errors that cancel a fetch
     my_tor_cookie_jar = cookielib.MozillaCookieJar()
-    for cookie in self.tor_cookie_jar:
+    for cookie in worker.tor_cookie_jar:
       my_tor_cookie_jar.set_cookie(cookie)
 
     my_cookie_jar = cookielib.MozillaCookieJar()
-    for cookie in self.cookie_jar:
+    for cookie in worker.cookie_jar:
       my_cookie_jar.set_cookie(cookie)
 
     # CA we should modify our headers so we look like a browser
@@ -1380,6 +1570,7 @@ class BaseHTTPTest(Test):
     f = open(context + '.content', 'w')
     f.write(req.content)
     f.close()
+    BaseHTTPTest.baseline_soups.pop(context, None)
 
     lines = req.content.split('\n')
 
@@ -1442,7 +1633,7 @@ class BaseHTTPTest(Test):
 
   def compare_js(self,new_content,old_content,context):
     # TODO check for truncation? Store differ?
-    jsdiff = JSDiffer(old_content)
+    jsdiff = JSDiffer(old_content, context+'.jscounts')
     has_changes = jsdiff.contains_differences(new_content)
     if not has_changes:
       return COMPARE_EQUAL
@@ -1451,7 +1642,7 @@ class BaseHTTPTest(Test):
 
   def compare_html(self,new_content,old_content,context):
     # TODO check for truncation? Store differ?
-    old_soup = FullyStrainedSoup(old_content.decode('ascii', 'ignore'))
+    old_soup = self.baseline_soup(old_content, context)
     new_soup = FullyStrainedSoup(new_content.decode('ascii', 'ignore'))
     htmldiff = SoupDiffer(old_soup,new_soup)
     html_has_changes = htmldiff.content_changed
@@ -1461,6 +1652,18 @@ class BaseHTTPTest(Test):
     else:
       return COMPARE_NOEQUAL
 
+  def baseline_soup(self, content, context):
+    """ The SoupSets of the baseline content saved for context. The
+        baseline is only parsed again once save_compare_data() replaces
+        it. """
+    sha1sum = sha(content).digest()
+    cached = BaseHTTPTest.baseline_soups.get(context)
+    if cached and cached[0] == sha1sum:
+      return cached[1]
+    soup = SoupSets(FullyStrainedSoup(content.decode('ascii', 'ignore')))
+    BaseHTTPTest.baseline_soups[context] = (sha1sum, soup)
+    return soup
+
   def load_original_sha1sum(self, address):
     context = self.address_to_context(address)
     f = open(context + '.content')
@@ -2496,7 +2699,7 @@ class DNSRebindScanner(TorCtl.EventHandler):
       for network in ipv4_nonpublic:
         if ipbin[:len(network)] == network:
           handler = DataHandler()
-          node = "$"+self.__mt.get_exit_node().idhex
+          node = "$"+self.__mt.get_stream_exit(event.strm_id).idhex
           plog("ERROR", "DNS Rebeind failure via "+node)
 
           result = DNSRebindTestResult(self.__mt.node_manager.idhex_to_r(node),
@@ -2549,14 +2752,19 @@ def decompress_response_data(response):
 
   def _raise_timeout(signum, frame):
     raise ReadTimeout("HTTP read timed out")
-  signal.signal(signal.SIGALRM, _raise_timeout)
+  # Other threads have only the socket timeout NoDNSHTTPConnection set
+  use_alarm = in_main_thread()
+  if use_alarm:
+    signal.signal(signal.SIGALRM, _raise_timeout)
 
   start = 0
   data = ""
   while True:
-    signal.alarm(int(read_timeout)) # raise a timeout after read_timeout
+    if use_alarm:
+      signal.alarm(int(read_timeout)) # raise a timeout after read_timeout
     data_read = response.read(500) # Cells are 495 bytes..
-    signal.alarm(0)
+    if use_alarm:
+      signal.alarm(0)
     if not start:
       start = time.time()
     # TODO: if this doesn't work, check stream observer for
@@ -2638,6 +2846,160 @@ def setup_handler(out_dir, cookie_file, fixed_exits=[]):
   atexit.register(cleanup, *(c, l, f))
   return (c,h)
 
+def finish_tests(tests, fixed_exits, do_rescan, running=None):
+  """ Rewinds the tests that have finished all their nodes, and returns
+      True once all of them are done for good. Tests still 'running' in a
+      pool worker are left for a later call. """
+  all_finished = True
+  for test in tests.itervalues():
+    if not test.finished() or (running and running.get(test)):
+      all_finished = False
+    else:
+      plog("NOTICE", test.proto+" test has finished all nodes.")
+      datahandler.saveTest(test)
+      if not fixed_exits:
+        test.remove_false_positives()
+      else:
+        plog("NOTICE", "Not removing false positives for fixed-exit scan")
+      if not do_rescan and rescan_at_finish:
+        if not test.toggle_rescan():
+          # Only timestamp as finished after the rescan
+          test.timestamp_results(time.time())
+        test.rewind()
+        all_finished = False
+      elif restart_at_finish:
+        test.timestamp_results(time.time())
+        test.rewind()
+        all_finished = False
+      else:
+        test.timestamp_results(time.time())
+  return all_finished
+
+def log_exit_rate(exits_tested, start, workers):
+  elapsed = time.time() - start
+  plog("INFO", "Tested "+str(exits_tested)+" exits in %.0fs (%.1f exits/hour, %d workers)" % (elapsed, exits_tested*3600.0/max(elapsed, 1), workers))
+
+class ExitWorkerPool:
+  """ Tests several exits at once. Each worker thread does what main()
+      does with one exit: it picks an exit that no other worker is on,
+      runs a random subset of the tests through it and marks the results
+      against it. The workers share the tests and hold scan_lock for all
+      but their Tor fetches. """
+  def __init__(self, tests, num_workers, fixed_exits, do_rescan):
+    self.tests = tests
+    self.num_workers = num_workers
+    self.fixed_exits = fixed_exits
+    self.do_rescan = do_rescan
+    self.cond = threading.Condition(scan_lock)
+    self.busy_exits = set([])
+    self.running = {} # test -> number of workers running it
+    self.nodes_pending = False
+    self.done = False
+    self.exits_tested = 0
+    self.start = time.time()
+
+  def run(self):
+    threads = []
+    for i in xrange(self.num_workers):
+      t = threading.Thread(target=self.work, args=("soat"+str(i),))
+      t.setDaemon(True)
+      threads.append(t)
+      t.start()
+    # Join with a timeout so that Ctrl-C still gets through
+    for t in threads:
+      while t.isAlive():
+        t.join(1)
+    log_exit_rate(self.exits_tested, self.start, self.num_workers)
+
+  def choose(self, tag):
+    """ Returns the tests to run and the exit to run them through, or
+        (None, None) if no exit is free. Sets the exit for worker 'tag'. """
+    if scanhdlr.has_new_nodes():
+      plog("INFO", "Got signal for node update.")
+      self.nodes_pending = True
+    if self.nodes_pending:
+      # The exits the other workers are on may have left the consensus,
+      # so wait for them to finish before updating the nodes
+      if self.busy_exits:
+        return (None, None)
+      for test in self.tests.itervalues():
+        test.update_nodes()
+      self.nodes_pending = False
+      plog("INFO", "Node update complete.")
+
+    # A finished test waits for its last workers before it is rewound
+    avail_tests = filter(lambda t: not t.finished(), self.tests.values())
+    if not avail_tests:
+      return (None, None)
+    n_tests = random.choice(xrange(1,len(avail_tests)+1))
+    to_run = random.sample(avail_tests, n_tests)
+
+    common_nodes = None
+    for test in to_run:
+      if common_nodes is None:
+        common_nodes = test.nodes - self.busy_exits
+      else:
+        common_nodes &= test.nodes
+    if common_nodes:
+      current_exit_idhex = scanhdlr.select_worker_exit(tag, common_nodes)
+      if current_exit_idhex:
+        return (to_run, current_exit_idhex)
+
+    for test in to_run:
+      current_exit_idhex = scanhdlr.select_worker_exit(tag,
+                                  test.nodes - self.busy_exits)
+      if current_exit_idhex:
+        return ([test], current_exit_idhex)
+    return (None, None)
+
+  def work(self, tag):
+    worker.tag = tag
+    self.cond.acquire()
+    try:
+      try:
+        while not self.done:
+          (to_run, current_exit_idhex) = self.choose(tag)
+          if not current_exit_idhex:
+            if self.busy_exits:
+              # The other workers are on the only exits left
+              self.cond.wait()
+              continue
+            plog("NOTICE", "Not enough exits were available to complete the tests. Exiting")
+            self.done = True
+            break
+
+          self.busy_exits.add(current_exit_idhex)
+          for test in to_run:
+            self.running[test] = self.running.get(test, 0) + 1
+          plog("DEBUG", tag+" chose to run "+str(len(to_run))+" tests via "+current_exit_idhex)
+          try:
+            for test in to_run:
+              result = test.run_test()
+              if result != TEST_INCONCLUSIVE:
+                test.mark_chosen(current_exit_idhex, result)
+              datahandler.saveTest(test)
+              plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
+              plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+          finally:
+            self.busy_exits.remove(current_exit_idhex)
+            for test in to_run:
+              self.running[test] -= 1
+          self.exits_tested += 1
+          log_exit_rate(self.exits_tested, self.start, self.num_workers)
+
+          if finish_tests(self.tests, self.fixed_exits, self.do_rescan,
+                          self.running):
+            plog("NOTICE", "All tests have finished. Exiting\n")
+            self.done = True
+          self.cond.notifyAll()
+      except:
+        plog("ERROR", "Worker "+tag+" failed. Stopping the scan.")
+        traceback.print_exc()
+        self.done = True
+    finally:
+      self.cond.notifyAll()
+      self.cond.release()
+
 def usage():
     print 'Please provide at least one test option:'
     print '--pernode=<n>'
@@ -2652,6 +3014,7 @@ def usage():
     print '--dnsrebind (use with one or more of above tests)'
     print '--policies'
     print '--exit=<exit>'
+    print '--workers=<n>'
     print '--target=<ip or url>'
     print '--loglevel=<DEBUG|INFO|NOTICE|WARN|ERROR|NONE>'
     print ''
@@ -2666,7 +3029,7 @@ def main(argv):
 
   TorUtil.read_config(data_dir+"/torctl.cfg")
 
-  opts = ['ssl','rescan', 'pernode=', 'resume=','http','ssh','smtp','pop','imap','dns','dnsrebind','policies','exit=','target=','loglevel=','help']
+  opts = ['ssl','rescan', 'pernode=', 'resume=','http','ssh','smtp','pop','imap','dns','dnsrebind','policies','exit=','target=','workers=','loglevel=','help']
 
   # make sure the arguments are correct
   try:
@@ -2704,6 +3067,9 @@ def main(argv):
     if flag[0] == "--rescan" and flag[1]:
       global num_rescan_tests_per_node
       num_rescan_tests_per_node = int(flag[1])
+    if flag[0] == "--workers":
+      global num_workers
+      num_workers = int(flag[1])
     if flag[0] == "--resume":
       do_resume = True
       resume_run=int(flag[1])
@@ -2836,6 +3202,14 @@ def main(argv):
     for test in tests.itervalues():
       test.rewind()
 
+  if num_workers > 1:
+    plog("NOTICE", "Testing "+str(num_workers)+" exits at a time")
+    ExitWorkerPool(tests, num_workers, fixed_exits, do_rescan).run()
+    return
+
+  exits_tested = 0
+  start = time.time()
+
   # start testing
   while 1:
     avail_tests = tests.values()
@@ -2879,6 +3253,7 @@ def main(argv):
         datahandler.saveTest(test)
         plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
         plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+      exits_tested += 1
     elif len(to_run) > 1:
       plog("NOTICE", "No nodes in common between "+", ".join(map(lambda t: t.proto, to_run)))
       for test in to_run:
@@ -2893,35 +3268,14 @@ def main(argv):
           datahandler.saveTest(test)
           plog("INFO", test.proto+" test via "+current_exit_idhex+" has result "+str(result))
           plog("INFO", test.proto+" attempts: "+str(test.tests_run)+".  Completed: "+str(test.total_nodes - test.scan_nodes)+"/"+str(test.total_nodes)+" ("+str(test.percent_complete())+"%)")
+          exits_tested += 1
         else:
           plog("INFO", "No available exits for "+test.proto+" test.")
           continue
+    log_exit_rate(exits_tested, start, 1)
 
     # Check each test for rewind
-    all_finished = True
-    for test in tests.itervalues():
-      if not test.finished():
-        all_finished = False
-      else:
-        plog("NOTICE", test.proto+" test has finished all nodes.")
-        datahandler.saveTest(test)
-        if not fixed_exits:
-          test.remove_false_positives()
-        else:
-          plog("NOTICE", "Not removing false positives for fixed-exit scan")
-        if not do_rescan and rescan_at_finish:
-          if not test.toggle_rescan():
-            # Only timestamp as finished after the rescan
-            test.timestamp_results(time.time())
-          test.rewind()
-          all_finished = False
-        elif restart_at_finish:
-          test.timestamp_results(time.time())
-          test.rewind()
-          all_finished = False
-        else:
-          test.timestamp_results(time.time())
-    if all_finished:
+    if finish_tests(tests, fixed_exits, do_rescan):
       plog("NOTICE", "All tests have finished. Exiting\n")
       return
     if not any_avail:
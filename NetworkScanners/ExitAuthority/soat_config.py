@@ -91,6 +91,10 @@ min_targets = 10
 num_tests_per_node = 5
 num_rescan_tests_per_node = 5
 
+# How many exits to test at once, each from its own worker thread
+# (can be overriden on command line)
+num_workers = 1
+
 # Number of timeouts before we consider a node failed.
 num_timeouts_per_node = 4
 
@@ -274,3 +278,14 @@ http_failed_dir = soat_dir + 'http/failed/'
 http_inconclusive_dir = soat_dir + 'http/inconclusive/'
 http_falsepositive_dir = soat_dir + 'http/falsepositive/'
 
+# Test results are kept in this sqlite database in soat_dir, indexed by
+# exit, site, class, status, reason and time. Set to None to keep them as
+# pickled .result files instead. ./soatimport.py copies existing .result
+# files into the database.
+result_db = 'results.sqlite'
+
+# After each test, only the parts of the test state that changed are
+# appended to a journal next to its .test file. The .test file is
+# rewritten in full every test_journal_compact saves, or once the journal
+# has outgrown it. Set to 0 to rewrite the .test file after every test.
+test_journal_compact = 500
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+#
+# Copies the pickled .result files of a soat data dir into its result
+# database (result_db in soat_config.py). Run it once after upgrading,
+# with soat.py stopped.
+
+import getopt
+import sys
+
+from libsoat import *
+from soat_config import *
+
+def usage(argv):
+  print "Usage: "+argv[0]+" [--dir <soat data dir>] [--remove]"
+  print "  --dir     defaults to "+soat_dir
+  print "  --remove  deletes each .result file once it has been imported"
+  sys.exit(1)
+
+def main(argv):
+  use_dir = soat_dir
+  remove = False
+  try:
+    opts,args = getopt.getopt(argv[1:], "d:rh", ["dir=", "remove", "help"])
+  except getopt.GetoptError,err:
+    print str(err)
+    usage(argv)
+  for o,a in opts:
+    if o == '-d' or o == '--dir':
+      use_dir = a
+    elif o == '-r' or o == '--remove':
+      remove = True
+    else:
+      usage(argv)
+
+  if not result_db:
+    print "result_db is not set in soat_config.py. Nothing to import into."
+    sys.exit(1)
+  dh = DataHandler(use_dir)
+  if not dh.store:
+    print "No sqlite3 module. Cannot import."
+    sys.exit(1)
+  count = dh.importResults(remove)
+  print "Imported "+str(count)+" results into "+dh.store.filename
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -39,38 +39,39 @@ class ResultNode:
 
 def main(argv):
   dh = DataHandler()
-  data = dh.getAll()
+  # (exit, result class, status, reason, count) rows
+  data = dh.getCounts()
 
   reason_counts = {}
   nodeResults = {}
   tests = set([])
 
-  total = len(data)
+  total = sum(map(lambda row: row[4], data))
 
-  for result in data:
-    if result.exit_node in nodeResults:
-      rn = nodeResults[result.exit_node]
+  for (exit_node, test, status, reason, count) in data:
+    if exit_node in nodeResults:
+      rn = nodeResults[exit_node]
     else:
-      rn = ResultNode(result.exit_node)
-      nodeResults[result.exit_node] = rn
-
-    tests.add(result.__class__.__name__) 
-    if result.__class__.__name__ not in rn.counts:
-      rn.counts[result.__class__.__name__] = ResultCount(result.__class__.__name__)
-
-    if result.status == TEST_SUCCESS:
-      rn.total.good += 1
-      rn.counts[result.__class__.__name__].good += 1
-    elif result.status == TEST_INCONCLUSIVE:
-      rn.total.inconclusive += 1
-      rn.counts[result.__class__.__name__].inconclusive += 1
-    elif result.status == TEST_FAILURE:
-      rn.total.bad += 1
-      rn.counts[result.__class__.__name__].bad += 1
-      if result.reason not in reason_counts:
-        reason_counts[result.reason] = 1
+      rn = ResultNode(exit_node)
+      nodeResults[exit_node] = rn
+
+    tests.add(test) 
+    if test not in rn.counts:
+      rn.counts[test] = ResultCount(test)
+
+    if status == TEST_SUCCESS:
+      rn.total.good += count
+      rn.counts[test].good += count
+    elif status == TEST_INCONCLUSIVE:
+      rn.total.inconclusive += count
+      rn.counts[test].inconclusive += count
+    elif status == TEST_FAILURE:
+      rn.total.bad += count
+      rn.counts[test].bad += count
+      if reason not in reason_counts:
+        reason_counts[reason] = count
       else:
-        reason_counts[result.reason] += 1
+        reason_counts[reason] += count
     
   # Sort by total counts, print out nodes with highest counts first
   failed_nodes = nodeResults.values()
@@ -1,5 +1,6 @@
 import socket
 import SocketServer
+import threading
 import time
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from OpenSSL import SSL, crypto
@@ -23,7 +24,11 @@ TOR_RESP= """\
 </html>
 """
 
-class SSLServer(HTTPServer):
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+  # soat --workers fetches through several exits at once
+  daemon_threads = True
+
+class SSLServer(ThreadingHTTPServer):
   def server_bind(self):
     HTTPServer.server_bind(self)
     pkey = crypto.PKey()
@@ -39,12 +44,39 @@ class SSLServer(HTTPServer):
     ctx.use_certificate(x509)
     self.socket = SSL.Connection(ctx, self.socket)
 
+class ExitCounter:
+  """ Counts the exits that fetched the Tor response, to measure how many
+      exits soat covers per hour. """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start = time.time()
+    self.exits = {} # ip -> fetches
+
+  def add(self, ip):
+    self.lock.acquire()
+    self.exits[ip] = self.exits.get(ip, 0) + 1
+    self.lock.release()
+
+  def report(self):
+    self.lock.acquire()
+    (n_exits, n_fetches) = (len(self.exits), sum(self.exits.values()))
+    self.lock.release()
+    elapsed = time.time() - self.start
+    return "%d exits, %d fetches in %.0fs (%.1f exits/hour)" % \
+           (n_exits, n_fetches, elapsed, n_exits*3600.0/max(elapsed, 1))
+
+def report_every(counter, secs):
+  while True:
+    time.sleep(secs)
+    print counter.report()
+
 class Tester:
   direct_ip = "127.0.0.1"
   exit_ip = None # By default 
+  counter = ExitCounter()
 
 class HTTPTester(BaseHTTPRequestHandler, Tester):
-  server=HTTPServer
+  server=ThreadingHTTPServer
   port=80
   def do_GET(self):
     if self.client_address[0] == self.direct_ip:
@@ -66,6 +98,7 @@ class HTTPTester(BaseHTTPRequestHandler, Tester):
     self.wfile.write(DIRECT_RESP)
 
   def tor_GET(self):
+    self.counter.add(self.client_address[0])
     self.send_response(200)
     self.send_header("Content-type", "text/html")
     self.send_header("Content-Length", str(len(TOR_RESP)))
@@ -74,6 +107,7 @@ class HTTPTester(BaseHTTPRequestHandler, Tester):
 
 class HTTPRedirectTester(BaseHTTPRequestHandler, HTTPTester):
   def tor_GET(self):
+    self.counter.add(self.client_address[0])
     self.send_response(302)
     self.send_header("Location", "torproject.org")
     self.end_headers()
@@ -89,17 +123,23 @@ class HTTPSTester(HTTPTester):
 
 def usage(argv):
   print "Usage: %s --exit=<exit ip> [options]" % argv[0]
+  print "  --direct=<ip>   address soat fetches from directly"
+  print "  --test=<name>   HTTP, HTTPS or HTTPRedirect"
+  print "  --port=<port>   port to serve on instead of the test's own"
+  print "  --report=<n>    print the exits seen every n seconds"
 
 if __name__ == '__main__':
   import sys
   import getopt
   try:
-    flags,rest = getopt.getopt(sys.argv[1:], "", ["exit=", "direct=", "test="])
+    flags,rest = getopt.getopt(sys.argv[1:], "", ["exit=", "direct=", "test=", "port=", "report="])
   except getopt.GetoptError,err:
     print err
     usage(sys.argv)
 
   test = "HTTP"
+  port = None
+  report = 0
   for flag, val in flags:
     if flag == "--exit":
       Tester.exit_ip = val
@@ -107,13 +147,24 @@ if __name__ == '__main__':
       Tester.direct_ip = val
     elif flag == "--test":
       test = val
+    elif flag == "--port":
+      port = int(val)
+    elif flag == "--report":
+      report = int(val)
 
   tester = globals().get(test+"Tester")
   if not tester:
     print "No such test, " + test
     sys.exit(1)
-  print "Serving %s on %d" % (test, tester.port)
+  if port is None:
+    port = tester.port
+  if report:
+    t = threading.Thread(target=report_every, args=(Tester.counter, report))
+    t.setDaemon(True)
+    t.start()
+  print "Serving %s on %d" % (test, port)
   try:
-    tester.server(('', tester.port), tester).serve_forever()
+    tester.server(('', port), tester).serve_forever()
   except KeyboardInterrupt:
+    print Tester.counter.report()
     print "Done"